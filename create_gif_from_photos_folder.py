@@ -21,7 +21,7 @@ parser = argparse.ArgumentParser()
 # required
 parser.add_argument("--photos-dir", dest='photos_dir', type=str, required=True, help="Source folder of images")
 parser.add_argument("--fps", dest='fps', type=float, default=3, help="Frames per second to render") 
-parser.add_argument("--fuzz", dest='fuzz', type=float, default=5, help="Fuzz factor for moviepy blur rendering")
+parser.add_argument("--fuzz", dest='fuzz', type=float, default=5, help="Percent color change under which a pixel is left unchanged between frames")
 parser.add_argument("--order", dest='order', type=str, default='ascending', help="ascending, descending, or random")
 parser.add_argument("--num-permutations", dest='num_permutations', type=int, default=1, help="When order is random, the number of permutations to try.")
 
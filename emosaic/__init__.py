@@ -1,11 +1,9 @@
 import time
 import traceback
-import random
 
 import numpy as np
-import cv2
 
-from emosaic.utils.image import divide_image_rectangularly, to_vector
+from emosaic.candidates import TileCandidates
 
 
 def mosaicify(
@@ -20,97 +18,83 @@ def mosaicify(
         best_k=1,
         trim=True,
         uniform_k=True,
-        no_duplicates=True,
+        no_duplicates=False,
+        match_size=None,
+        integral=None,
+        seed=None,
+        max_uses=None,
+        min_distance=0,
+        feature=None,
+        variants=None,
+        color_correction=0.0,
     ):
-    try:
-        rect_starts = divide_image_rectangularly(target_image, h_pixels=tile_h, w_pixels=tile_w)
-        mosaic = np.zeros(target_image.shape)
+    """
+    Searches & pastes the closest codebook tile for every tile of the target,
+    all tiles in one batch (see TileCandidates for the selection rules).
 
-        if use_stabilization:
-            dist_shape = (target_image.shape[0], target_image.shape[1])
-            last_dist = np.zeros(dist_shape).astype(np.int32)
-            last_dist[:, :] = 2**31 - 1
+    @param: match_size (tuple of ints) size the tile index was vectorized at (see index_images),
+            defaults to the tile size
+    @param: integral (TargetIntegral) of target_image, when rendering many scales of one target
+    @param: seed (int) for reproducible best_k & randomness picks
+    @param: no_duplicates (bool) spread tiles over the codebook, using each image at most
+            ceil(tiles / images) times, instead of best_k & randomness
+    @param: max_uses, min_distance (int) explicit limits, see TileCandidates.select_constrained
+    @param: feature (String) the tile index was built with, see emosaic.features
+    @param: variants (String or list) flips & rotations the tile index was built with, see index_images
+    @param: color_correction (float) shift each tile's mean color this far (0 to 1) towards its
+            target cell's, best with feature='centered' which matches ignoring mean color
 
-        timings = []
-        if verbose:
-            print("We have %d tiles to assign" % len(rect_starts))
+    @return: tuple (mosaic, rect_starts, seconds taken), tiles are matched in one
+             batch so there's no time per tile, only the total
+    """
+    try:
+        starttime = time.time()
 
-        seen_idx = { -1 }
-        for (j, (x, y)) in enumerate(rect_starts):
-            starttime = time.time()
-            
-            # get our target region & vectorize it
-            target = target_image[x : x + tile_h, y : y + tile_w]
-            target_h, target_w, _ = target.shape
-            v = to_vector(target, tile_h, tile_w)
-            
-            # find nearest codebook image
-            try:
-                if best_k == 1:
-                    dist, I = tile_index.search(v, k=1)
-                    idx = I[0][0]
-                else:
-                    if uniform_k:
-                        dist, I = tile_index.search(v, k=best_k)
-                        idx = random.choice(I[0])
-                    else:
-                        dist, I = tile_index.search(v, k=best_k + 1)
-                        distances = dist[0]
-                        deviation_from_max = np.abs(distances - distances.max())
-                        weighting = deviation_from_max / deviation_from_max.sum()
-                        idx = np.random.choice(I[0], p=weighting)
-                closest_tile = tile_images[idx]
-            except Exception:
-                import ipdb; ipdb.set_trace()
-            
-            # write into mosaic
-            if random.random() < randomness:
-                # pick a random tile!
-                num_images = len(tile_images)
-                rand_idx = random.choice(range(num_images))
-                if rand_idx in seen_idx:
-                    remaining_idx = set(range(num_images)) - seen_idx
-                    try:
-                        rand_idx = random.choice(list(remaining_idx))
-                    except IndexError:
-                        # just pick one anyway
-                        rand_idx = random.choice(range(num_images))
+        # enough candidates to choose from: the top best_k, plus the next one to weight against
+        if best_k <= 1:
+            k = 1
+        else:
+            k = best_k if uniform_k else best_k + 1
+        constrained = no_duplicates or max_uses or min_distance > 1
+        if constrained:
+            k = max(k, 8)
+        candidates = TileCandidates.search(
+            target_image, tile_h, tile_w, tile_index, k=k, match_size=match_size, integral=integral,
+            feature=feature, variants=variants)
+        if verbose:
+            print("We have %d tiles to assign" % candidates.num_tiles)
 
-                seen_idx.add(rand_idx)
-                mosaic[x : x + tile_h, y : y + tile_w] = tile_images[rand_idx]
-            else:
-                if use_stabilization:
-                    if dist < last_dist[x, y] * stabilization_threshold:
-                        mosaic[x : x + tile_h, y : y + tile_w] = closest_tile
-                else:
-                    mosaic[x : x + tile_h, y : y + tile_w] = closest_tile
+        if constrained:
+            if no_duplicates and not max_uses:
+                max_uses = int(np.ceil(candidates.num_tiles / float(len(tile_images))))
+            ids, report = candidates.select_constrained(
+                max_uses=max_uses, min_distance=min_distance,
+                tile_index=tile_index, target_image=target_image)
+            if verbose:
+                print("Constrained: %.2f%% from the best matches, %d tiles changed, took %.3fs" % (
+                    100 * report['gap'], report['changed'], report['seconds']))
+        else:
+            ids = candidates.select(
+                best_k=best_k,
+                uniform_k=uniform_k,
+                randomness=randomness,
+                num_images=len(tile_images),
+                seed=seed)
 
-            # set new last dist
-            if use_stabilization:
-                last_dist[x, y] = dist
-            
-            # record the performance
-            elapsed = time.time() - starttime
-            timings.append(elapsed)
+        if use_stabilization:
+            # only replace tiles with matches closer than the last ones (none yet)
+            last_dist = np.full(candidates.num_tiles, 2**31 - 1, dtype=np.float64)
+            ids[candidates.distances[:, 0] >= last_dist * stabilization_threshold] = -1
 
-        # should we adjust opacity? 
-        if opacity > 0:
-            mosaic = cv2.addWeighted(target_image, opacity, mosaic.astype(np.uint8), 1 - opacity, 0)
-        else:
-            mosaic = mosaic.astype(np.uint8)
+        mosaic = candidates.render(
+            tile_images, ids, target_image, opacity=opacity, trim=trim, color_correction=color_correction)
 
-        # should we trim the image to only the tiled area?
-        if trim:
-            (x1, y1), (x2, y2) = rect_starts[0], rect_starts[-1]
-            mosaic = mosaic[x1 : x2, y1 : y2]
-            
-        # show some results
-        arr = np.array(timings)
+        # record the performance
+        elapsed = time.time() - starttime
         if verbose:
-            print("Timings: mean=%.5f, stddev=%.5f" % (arr.mean(), arr.std()))
-        return mosaic, rect_starts, arr
+            print("Took %.3fs for %d tiles" % (elapsed, candidates.num_tiles))
+        return mosaic, candidates.rect_starts, elapsed
 
     except Exception:
         print(traceback.format_exc())
-        import ipdb; ipdb.set_trace()
         return None, None, None
@@ -0,0 +1,3 @@
+from emosaic.cli import main
+
+main()
@@ -0,0 +1,503 @@
+import os
+import json
+import hashlib
+import collections
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import cv2
+
+from emosaic.caching import file_stamp
+from emosaic.candidates import cell_vectors, masked_search, cell_means, correct_colors, assign_with_constraints
+from emosaic.utils.image import upscale_window, to_tile
+from emosaic.utils.tiff import StripTiffWriter
+from emosaic.variants import apply_variant, decode_ids, encode_ids, expand_ids
+from emosaic.utils.alpha import composite, TARGET_BACKGROUND
+
+ASSIGNMENT_SUFFIX = '.assignment.npz'
+
+
+def assignment_path_for(savepath):
+    """
+    Where the assignment of a mosaic saved at `savepath` lives, next to it:
+    'out/beach-12.jpg' -> 'out/beach-12.jpg.assignment.npz'
+
+    The extension stays in, so a .jpg & a .tif of the same mosaic each keep their own.
+    """
+    return savepath + ASSIGNMENT_SUFFIX
+
+def codebook_hash(paths, stamps):
+    return hashlib.md5(repr(list(zip(paths, [tuple(s) for s in stamps]))).encode('utf-8')).hexdigest()
+
+def match_codebook_paths(names, paths):
+    """
+    Resolves photos given as full paths or just file names against a codebook.
+
+    @return: tuple (matched paths list, names that matched nothing)
+    """
+    matched, unmatched = [], []
+    for name in names:
+        hits = [p for p in paths if p == name or os.path.basename(p) == os.path.basename(name)]
+        if hits:
+            matched.extend(hits)
+        else:
+            unmatched.append(name)
+    return sorted(set(matched)), unmatched
+
+def load_tile(args):
+    """
+    @args: (path, h, w[, alpha_background]) see emosaic.utils.alpha
+    """
+    path, h, w = args[:3]
+    alpha_background = args[3] if len(args) > 3 else None
+    img = cv2.imread(path, cv2.IMREAD_UNCHANGED if alpha_background is not None else cv2.IMREAD_COLOR)
+    if img is None:
+        raise IOError("Can't read codebook photo '%s'" % path)
+    # cropped like when indexing, for photos of a slightly different aspect ratio
+    return to_tile(img, h, w, alpha_background)
+
+
+class MosaicAssignment(object):
+    """
+    Which codebook photo went into every cell of a mosaic's grid, plus
+    enough about the codebook and settings to rebuild it with no searching:
+
+        assignment = MosaicAssignment.from_candidates(candidates, ids, paths, opacity=0.2)
+        assignment.save(assignment_path_for(savepath))
+
+        # later, a print with tiles 4x as big
+        assignment = MosaicAssignment.load(path)
+        big = assignment.render(tile_h * 4, tile_w * 4)
+
+    `ids` index into `paths` (the codebook in index order) and are in
+    row-major grid order, -1 for cells left empty. `distances` are the
+    match distances, NaN where a tile was picked at random. When flipped &
+    rotated variants were matched too, `slots` says which of
+    `params['variants']` each cell shows (see emosaic.variants).
+    """
+    def __init__(self, grid_shape, ids, distances, paths, stamps, params, slots=None):
+        self.grid_shape = tuple(int(n) for n in grid_shape)
+        self.ids = np.asarray(ids, dtype=np.int32)
+        self.slots = np.zeros(len(self.ids), dtype=np.int8) if slots is None else np.asarray(slots, dtype=np.int8)
+        self.distances = np.asarray(distances, dtype=np.float32)
+        self.paths = list(paths)
+        self.stamps = [tuple(int(v) for v in s) for s in stamps]
+        self.params = params
+
+    @classmethod
+    def from_candidates(cls, candidates, ids, paths, **params):
+        """
+        @param: candidates (TileCandidates) the search the ids were selected from
+        @param: ids (int array) selected codebook id per tile
+        @param: paths (list of Strings) codebook photo paths, in index order
+        @param: params extra settings to record (opacity, best_k, target path, ...)
+        """
+        ids = np.asarray(ids)
+        match = candidates.ids == ids[:, None]
+        found = match.any(axis=1) & (ids >= 0)
+        distances = np.where(found, candidates.distances[np.arange(len(ids)), match.argmax(axis=1)], np.nan)
+
+        params = dict(params)
+        slots = None
+        variants = getattr(candidates, 'variants', None)
+        if variants:
+            ids, slots = decode_ids(ids, len(paths))
+            params.update(variants=list(variants))
+        match_h, match_w = getattr(candidates, 'match_size', None) or (candidates.tile_h, candidates.tile_w)
+        params.update(
+            tile_h=candidates.tile_h,
+            tile_w=candidates.tile_w,
+            match_h=match_h,
+            match_w=match_w,
+            origin=[int(v) for v in candidates.origin],
+            feature=getattr(candidates, 'feature', None),
+            target_shape=[int(v) for v in candidates.target_shape])
+        stamps = [file_stamp(p) for p in paths]
+        return cls(candidates.grid_shape, ids, distances, paths, stamps, params, slots=slots)
+
+    @property
+    def match_size(self):
+        if 'match_h' in self.params:
+            return self.params['match_h'], self.params['match_w']
+        return None
+
+    @property
+    def variants(self):
+        return self.params.get('variants') or ['identity']
+
+    @property
+    def alpha_background(self):
+        background = self.params.get('alpha_background')
+        return tuple(background) if isinstance(background, list) else background
+
+    def tile_for(self, cell, tile):
+        """
+        @return: `tile` (the photo of `cell`) flipped / rotated as the cell shows it
+        """
+        slot = self.slots[cell]
+        return apply_variant(tile, self.variants[slot]) if slot else tile
+
+    def finish_tiles(self, tiles, cells, background=None, means=None, color_correction=0.0):
+        """
+        Composites transparent tiles over the target & color corrects them, all at once.
+
+        @param: tiles (numpy arr) N x h x w x c of the row-major grid `cells`, premultiplied
+                BGRA when the target shows through (see emosaic.utils.alpha)
+        @param: background (numpy arr) N x h x w x 3 target under each tile
+        @param: means (numpy arr) mean color of every cell of the target, see `target_means`
+
+        @return: N x h x w x 3 uint8
+        """
+        if tiles.shape[-1] == 4:
+            if background is None:
+                raise ValueError("Tiles with transparency need the target image to show through")
+            tiles = composite(tiles, background)
+        if means is not None and color_correction > 0:
+            used = self.ids[cells] >= 0
+            tiles[used] = correct_colors(tiles[used], means[cells[used]], color_correction)
+        return tiles
+
+    def target_means(self, target_image):
+        """
+        @return: (rows * cols) x 3 mean color of every cell of the target, what tiles are color corrected to
+        """
+        rows, cols = self.grid_shape
+        x0, y0 = self.params['origin']
+        h, w = self.params['tile_h'], self.params['tile_w']
+        return cell_means(target_image[x0 : x0 + rows * h, y0 : y0 + cols * w], rows, cols, h, w)
+
+    @property
+    def codebook_hash(self):
+        return codebook_hash(self.paths, self.stamps)
+
+    def save(self, savepath):
+        meta = dict(self.params, codebook_hash=self.codebook_hash)
+        with open(savepath, 'wb') as f:
+            np.savez_compressed(
+                f,
+                grid_shape=np.array(self.grid_shape),
+                ids=self.ids,
+                slots=self.slots,
+                distances=self.distances,
+                paths=np.array(self.paths, dtype=str),
+                stamps=np.array(self.stamps, dtype=np.int64).reshape(-1, 2),
+                meta=np.array(json.dumps(meta)))
+        return savepath
+
+    @classmethod
+    def load(cls, savepath):
+        with np.load(savepath) as data:
+            params = json.loads(str(data['meta']))
+            params.pop('codebook_hash', None)
+            return cls(
+                data['grid_shape'], data['ids'], data['distances'],
+                [str(p) for p in data['paths']], data['stamps'], params,
+                slots=data['slots'] if 'slots' in data.files else None)
+
+    def changed_paths(self):
+        """
+        @return: list of codebook photos that are gone or were modified since
+        """
+        changed = []
+        for path, stamp in zip(self.paths, self.stamps):
+            try:
+                if file_stamp(path) != stamp:
+                    changed.append(path)
+            except OSError:
+                changed.append(path)
+        return changed
+
+    def load_tiles(self, tile_h, tile_w, ids=None, nthreads=4):
+        """
+        Loads & resizes just the codebook photos this mosaic (or `ids`) uses.
+
+        @return: tuple (sorted used ids array, (num_used, tile_h, tile_w, 3) uint8 array), 4 channels
+                 (premultiplied BGRA) when the target shows through transparent tiles
+        """
+        ids = self.ids if ids is None else np.asarray(ids)
+        used = np.unique(ids[ids >= 0])
+        pool = ThreadPool(nthreads)
+        try:
+            tiles = pool.map(load_tile, [(self.paths[i], tile_h, tile_w, self.alpha_background) for i in used])
+        finally:
+            pool.close()
+        channels = 4 if self.alpha_background == TARGET_BACKGROUND else 3
+        stack = np.zeros((len(used), tile_h, tile_w, channels), dtype=np.uint8)
+        for i, tile in enumerate(tiles):
+            stack[i] = tile
+        return used, stack
+
+    def excluded_ids(self):
+        excluded = set(self.params.get('excluded', []))
+        return np.array([i for i, path in enumerate(self.paths) if path in excluded], dtype=np.int64)
+
+    def exclude(self, paths, tile_index, target_image):
+        """
+        Never use the codebook photos in `paths` again: every cell showing one
+        gets its best match among the rest of the codebook. Only those cells
+        are searched, with the excluded photos masked out of the index. Mosaics
+        made with `max_uses` or `min_repeat_distance` keep to them, counting
+        the cells that don't change (see assign_with_constraints).
+
+        @param: paths (list of Strings) codebook photos to exclude, as in `self.paths`
+        @param: tile_index (Faiss Index) the codebook index the mosaic was made with
+        @param: target_image (numpy arr) the mosaic's target
+
+        @return: array of the (row-major) grid cells that changed
+        """
+        unknown = set(paths) - set(self.paths)
+        if unknown:
+            raise ValueError("Not in this mosaic's codebook: %s" % ', '.join(sorted(unknown)))
+
+        self.params['excluded'] = sorted(set(self.params.get('excluded', [])) | set(paths))
+        exclude_ids = self.excluded_ids()
+        cells = np.flatnonzero(np.isin(self.ids, exclude_ids))
+        if not len(cells):
+            return cells
+
+        num_images, num_variants = len(self.paths), len(self.variants)
+        queries = cell_vectors(
+            target_image, cells, self.grid_shape, self.params['origin'],
+            self.params['tile_h'], self.params['tile_w'], match_size=self.match_size,
+            feature=self.params.get('feature'))
+        max_uses = self.params.get('max_uses')
+        min_distance = self.params.get('min_repeat_distance') or 0
+        found = np.full(len(cells), -1, dtype=np.int64)
+        found_distances = np.full(len(cells), np.nan)
+
+        if max_uses or min_distance > 1:
+            # the rest of the mosaic stays put & counts against the limits
+            chosen = encode_ids(self.ids, self.slots, num_images)
+            chosen[cells] = -1
+            todo = np.arange(len(cells))
+            k = 8
+            while len(todo):
+                k = min(k, tile_index.ntotal)
+                blocked = set(exclude_ids.tolist())
+                if max_uses:
+                    used = chosen[chosen >= 0] % num_images
+                    blocked.update(np.flatnonzero(np.bincount(used) >= max_uses).tolist())
+                distances, ids = masked_search(
+                    tile_index, queries[todo], expand_ids(sorted(blocked), num_images, num_variants), k=k)
+                chosen, chosen_distances = assign_with_constraints(
+                    ids, distances, self.grid_shape, max_uses=max_uses, min_distance=min_distance,
+                    chosen=chosen, cells=cells[todo], num_images=num_images)
+                found[todo] = chosen[cells[todo]]
+                found_distances[todo] = chosen_distances[cells[todo]]
+                todo = todo[found[todo] < 0]
+                if k >= tile_index.ntotal:
+                    break
+                # deeper for the leftovers
+                k *= 4
+        else:
+            todo = np.arange(len(cells))
+
+        if len(todo):
+            # unconstrained, or impossible to satisfy (e.g. too few images for max_uses): the best match
+            distances, ids = masked_search(
+                tile_index, queries[todo], expand_ids(exclude_ids, num_images, num_variants), k=1)
+            found[todo] = ids[:, 0]
+            found_distances[todo] = distances[:, 0]
+
+        self.ids[cells], self.slots[cells] = decode_ids(found, num_images)
+        self.distances[cells] = np.where(found >= 0, found_distances, np.nan)
+        return cells
+
+    def patch(self, mosaic, cells, target_image=None, opacity=None, nthreads=4, color_correction=None):
+        """
+        Redraws only `cells` of an already rendered mosaic, in place. The tile
+        size is worked out from the image, so this works on re-rendered
+        prints too.
+
+        @param: mosaic (numpy arr) rendered image of this assignment, trimmed
+                unless it was made with trim=False
+        @param: cells (int array) row-major grid cells to redraw, e.g. from `exclude`
+        """
+        rows, cols = self.grid_shape
+        h, w = self.params['tile_h'], self.params['tile_w']
+        if self.params.get('trim', True):
+            x0, y0 = 0, 0
+            tile_h, tile_w = mosaic.shape[0] // rows, mosaic.shape[1] // cols
+        else:
+            (x0, y0), tile_h, tile_w = self.params['origin'], h, w
+
+        if opacity is None:
+            opacity = self.params.get('opacity', 0.0)
+        blend = opacity > 0 and target_image is not None
+        if target_image is not None:
+            ox, oy = self.params['origin']
+            region = target_image[ox : ox + rows * h, oy : oy + cols * w]
+        masked = self.alpha_background == TARGET_BACKGROUND
+        if color_correction is None:
+            color_correction = self.params.get('color_correction', 0.0)
+        means = self.target_means(target_image) if target_image is not None and color_correction > 0 else None
+
+        used, stack = self.load_tiles(tile_h, tile_w, ids=self.ids[cells], nthreads=nthreads)
+        for cell in cells:
+            r, c = cell // cols, cell % cols
+            x, y = x0 + r * tile_h, y0 + c * tile_w
+            tile_id = self.ids[cell]
+            if tile_id >= 0:
+                tile = self.tile_for(cell, stack[np.searchsorted(used, tile_id)])
+            else:
+                tile = np.zeros((tile_h, tile_w, 4 if masked else 3), np.uint8)
+            target = None
+            if target_image is not None:
+                target = upscale_window(region, r * tile_h, c * tile_w, tile_h, tile_w, tile_h / float(h), tile_w / float(w))
+            tile = self.finish_tiles(
+                tile[None], np.array([cell]), None if target is None else target[None], means, color_correction)[0]
+            if blend:
+                tile = cv2.addWeighted(target, opacity, tile, 1 - opacity, 0)
+            mosaic[x : x + tile_h, y : y + tile_w] = tile
+        return mosaic
+
+    def iter_bands(self, tile_h, tile_w, band_rows=1, target_image=None, opacity=None, 
+            tile_images=None, max_cached_tiles=1024, nthreads=4, color_correction=None):
+        """
+        Renders the mosaic `band_rows` rows of tiles at a time, top to bottom,
+        so memory is bounded by one band (plus an LRU of at most
+        `max_cached_tiles` resized photos) however big the output is.
+
+        @param: tile_images (list or array) already resized tiles by codebook id,
+                otherwise photos are loaded from `paths` as needed
+        @param: color_correction (float) defaults to the one the mosaic was made with,
+                needs target_image
+
+        @return: generator of tuples (top pixel row, uint8 band image)
+        """
+        changed = self.changed_paths()
+        if changed:
+            print("Warning: %d codebook photos changed since this mosaic was made, e.g. '%s'" % (
+                len(changed), changed[0]))
+
+        rows, cols = self.grid_shape
+        h, w = self.params['tile_h'], self.params['tile_w']
+        ids = self.ids.reshape(rows, cols)
+
+        if opacity is None:
+            opacity = self.params.get('opacity', 0.0)
+        blend = opacity > 0 and target_image is not None
+        if target_image is not None:
+            x0, y0 = self.params['origin']
+            region = target_image[x0 : x0 + rows * h, y0 : y0 + cols * w]
+        if color_correction is None:
+            color_correction = self.params.get('color_correction', 0.0)
+        means = self.target_means(target_image) if target_image is not None and color_correction > 0 else None
+        alpha_background = self.alpha_background
+        channels = 4 if alpha_background == TARGET_BACKGROUND else 3
+
+        cache = collections.OrderedDict()
+        pool = ThreadPool(nthreads) if tile_images is None else None
+        try:
+            for r0 in range(0, rows, band_rows):
+                band_ids = ids[r0 : r0 + band_rows]
+                n = band_ids.shape[0]
+
+                if tile_images is not None:
+                    lookup = tile_images
+                else:
+                    # load the photos this band needs that aren't cached yet
+                    needed = np.unique(band_ids[band_ids >= 0])
+                    missing = [i for i in needed if i not in cache]
+                    tiles = pool.map(load_tile, [(self.paths[i], tile_h, tile_w, alpha_background) for i in missing])
+                    for i, tile in zip(missing, tiles):
+                        cache[i] = tile
+                    for i in needed:
+                        cache[i] = cache.pop(i)  # mark as recently used
+                    lookup = cache
+
+                band = np.zeros((n * tile_h, cols * tile_w, channels), dtype=np.uint8)
+                grid = band.reshape(n, tile_h, cols, tile_w, channels).swapaxes(1, 2)
+                for r in range(n):
+                    for c in range(cols):
+                        if band_ids[r, c] >= 0:
+                            grid[r, c] = self.tile_for((r0 + r) * cols + c, lookup[band_ids[r, c]])
+
+                target = None
+                if target_image is not None:
+                    target = upscale_window(
+                        region, r0 * tile_h, 0, n * tile_h, cols * tile_w, tile_h / float(h), tile_w / float(w))
+                if channels == 4 or means is not None:
+                    # every tile of the band at once
+                    as_tiles = lambda img: img.reshape(n, tile_h, cols, tile_w, -1).swapaxes(1, 2).reshape(
+                        n * cols, tile_h, tile_w, -1)
+                    finished = self.finish_tiles(
+                        as_tiles(band), np.arange(r0 * cols, (r0 + n) * cols),
+                        None if target is None else as_tiles(target), means, color_correction)
+                    band = finished.reshape(n, cols, tile_h, tile_w, 3).swapaxes(1, 2).reshape(n * tile_h, cols * tile_w, 3)
+
+                if blend:
+                    band = cv2.addWeighted(target, opacity, band, 1 - opacity, 0)
+
+                # never evict what this band just used
+                while len(cache) > max(max_cached_tiles, len(np.unique(band_ids))):
+                    cache.popitem(last=False)
+
+                yield r0 * tile_h, band
+        finally:
+            if pool is not None:
+                pool.close()
+
+    def render(self, tile_h, tile_w, target_image=None, opacity=None, nthreads=4, color_correction=None):
+        """
+        Rebuilds the mosaic at any tile size straight from the codebook photos.
+
+        @param: tile_h, tile_w (int) output tile size
+        @param: target_image (numpy arr) original target, only needed to blend with opacity
+        @param: opacity (float) defaults to the opacity the mosaic was made with
+        @param: color_correction (float) defaults to the one the mosaic was made with
+
+        @return: uint8 mosaic of the tiled area, (rows * tile_h, cols * tile_w, 3)
+        """
+        rows, cols = self.grid_shape
+        mosaic = np.zeros((rows * tile_h, cols * tile_w, 3), dtype=np.uint8)
+        bands = self.iter_bands(
+            tile_h, tile_w, band_rows=rows, target_image=target_image, opacity=opacity,
+            max_cached_tiles=len(self.paths), nthreads=nthreads, color_correction=color_correction)
+        for x, band in bands:
+            mosaic[x : x + band.shape[0]] = band
+        return mosaic
+
+    def write(self, savepath, tile_h, tile_w, band_rows=4, target_image=None, opacity=None, 
+            tile_images=None, max_cached_tiles=1024, nthreads=4, color_correction=None):
+        """
+        Renders straight to disk band by band (see `iter_bands`), so the full
+        image never has to fit in memory. '.tif'/'.tiff' writes a strip TIFF
+        (BigTIFF when needed), '.npy' a raw array that can be memmapped back
+        with np.load(..., mmap_mode='r') and '.dzi' a deep zoom pyramid (see
+        emosaic/deepzoom.py). Anything else is rendered in memory and written
+        with cv2.imwrite().
+
+        @return: tuple (height, width) of the image written
+        """
+        rows, cols = self.grid_shape
+        height, width = rows * tile_h, cols * tile_w
+        ext = os.path.splitext(savepath)[1].lower()
+        if ext == '.dzi':
+            from emosaic.deepzoom import write_deep_zoom
+            return write_deep_zoom(
+                self, savepath, tile_h, tile_w, target_image=target_image, opacity=opacity, 
+                max_cached_tiles=max_cached_tiles, color_correction=color_correction)
+
+        bands = self.iter_bands(
+            tile_h, tile_w, band_rows=band_rows, target_image=target_image, opacity=opacity,
+            tile_images=tile_images, max_cached_tiles=max_cached_tiles, nthreads=nthreads,
+            color_correction=color_correction)
+
+        if ext in ('.tif', '.tiff'):
+            with StripTiffWriter(savepath, height, width) as writer:
+                for _, band in bands:
+                    writer.append(band)
+        elif ext == '.npy':
+            canvas = np.lib.format.open_memmap(savepath, mode='w+', dtype=np.uint8, shape=(height, width, 3))
+            for x, band in bands:
+                canvas[x : x + band.shape[0]] = band
+            canvas.flush()
+            del canvas
+        else:
+            mosaic = np.zeros((height, width, 3), dtype=np.uint8)
+            for x, band in bands:
+                mosaic[x : x + band.shape[0]] = band
+            if not cv2.imwrite(savepath, mosaic):
+                raise IOError("Couldn't write mosaic to '%s'" % savepath)
+        return height, width
@@ -1,5 +1,6 @@
 import os
 import glob
+import hashlib
 import six
 
 if six.PY2:
@@ -10,68 +11,131 @@ else:
 DEFAULT_CACHE_DIR = 'cache'
 DEFAULT_CACHE_PATTERN = '*.pkl'
 
+# embeddings caches are rewritten without stale entries once this share of them is stale
+COMPACT_STALE_FRACTION = 0.25
+
+def file_stamp(path):
+    """
+    @return: tuple (size in bytes, modification time), changes whenever the file does
+    """
+    stat = os.stat(path)
+    return (stat.st_size, int(stat.st_mtime))
+
 class EmbeddingsCacheConfig(object):
+    """
+    Per-file, per-face cache of face detections and embeddings, so adding
+    photos to a library only embeds the new ones.
+
+    # loading
+    cache = EmbeddingsCacheConfig(downsize, face_detect_upsample_multiple, num_embedding_jitters)
+    records = cache.load()  # {path: [face, ...]}
+    missing = cache.missing(paths)
+
+    # saving (appends, so this is cheap to call often)
+    cache.save({path: faces, ...})
+
+    Each face is a dict with 'rect' (left, top, right, bottom), 'keypoints'
+    (N x 2 array) and 'embedding' (128D array), all in the coordinates of
+    the image after resizing by `downsize`. Entries are invalidated when a
+    file's size or modification time changes, and the file is rewritten
+    without them (& without entries superseded by later chunks) when they
+    pass COMPACT_STALE_FRACTION of it.
+    """
     def __init__(self, 
-            paths, 
             downsize, 
             face_detect_upsample_multiple, 
             num_embedding_jitters, 
-            allow_single_face_per_photo,
-            cache_dir=DEFAULT_CACHE_DIR,
-            cache_pattern=DEFAULT_CACHE_PATTERN):
+            cache_dir=DEFAULT_CACHE_DIR):
 
-        self.paths = paths
         self.downsize = downsize
         self.face_detect_upsample_multiple = face_detect_upsample_multiple
         self.num_embedding_jitters = num_embedding_jitters
-        self.allow_single_face_per_photo = allow_single_face_per_photo
-
-        self.paths.sort()
-
         self.cache_dir = cache_dir
-        self.cache_pattern = cache_pattern
+        self.records = None
 
     def _hash(self):
-        paths_tuple = tuple(self.paths)
         hash_tuple = (
-            paths_tuple,
             self.downsize, self.face_detect_upsample_multiple, self.num_embedding_jitters,
-            self.allow_single_face_per_photo
         )
-        return str(hash(hash_tuple))
+        return hashlib.md5(repr(hash_tuple).encode('utf-8')).hexdigest()
 
-    def list_cache_files(self):
-        return glob.glob(os.path.join(self.cache_dir, self.cache_pattern))
+    @property
+    def savepath(self):
+        return os.path.join(self.cache_dir, 'embeddings-%s.pkl' % self._hash())
+
+    file_stamp = staticmethod(file_stamp)
 
     def load(self):
-        hsh = self._hash()
-        cache_files = self.list_cache_files()
-        for cf in cache_files:
-            cache_hsh = os.path.basename(cf).replace('.pkl', '')
-            if hsh == cache_hsh:
-                with open(cf, 'rb') as f:
-                    data = pickle.load(f)
-                return data
-        return None
+        """
+        Reads every appended chunk, later entries overriding earlier ones,
+        and returns {path: faces} for files that haven't changed since.
+        """
+        if self.records is not None:
+            return self.records
 
-    def save(self, embedding_vectors):
-        hsh = self._hash()
-        savepath = os.path.join(self.cache_dir, '%s.pkl' % hsh)
+        stamped = {}
+        num_entries = 0
+        if os.path.exists(self.savepath):
+            with open(self.savepath, 'rb') as f:
+                while True:
+                    try:
+                        chunk = pickle.load(f)
+                    except EOFError:
+                        break
+                    except pickle.UnpicklingError:
+                        # a write was interrupted, keep what we have
+                        break
+                    num_entries += len(chunk)
+                    stamped.update(chunk)
+
+        self.records = {}
+        live = {}
+        for path, (stamp, faces) in stamped.items():
+            try:
+                if self.file_stamp(path) == stamp:
+                    self.records[path] = faces
+                    live[path] = (stamp, faces)
+            except OSError:
+                continue
+
+        if num_entries - len(live) > COMPACT_STALE_FRACTION * num_entries:
+            self.compact(live)
+        return self.records
 
+    def compact(self, live):
+        """
+        Rewrites the cache as one chunk of just the `live` {path: (stamp, faces)}
+        entries, swapped in whole so an interrupted rewrite loses nothing.
+        """
+        tmp_path = self.savepath + '.tmp'
         try:
-            with open(savepath, 'wb') as f:
-                data = dict(
-                    embedding_vectors=embedding_vectors,
-                    paths=self.paths,
-                    downsize=self.downsize, 
-                    face_detect_upsample_multiple=self.face_detect_upsample_multiple, 
-                    num_embedding_jitters=self.num_embedding_jitters, 
-                    allow_single_face_per_photo=self.allow_single_face_per_photo,
-                )
-                pickle.dump(data, f, protocol=2)
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(live, f, protocol=2)
+            os.rename(tmp_path, self.savepath)
             return True
         except Exception:
-            print("Failed to cache index!")
+            print("Failed to compact embeddings cache!")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+
+    def missing(self, paths):
+        records = self.load()
+        return [p for p in paths if p not in records]
+
+    def save(self, path2faces):
+        records = self.load()
+        chunk = {}
+        for path, faces in path2faces.items():
+            chunk[path] = (self.file_stamp(path), faces)
+            records[path] = faces
+
+        try:
+            with open(self.savepath, 'ab') as f:
+                pickle.dump(chunk, f, protocol=2)
+            return True
+        except Exception:
+            print("Failed to cache embeddings!")
             return False
 
 
@@ -96,7 +160,14 @@ class MosaicCacheConfig(object):
             dimensions,
             detect_faces,
             cache_dir=DEFAULT_CACHE_DIR,
-            cache_pattern=DEFAULT_CACHE_PATTERN):
+            cache_pattern=DEFAULT_CACHE_PATTERN,
+            match_size=None,
+            cascade_grid=None,
+            feature=None,
+            storage='float32',
+            variants=None,
+            alpha_background=None,
+            aspect_tolerance=0.0):
         
         # parameters
         self.paths = paths
@@ -106,6 +177,14 @@ class MosaicCacheConfig(object):
         self.index_class = index_class
         self.dimensions = dimensions
         self.detect_faces = detect_faces
+        self.match_size = match_size
+        self.cascade_grid = cascade_grid
+        self.feature = feature
+        self.storage = storage or 'float32'
+        self.variants = tuple(variants or ('identity',))
+        self.alpha_background = alpha_background
+        # photos of other aspect ratios, cropped (see index_images)
+        self.aspect_tolerance = aspect_tolerance or 0.0
         self.index = None
 
         self.paths.sort()
@@ -119,9 +198,23 @@ class MosaicCacheConfig(object):
         hash_tuple = (
             paths_tuple,
             self.height, self.width, self.nchannels,
-            self.detect_faces
+            self.detect_faces, self.dimensions,
         )
-        return str(hash(hash_tuple))
+        if self.cascade_grid:
+            hash_tuple += ('cascade', tuple(self.match_size), tuple(self.cascade_grid))
+        if self.feature and self.feature != 'raw':
+            # every feature extractor gets its own cache entry
+            hash_tuple += ('feature', self.feature)
+        if self.storage != 'float32':
+            hash_tuple += ('storage', self.storage)
+        if len(self.variants) > 1:
+            hash_tuple += ('variants', self.variants)
+        if self.alpha_background is not None:
+            hash_tuple += ('alpha', self.alpha_background)
+        if self.aspect_tolerance:
+            hash_tuple += ('aspect_tolerance', self.aspect_tolerance)
+        # hash() of strings changes every process, so md5 keeps the cache valid across runs
+        return hashlib.md5(repr(hash_tuple).encode('utf-8')).hexdigest()
 
     def list_cache_files(self):
         return glob.glob(os.path.join(self.cache_dir, self.cache_pattern))
@@ -136,22 +229,46 @@ class MosaicCacheConfig(object):
                     data = pickle.load(f)
 
                 # recreate Swig index since we can't pickle it directly
-                self.index = data['index_class'](data['dimensions'])
-                self.index.add(data['matrix'])
+                storage = data.get('storage', 'float32')
+                variants = data.get('variants', ('identity',))
+                match_h, match_w = self.match_size or (self.height, self.width)
+                if data.get('alpha_background') == 'target':
+                    from emosaic.utils.alpha import AlphaMaskedIndex
+                    self.index = AlphaMaskedIndex(data['matrix'], self.nchannels)
+                elif data.get('coarse_matrix') is not None:
+                    from emosaic.utils.cascade import build_cascade_index
+                    from emosaic.variants import augment_matrix
+                    matrix = data['matrix']
+                    if len(variants) > 1:
+                        matrix = augment_matrix(matrix, variants, match_h, match_w, self.nchannels)
+                    self.index = build_cascade_index(
+                        matrix, self.match_size, self.nchannels, self.cascade_grid,
+                        coarse_class=data['index_class'], coarse_matrix=data['coarse_matrix'],
+                        storage=storage)
+                else:
+                    from emosaic.utils.storage import build_storage_index
+                    from emosaic.variants import add_variant_vectors
+                    self.index = build_storage_index(data['matrix'], storage, index_class=data['index_class'])
+                    add_variant_vectors(self.index, data['matrix'], variants, match_h, match_w, self.nchannels)
                 data['index'] = self.index
                 return data
         return None
 
-    def save(self, matrix, images, tile_images):
+    def save(self, matrix, images, tile_images, coarse_matrix=None):
         """
         Fields to save:
 
         - 'index_class' (eg: faiss.IndexFlatL2)
         - 'dimensions' (for Faiss index)
         - 'images': Image objects list
-        - 'tile_images': resized list of images as numpy arrays
+        - 'tile_images': resized images, one (N, height, width, channels) array
         - 'paths': list of filepaths for images
-        - 'matrix'
+        - 'matrix': codebook vectors, uint8 or float16 with compact storage
+        - 'storage': 'float32', 'float16' or 'uint8'
+        - 'variants': flips & rotations added to the index from 'matrix' when loading
+        - 'alpha_background': None, 'target' (then 'matrix' & 'tile_images' are premultiplied BGRA) or (b, g, r)
+        - 'aspect_tolerance': photos of aspect ratios this close were cropped & included
+        - 'coarse_matrix': mean color grid vectors of a cascade index, or None
         - 'height', 'width', 'nchannels'
 
         The following MUST be in the same order:
@@ -171,6 +288,11 @@ class MosaicCacheConfig(object):
                     tile_images=tile_images,
                     paths=self.paths,
                     matrix=matrix,
+                    coarse_matrix=coarse_matrix,
+                    storage=self.storage,
+                    variants=self.variants,
+                    alpha_background=self.alpha_background,
+                    aspect_tolerance=self.aspect_tolerance,
                     height=self.height, 
                     width=self.width,
                     nchannels=self.nchannels,
@@ -180,3 +302,99 @@ class MosaicCacheConfig(object):
         except Exception:
             print("Failed to cache index!")
             return False
+
+
+
+class CandidatesCacheConfig(object):
+    """
+    Caches the per-tile top-k search results (TileCandidates) for one target
+    against one codebook, so changing only opacity, randomness or best_k
+    skips the search.
+
+    # loading
+    cache = CandidatesCacheConfig(target_path, codebook_paths, height, width, k, detect_faces, match_size)
+    candidates = cache.load()  # None on a miss
+
+    # saving
+    cache.save(candidates)
+
+    The target and every codebook file are keyed by path, size and
+    modification time.
+    """
+    def __init__(self,
+            target_path,
+            codebook_paths,
+            height,
+            width,
+            k,
+            detect_faces,
+            match_size=None,
+            cache_dir=DEFAULT_CACHE_DIR,
+            cascade=None,
+            feature=None,
+            storage='float32',
+            variants=None,
+            alpha_background=None,
+            aspect_tolerance=0.0):
+
+        self.target_path = target_path
+        self.codebook_paths = sorted(codebook_paths)
+        self.height = height
+        self.width = width
+        self.k = k
+        self.detect_faces = detect_faces
+        self.match_size = tuple(match_size or (height, width))
+        self.cache_dir = cache_dir
+        # (grid, factor) of a cascade index, whose results can differ slightly
+        self.cascade = cascade
+        self.feature = feature
+        # float16 distances can differ slightly
+        self.storage = storage or 'float32'
+        self.variants = tuple(variants or ('identity',))
+        self.alpha_background = alpha_background
+        # photos of other aspect ratios, cropped (see index_images)
+        self.aspect_tolerance = aspect_tolerance or 0.0
+        # stats every codebook file, so only once
+        self.key = self._hash()
+
+    def _hash(self):
+        hash_tuple = (
+            self.target_path, file_stamp(self.target_path),
+            tuple((p, file_stamp(p)) for p in self.codebook_paths),
+            self.height, self.width, self.k, self.detect_faces, self.match_size,
+        )
+        if self.cascade:
+            hash_tuple += ('cascade', repr(self.cascade))
+        if self.feature and self.feature != 'raw':
+            hash_tuple += ('feature', self.feature)
+        if self.storage != 'float32':
+            hash_tuple += ('storage', self.storage)
+        if len(self.variants) > 1:
+            hash_tuple += ('variants', self.variants)
+        if self.alpha_background is not None:
+            hash_tuple += ('alpha', self.alpha_background)
+        if self.aspect_tolerance:
+            hash_tuple += ('aspect_tolerance', self.aspect_tolerance)
+        return hashlib.md5(repr(hash_tuple).encode('utf-8')).hexdigest()
+
+    @property
+    def savepath(self):
+        return os.path.join(self.cache_dir, 'candidates-%s.pkl' % self.key)
+
+    def load(self):
+        if not os.path.exists(self.savepath):
+            return None
+        try:
+            with open(self.savepath, 'rb') as f:
+                return pickle.load(f)
+        except Exception:
+            return None
+
+    def save(self, candidates):
+        try:
+            with open(self.savepath, 'wb') as f:
+                pickle.dump(candidates, f, protocol=2)
+            return True
+        except Exception:
+            print("Failed to cache tile candidates!")
+            return False
@@ -0,0 +1,463 @@
+import numpy as np
+import cv2
+
+from emosaic.utils.image import divide_image_rectangularly, to_vector, upscale_window
+from emosaic.features import get_feature_extractor
+from emosaic.variants import parse_variants, expand_ids, variant_tiles
+from emosaic.utils.alpha import AlphaMaskedIndex, composite
+
+
+def grid_vectors(target_image, tile_h, tile_w, match_size=None, feature=None):
+    """
+    Slices the target into its tile grid (same layout as
+    `divide_image_rectangularly`) and flattens every tile, all at once.
+
+    @param: match_size (tuple of ints) (height, width) to shrink each tile to first,
+            the size the tile index was vectorized at
+    @param: feature (String) what the tile index compares, see emosaic.features, defaults to raw pixels
+
+    @return: tuple (N x dimensions float32 matrix, (rows, cols), (x0, y0))
+    """
+    rect_starts = divide_image_rectangularly(target_image, h_pixels=tile_h, w_pixels=tile_w)
+    (x0, y0), (x1, y1) = rect_starts[0], rect_starts[-1]
+    rows, cols = (x1 - x0) // tile_h + 1, (y1 - y0) // tile_w + 1
+    c = target_image.shape[2]
+    match_h, match_w = match_size or (tile_h, tile_w)
+
+    region = target_image[x0 : x0 + rows * tile_h, y0 : y0 + cols * tile_w]
+    if (match_h, match_w) != (tile_h, tile_w):
+        # one area-averaging resize of the whole grid shrinks every tile at once
+        region = cv2.resize(region, (cols * match_w, rows * match_h), interpolation=cv2.INTER_AREA)
+    tiles = region.reshape(rows, match_h, cols, match_w, c).swapaxes(1, 2)
+    matrix = tiles.reshape(rows * cols, match_h * match_w * c).astype(np.float32)
+    if feature is not None:
+        matrix = get_feature_extractor(feature).vectors(matrix, match_h, match_w, c)
+    return matrix, (rows, cols), (x0, y0)
+
+
+def cell_vectors(target_image, cells, grid_shape, origin, tile_h, tile_w, match_size=None, feature=None):
+    """
+    Like `grid_vectors`, but only for some cells (row-major grid indices).
+    """
+    rows, cols = grid_shape
+    x0, y0 = origin
+    match_h, match_w = match_size or (tile_h, tile_w)
+    matrix = np.empty((len(cells), match_h * match_w * target_image.shape[2]), dtype=np.float32)
+    for i, cell in enumerate(cells):
+        x, y = x0 + (cell // cols) * tile_h, y0 + (cell % cols) * tile_w
+        matrix[i] = to_vector(target_image[x : x + tile_h, y : y + tile_w], match_h, match_w, target_image.shape[2])
+    if feature is not None:
+        matrix = get_feature_extractor(feature).vectors(matrix, match_h, match_w, target_image.shape[2])
+    return matrix
+
+def masked_search(tile_index, queries, exclude=None, k=1):
+    """
+    Searches `tile_index` as if the codebook ids in `exclude` weren't in it.
+
+    @return: tuple (distances, ids), each len(queries) x k, ids -1 where nothing's left
+    """
+    if exclude is None or not len(exclude):
+        return tile_index.search(queries, k)
+    if isinstance(tile_index, AlphaMaskedIndex):
+        return tile_index.search(queries, k, exclude=exclude)
+
+    import faiss
+    exclude = np.unique(np.asarray(list(exclude), dtype=np.int64))
+    try:
+        selector = faiss.IDSelectorNot(faiss.IDSelectorBatch(exclude))
+        params = faiss.SearchParameters(sel=selector)
+        if isinstance(tile_index, faiss.IndexRefine):
+            # cascade index (see build_cascade_index), the selector goes to the shortlisting
+            params = faiss.IndexRefineSearchParameters(k_factor=tile_index.k_factor, base_index_params=params)
+        return tile_index.search(queries, k, params=params)
+    except (AttributeError, TypeError, RuntimeError):
+        # older faiss without search-time selectors, over-fetch & filter
+        fetch = min(k + len(exclude), tile_index.ntotal)
+        distances, ids = tile_index.search(queries, fetch)
+        keep = ~np.isin(ids, exclude) & (ids >= 0)
+        order = np.argsort(~keep, axis=1, kind='stable')[:, :k]
+        ids = np.where(np.take_along_axis(keep, order, axis=1), np.take_along_axis(ids, order, axis=1), -1)
+        return np.take_along_axis(distances, order, axis=1), ids
+
+
+def cell_means(region, rows, cols, tile_h, tile_w):
+    """
+    @return: (rows * cols) x c float32 mean color of every grid cell of `region`, row-major
+    """
+    c = region.shape[2]
+    cells = region[: rows * tile_h, : cols * tile_w].reshape(rows, tile_h, cols, tile_w, c)
+    return cells.mean(axis=(1, 3), dtype=np.float32).reshape(rows * cols, c)
+
+def correct_colors(tiles, target_means, strength=1.0):
+    """
+    Shifts every channel of every tile so its mean moves `strength` of the
+    way to the mean of its target cell. That offset is the one that
+    minimizes the L2 distance between them, what 'centered' matching leaves out.
+
+    @param: tiles (numpy arr) N x h x w x c uint8
+    @param: target_means (numpy arr) N x c
+
+    @return: N x h x w x c uint8, clipped
+    """
+    offsets = strength * (np.asarray(target_means, dtype=np.float32) - tiles.mean(axis=(1, 2), dtype=np.float32))
+    offsets = np.rint(offsets).astype(np.int16)[:, None, None, :]
+    return np.clip(tiles.astype(np.int16) + offsets, 0, 255).astype(np.uint8)
+
+def assign_with_constraints(ids, distances, grid_shape, max_uses=None, min_distance=0, chosen=None, cells=None,
+        num_images=None):
+    """
+    Greedy by regret: cells that lose the most if they don't get their
+    best match (biggest gap to their second best) choose first, each taking
+    its best candidate that's still allowed.
+
+    @param: ids, distances (len(cells) x k arrays) candidates per cell, best first, ids -1 for none
+    @param: grid_shape (tuple of ints) (rows, cols) of the tile grid
+    @param: max_uses (int) times each codebook image may be used at most
+    @param: min_distance (int) repeats of an image must be at least this many tiles apart
+            (rows or columns), 0 or 1 allows neighbours
+    @param: chosen (int array) one id per grid cell, cells already >= 0 are kept & count as uses
+    @param: cells (int array) row-major grid cells the candidates are for, defaults to all of them
+    @param: num_images (int) codebook size when ids encode variants (see emosaic.variants),
+            so every variant of an image counts as that image
+
+    @return: tuple (chosen ids, their distances), one per grid cell, -1 / inf where nothing fit
+    """
+    rows, cols = grid_shape
+    if cells is None:
+        cells = np.arange(rows * cols)
+    if chosen is None:
+        chosen = np.full(rows * cols, -1, dtype=np.int64)
+    chosen_distances = np.full(rows * cols, np.inf)
+    owner = chosen.reshape(rows, cols)
+    radius = max(0, min_distance - 1)
+
+    # what counts as the same image
+    image_of = (lambda a: np.where(a >= 0, a % num_images, -1)) if num_images else (lambda a: a)
+
+    num_ids = max(ids.max(), chosen.max(), 0) + 1
+    uses = np.bincount(image_of(chosen[chosen >= 0]), minlength=num_ids)
+
+    if ids.shape[1] > 1:
+        regret = np.where(ids[:, 1] >= 0, distances[:, 1] - distances[:, 0], np.inf)
+    else:
+        regret = np.zeros(len(cells))
+
+    for i in np.argsort(-regret, kind='stable'):
+        cell = cells[i]
+        if chosen[cell] >= 0:
+            continue
+        candidates = ids[i]
+        images = image_of(candidates)
+        allowed = candidates >= 0
+        if max_uses:
+            allowed &= uses[np.maximum(images, 0)] < max_uses
+        if radius:
+            r, c = divmod(cell, cols)
+            window = owner[max(0, r - radius) : r + radius + 1, max(0, c - radius) : c + radius + 1].ravel()
+            allowed &= ~(images[:, None] == image_of(window[window >= 0])[None, :]).any(axis=1)
+
+        j = allowed.argmax()
+        if allowed[j]:
+            chosen[cell] = candidates[j]
+            chosen_distances[cell] = distances[i, j]
+            uses[images[j]] += 1
+
+    return chosen, chosen_distances
+
+
+class TileCandidates(object):
+    """
+    The top-k codebook matches (ids & distances) for every tile of a target.
+    Searching is the expensive part of making a mosaic, so keep these around
+    and redo only the cheap, vectorized selection & blending:
+
+        candidates = TileCandidates.search(target_image, h, w, tile_index, k=8)
+        ids = candidates.select(best_k=3, randomness=0.1, seed=0)
+        mosaic = candidates.render(tile_images, ids, target_image, opacity=0.2)
+
+    Tiles are in row-major grid order, like `rect_starts` from `mosaicify`.
+    With `variants` the ids encode flipped & rotated photos (see
+    emosaic.variants), while `exclude` & `num_images` still mean photos.
+    """
+    def __init__(self, ids, distances, grid_shape, origin, tile_h, tile_w, target_shape, match_size=None, feature=None,
+            variants=None, num_images=None):
+        self.ids = ids
+        self.distances = distances
+        self.grid_shape = grid_shape
+        self.origin = origin
+        self.tile_h = tile_h
+        self.tile_w = tile_w
+        self.target_shape = target_shape
+        self.match_size = match_size
+        self.feature = feature
+        self.variants = variants
+        self.num_images = num_images
+
+    @classmethod
+    def search(cls, target_image, tile_h, tile_w, tile_index, k=8, match_size=None, integral=None, feature=None,
+            variants=None):
+        """
+        @param: tile_h, tile_w (int) size of the grid cells in the target
+        @param: tile_index (Faiss Index) codebook index, vectorized at `match_size`
+        @param: k (int) number of candidates to keep per tile
+        @param: match_size (tuple of ints) (height, width) the index was vectorized at,
+                defaults to (tile_h, tile_w)
+        @param: integral (TargetIntegral) of target_image, to vectorize from when searching many scales
+        @param: feature (String) the tile index was built with, see emosaic.features
+        @param: variants (String or list) the tile index was built with, see index_images
+        """
+        variants = parse_variants(variants)
+        if integral is not None:
+            matrix, grid_shape, origin = integral.grid_vectors(tile_h, tile_w, match_size=match_size, feature=feature)
+        else:
+            matrix, grid_shape, origin = grid_vectors(target_image, tile_h, tile_w, match_size=match_size, feature=feature)
+        k = min(k, tile_index.ntotal)
+        distances, ids = tile_index.search(matrix, k)
+        return cls(
+            ids.astype(np.int32), distances.astype(np.float32),
+            grid_shape, origin, tile_h, tile_w, target_image.shape, match_size=match_size, feature=feature,
+            variants=variants if len(variants) > 1 else None,
+            num_images=tile_index.ntotal // len(variants))
+
+    def _encoded(self, images):
+        """
+        @return: every index id of the codebook `images`, variants included
+        """
+        if images is None or not len(images):
+            return images
+        variants = self.variants
+        if not variants:
+            return images
+        return expand_ids(images, self.num_images, len(variants))
+
+    def _num_images_if_variants(self):
+        return self.num_images if self.variants else None
+
+    def fill_excluded(self, ids, tile_index, target_image, exclude):
+        """
+        Cells whose candidates were all excluded (-1 from `select`) get their
+        best match among the rest of the codebook, searching just those cells.
+        """
+        cells = np.flatnonzero(ids < 0)
+        if len(cells):
+            queries = cell_vectors(
+                target_image, cells, self.grid_shape, self.origin, self.tile_h, self.tile_w,
+                match_size=self.match_size, feature=self.feature)
+            _, found = masked_search(tile_index, queries, self._encoded(exclude), k=1)
+            ids[cells] = found[:, 0]
+        return ids
+
+    @property
+    def num_tiles(self):
+        return self.ids.shape[0]
+
+    @property
+    def k(self):
+        return self.ids.shape[1]
+
+    @property
+    def rect_starts(self):
+        rows, cols = self.grid_shape
+        x0, y0 = self.origin
+        return [(x0 + i * self.tile_h, y0 + j * self.tile_w) for i in range(rows) for j in range(cols)]
+
+    def _valid_sorted(self, exclude):
+        """
+        Candidates reordered so the usable ones (found by the index & not
+        excluded) come first, best to worst.
+        """
+        valid = self.ids >= 0
+        exclude = self._encoded(exclude)
+        if exclude is not None and len(exclude):
+            valid &= ~np.isin(self.ids, np.asarray(list(exclude)))
+        if valid.all():
+            # nothing to move, the usual case
+            return self.ids, self.distances, valid
+        order = np.argsort(~valid, axis=1, kind='stable')
+        return (
+            np.take_along_axis(self.ids, order, axis=1),
+            np.take_along_axis(self.distances, order, axis=1),
+            np.take_along_axis(valid, order, axis=1))
+
+    def select(self, best_k=1, uniform_k=True, randomness=0.0, exclude=None, num_images=None, seed=None):
+        """
+        Picks one codebook id per tile, same rules as `mosaicify`:
+
+        @param: best_k (int) choose among the top best_k candidates
+        @param: uniform_k (bool) choose uniformly among them, otherwise weight by
+                how much closer each is than the (best_k + 1)th candidate
+        @param: randomness (float) probability a tile gets a random codebook image instead,
+                random picks don't repeat until the codebook runs out
+        @param: exclude (iterable of ints) codebook ids never to use
+        @param: num_images (int) codebook size, required for randomness
+        @param: seed (int) for reproducible selections
+
+        @return: int array of N codebook ids, -1 where every candidate was excluded
+        """
+        rng = np.random.RandomState(seed)
+        ids, distances, valid = self._valid_sorted(exclude)
+        num_valid = valid.sum(axis=1)
+
+        if best_k <= 1:
+            pick = np.zeros(self.num_tiles, dtype=np.int64)
+        elif uniform_k:
+            counts = np.minimum(num_valid, best_k)
+            pick = (rng.rand(self.num_tiles) * counts).astype(np.int64)
+        else:
+            n = min(best_k + 1, self.k)
+            d = distances[:, :n]
+            v = valid[:, :n]
+            worst = np.where(v, d, -np.inf).max(axis=1, keepdims=True)
+            weights = np.where(v, worst - d, 0.)
+
+            # all usable candidates equally good (or just one), choose uniformly
+            flat = weights.sum(axis=1) <= 0
+            weights[flat] = v[flat]
+
+            cdf = np.cumsum(weights, axis=1)
+            totals = np.maximum(cdf[:, -1:], 1e-12)
+            pick = (cdf / totals < rng.rand(self.num_tiles, 1)).sum(axis=1)
+            pick = np.minimum(pick, np.maximum(num_valid - 1, 0))
+
+        chosen = ids[np.arange(self.num_tiles), pick].astype(np.int32)
+        chosen[num_valid == 0] = -1
+
+        if randomness > 0:
+            if num_images is None:
+                raise ValueError("num_images is required to pick random tiles")
+            is_random = rng.rand(self.num_tiles) < randomness
+            allowed = np.arange(num_images)
+            if exclude is not None and len(exclude):
+                allowed = np.setdiff1d(allowed, np.asarray(list(exclude)))
+            num_random = int(is_random.sum())
+            if num_random and len(allowed):
+                # without replacement, starting over once every image was used
+                repeats = int(np.ceil(num_random / float(len(allowed))))
+                draws = np.concatenate([rng.permutation(allowed) for _ in range(repeats)])
+                chosen[is_random] = draws[:num_random]
+
+        return chosen
+
+    def select_constrained(self, max_uses=None, min_distance=0, exclude=None, tile_index=None, target_image=None):
+        """
+        Picks one codebook id per tile so no image is used more than
+        `max_uses` times, nor repeated within `min_distance` tiles, staying as
+        close as possible to the best matches (see assign_with_constraints).
+
+        Tiles whose top k candidates are all used up are searched again,
+        deeper and without the used up images, when `tile_index` & `target_image`
+        are given. Any still left over get their best match regardless.
+
+        @return: tuple (int array of N codebook ids, dict report with the total distance 'cost',
+                 the unconstrained 'optimum', relative 'gap' between them, 'changed' tiles that
+                 didn't get their best match, 'relaxed' tiles that broke the constraints & 'seconds')
+        """
+        import time
+
+        start = time.time()
+        ids, distances, valid = self._valid_sorted(exclude)
+        ids = np.where(valid, ids, -1)
+        num_images = self._num_images_if_variants()
+        chosen, chosen_distances = assign_with_constraints(
+            ids, distances, self.grid_shape, max_uses=max_uses, min_distance=min_distance, num_images=num_images)
+
+        k = self.k
+        while tile_index is not None and (chosen < 0).any() and k < tile_index.ntotal:
+            # deeper candidate lists for the leftovers, without the images nobody can use anymore
+            k = min(k * 4, tile_index.ntotal)
+            cells = np.flatnonzero(chosen < 0)
+            blocked = set([] if exclude is None else exclude)
+            if max_uses:
+                used = chosen[chosen >= 0] % num_images if num_images else chosen[chosen >= 0]
+                blocked.update(np.flatnonzero(np.bincount(used) >= max_uses).tolist())
+            queries = cell_vectors(
+                target_image, cells, self.grid_shape, self.origin, self.tile_h, self.tile_w,
+                match_size=self.match_size, feature=self.feature)
+            more_distances, more_ids = masked_search(tile_index, queries, self._encoded(sorted(blocked)), k=k)
+            deeper, deeper_distances = assign_with_constraints(
+                more_ids, more_distances, self.grid_shape,
+                max_uses=max_uses, min_distance=min_distance, chosen=chosen, cells=cells, num_images=num_images)
+            chosen_distances[cells] = deeper_distances[cells]
+
+        # impossible to satisfy (e.g. too few images for max_uses), fall back to the best match
+        relaxed = np.flatnonzero((chosen < 0) & valid[:, 0])
+        chosen[relaxed] = ids[relaxed, 0]
+        chosen_distances[relaxed] = distances[relaxed, 0]
+
+        scored = (chosen >= 0) & valid[:, 0]
+        cost = float(chosen_distances[scored].sum())
+        optimum = float(distances[scored, 0].astype(np.float64).sum())
+        report = dict(
+            cost=cost,
+            optimum=optimum,
+            gap=cost / optimum - 1 if optimum > 0 else 0.0,
+            changed=int((chosen[scored] != ids[scored, 0]).sum()),
+            relaxed=len(relaxed),
+            seconds=time.time() - start)
+        return chosen.astype(np.int32), report
+
+    def render(self, tile_images, ids, target_image=None, opacity=0.0, trim=True, color_correction=0.0):
+        """
+        Pastes the chosen tiles into a mosaic.
+
+        @param: tile_images (array or list of images) codebook tiles, all the same size, best as
+                one (N, h, w, c) array like index_images returns, which isn't copied. Tiles
+                bigger than the grid cells make a bigger, sharper mosaic. Premultiplied BGRA
+                tiles (see emosaic.utils.alpha) are composited over the target.
+        @param: ids (int array) one codebook id per tile, from `select`, flipped & rotated
+                from the tile images when they encode variants
+        @param: target_image (numpy arr) needed when blending with opacity > 0 or color correcting
+        @param: opacity (float) weight of the original target blended over the mosaic
+        @param: trim (bool) crop to the tiled area, only supported when tiles are the grid cell size
+        @param: color_correction (float) how far to shift each tile's mean color to its cell's,
+                0 to 1 (see correct_colors)
+
+        @return: uint8 mosaic image
+        """
+        rows, cols = self.grid_shape
+        x0, y0 = self.origin
+
+        if self.variants:
+            tiles = variant_tiles(tile_images, ids, self.variants)
+        else:
+            stack = np.asarray(tile_images)
+            tiles = stack[np.maximum(ids, 0)]
+            tiles[ids < 0] = 0
+        h, w = tiles.shape[1:3]
+        if tiles.shape[-1] == 4:
+            # transparent tiles, the target shows through
+            if target_image is None:
+                raise ValueError("Tiles with transparency need the target image to show through")
+            background = target_image[x0 : x0 + rows * self.tile_h, y0 : y0 + cols * self.tile_w]
+            if (h, w) != (self.tile_h, self.tile_w):
+                background = upscale_window(
+                    background, 0, 0, rows * h, cols * w, h / float(self.tile_h), w / float(self.tile_w))
+            background = background.reshape(rows, h, cols, w, -1).swapaxes(1, 2).reshape(rows * cols, h, w, -1)
+            tiles = composite(tiles, background)
+        if color_correction > 0:
+            if target_image is None:
+                raise ValueError("Color correction needs the target image")
+            region = target_image[x0 : x0 + rows * self.tile_h, y0 : y0 + cols * self.tile_w]
+            used = ids >= 0
+            tiles[used] = correct_colors(
+                tiles[used], cell_means(region, rows, cols, self.tile_h, self.tile_w)[used], color_correction)
+        grid = tiles.reshape(rows, cols, h, w, -1).swapaxes(1, 2).reshape(rows * h, cols * w, -1)
+        region = None
+        if opacity > 0:
+            region = target_image[x0 : x0 + rows * self.tile_h, y0 : y0 + cols * self.tile_w]
+
+        if trim:
+            mosaic = grid.astype(np.uint8)
+            if region is not None:
+                if (h, w) != (self.tile_h, self.tile_w):
+                    region = upscale_window(region, 0, 0, rows * h, cols * w, h / float(self.tile_h), w / float(self.tile_w))
+                mosaic = cv2.addWeighted(region, opacity, mosaic, 1 - opacity, 0)
+            return mosaic
+
+        if (h, w) != (self.tile_h, self.tile_w):
+            raise ValueError("Untrimmed mosaics need tiles the size of the grid cells")
+        mosaic = np.zeros(self.target_shape, dtype=np.uint8)
+        mosaic[x0 : x0 + rows * h, y0 : y0 + cols * w] = grid
+        if opacity > 0:
+            mosaic = cv2.addWeighted(target_image, opacity, mosaic, 1 - opacity, 0)
+        return mosaic
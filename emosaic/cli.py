@@ -0,0 +1,66 @@
+import argparse
+import sys
+
+from emosaic.commands import mosaic, video, gif, montage, index, render, exclude, adaptive
+from emosaic.utils.misc import ImportTimer
+
+"""
+One entry point for every subsystem:
+
+    $ python -m emosaic mosaic \
+        --target "media/example/beach.jpg" \
+        --savepath "media/output/%s-mosaic-scale-%d.jpg" \
+        --codebook-dir media/pics/ \
+        --scale 12
+
+    $ python -m emosaic --import-report index --codebook-dir media/pics/ --scale 8
+
+    $ python -m emosaic render \
+        --assignment "media/output/beach-mosaic-scale-12.jpg.assignment.npz" \
+        --savepath "media/output/beach-print.jpg" \
+        --scale 60
+
+Heavy dependencies are only imported by the subcommand that runs, and
+`--import-report` prints how long each of them took to import.
+"""
+
+COMMANDS = {
+    'mosaic': mosaic,
+    'video': video,
+    'gif': gif,
+    'montage': montage,
+    'index': index,
+    'render': render,
+    'exclude': exclude,
+    'adaptive': adaptive,
+}
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='emosaic')
+    parser.add_argument("--import-report", dest='import_report', action='store_true', default=False, 
+        help="Print how long each package took to import")
+    subparsers = parser.add_subparsers(dest='command')
+    for name in sorted(COMMANDS):
+        command = COMMANDS[name]
+        subparser = subparsers.add_parser(name, help=command.HELP, description=command.HELP)
+        command.add_arguments(subparser)
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        sys.exit(2)
+
+    command = COMMANDS[args.command]
+    if not args.import_report:
+        return command.run(args)
+
+    with ImportTimer() as timer:
+        try:
+            return command.run(args)
+        finally:
+            timer.report()
@@ -0,0 +1,7 @@
+"""
+Subcommands of the `emosaic` command line (see emosaic/cli.py).
+
+Each module exposes `HELP`, `add_arguments(parser)` and `run(args)`, and
+only imports its heavy dependencies (faiss, dlib, moviepy, ...) inside
+`run()`, so that starting one subsystem never pays for the others.
+"""
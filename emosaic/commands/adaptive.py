@@ -0,0 +1,93 @@
+import os
+
+HELP = "Create a mosaic with big tiles in flat areas and small ones where the target has detail"
+
+
+def add_arguments(parser):
+    # required
+    parser.add_argument("--codebook-dir", dest='codebook_dir', type=str, required=True, help="Source folder of images")
+    parser.add_argument("--savepath", dest='savepath', type=str, required=True, help="Where to save image to. Scale/filename is used in formatting.")
+    parser.add_argument("--target", dest='target', type=str, required=True, help="Image to make mosaic from")
+    parser.add_argument("--scale", dest='scale', type=int, required=True, help="How large to make the smallest tiles")
+
+    # optional
+    parser.add_argument("--levels", dest='levels', type=int, default=3,
+        help="Number of tile sizes, each twice as big as the next")
+    parser.add_argument("--variance-threshold", dest='variance_threshold', type=float, default=300.,
+        help="Grayscale variance above which a tile is split in four, lower means more small tiles")
+    parser.add_argument("--split-faces", dest='split_faces', action='store_true', default=False,
+        help="Always use the smallest tiles on faces in the target (needs dlib)")
+    parser.add_argument("--opacity", dest='opacity', type=float, default=0.0, help="Opacity of the original photo")
+    parser.add_argument("--height-aspect", dest='height_aspect', type=float, default=4.0, help="Height aspect")
+    parser.add_argument("--width-aspect", dest='width_aspect', type=float, default=3.0, help="Width aspect")
+    parser.add_argument("--vectorization-factor", dest='vectorization_factor', type=float, default=1.,
+        help="Downsize each tile size by this much before vectorizing")
+    parser.add_argument("--detect-faces", dest='detect_faces', action='store_true', default=False, help="If we should only include pictures with faces in them")
+
+
+def face_rects(target_image):
+    from emosaic.faces import detect_faces_dlib
+
+    faces, _ = detect_faces_dlib(target_image)
+    return [
+        (int(f.x * f.upsize), int(f.y * f.upsize), int((f.x + f.w) * f.upsize), int((f.y + f.h) * f.upsize))
+        for f in faces]
+
+
+def run(args):
+    import glob
+    import time
+
+    import cv2
+
+    from emosaic.utils.indexing import index_images_at_sizes
+    from emosaic.utils.image import compute_hw, compute_match_size
+    from emosaic.quadtree import quadtree_cells, quadtree_mosaicify, level_tile_size
+
+    print("=== Creating Adaptive Mosaic Image ===")
+    print("Images=%s, target=%s, scale=%d, levels=%d, variance_threshold=%.1f" % (
+        args.codebook_dir, args.target, args.scale, args.levels, args.variance_threshold))
+
+    tile_h, tile_w = compute_hw(args.scale, args.height_aspect, args.width_aspect)
+    aspect_ratio = tile_h / float(tile_w)
+    target_image = cv2.imread(args.target)
+
+    detail_rects = face_rects(target_image) if args.split_faces else None
+    if detail_rects is not None:
+        print("Found %d faces in the target" % len(detail_rects))
+
+    start = time.time()
+    origin, cells = quadtree_cells(
+        target_image, tile_h, tile_w,
+        levels=args.levels,
+        variance_threshold=args.variance_threshold,
+        detail_rects=detail_rects)
+
+    # one codebook index per tile size, only for the sizes actually used, from one decode of each photo
+    paths = glob.glob('%s/*.jpg' % args.codebook_dir)
+    levels = sorted(set(cells[:, 2].tolist()))
+    sizes = [level_tile_size(tile_h, tile_w, args.levels, level) for level in levels]
+    match_sizes = [compute_match_size(h, w, args.vectorization_factor) for h, w in sizes]
+    results = index_images_at_sizes(
+        paths=paths,
+        sizes=sizes,
+        aspect_ratios=[aspect_ratio] * len(sizes),
+        match_sizes=match_sizes,
+        caching=True,
+        use_detect_faces=args.detect_faces,
+    )
+    level2codebook = {}
+    for level, (h, w), match_size, (tile_index, _, tile_images) in zip(levels, sizes, match_sizes, results):
+        level2codebook[level] = (tile_index, tile_images, match_size)
+        print("Level %d: %d tiles of %dx%d" % (level, (cells[:, 2] == level).sum(), h, w))
+
+    mosaic_img, _ = quadtree_mosaicify(
+        target_image, origin, cells, level2codebook, tile_h, tile_w, args.levels, opacity=args.opacity)
+
+    uniform = (mosaic_img.shape[0] // tile_h) * (mosaic_img.shape[1] // tile_w)
+    print("%d tiles instead of %d at a uniform scale, done in %.2fs" % (len(cells), uniform, time.time() - start))
+
+    filename = os.path.basename(args.target).split('.')[0]
+    savepath = args.savepath % (filename, args.scale)
+    print("Writing mosaic image to '%s' ..." % savepath)
+    cv2.imwrite(savepath, mosaic_img)
@@ -0,0 +1,73 @@
+HELP = "Swap codebook photos out of a finished mosaic, redrawing only the tiles that used them"
+
+
+def add_arguments(parser):
+    # required
+    parser.add_argument("--assignment", dest='assignment', type=str, required=True, 
+        help="The .assignment.npz file saved next to the mosaic")
+    parser.add_argument("--image", dest='image', type=str, required=True, 
+        help="The rendered mosaic to patch, at any tile size")
+    parser.add_argument("--exclude", dest='exclude', type=str, nargs='+', required=True, 
+        help="Codebook photos (paths or file names) to take out")
+
+    # optional
+    parser.add_argument("--savepath", dest='savepath', type=str, default=None, 
+        help="Where to save the patched image, defaults to overwriting --image")
+    parser.add_argument("--target", dest='target', type=str, default=None, 
+        help="Target image the mosaic was made from, defaults to the recorded one")
+
+
+def run(args):
+    import cv2
+
+    from emosaic.assignment import MosaicAssignment, match_codebook_paths
+    from emosaic.utils.indexing import index_images
+    from emosaic.utils.image import compute_hw
+    from emosaic.utils.cascade import DEFAULT_CASCADE_FACTOR
+
+    assignment = MosaicAssignment.load(args.assignment)
+    params = assignment.params
+
+    excluded, unmatched = match_codebook_paths(args.exclude, assignment.paths)
+    if unmatched:
+        print("Not in this mosaic's codebook, ignoring: %s" % ', '.join(unmatched))
+    if not excluded:
+        return
+
+    target_path = args.target or params['target_path']
+    target_image = cv2.imread(target_path)
+    mosaic = cv2.imread(args.image)
+    if target_image is None or mosaic is None:
+        raise IOError("Can't read the target '%s' or mosaic '%s'" % (target_path, args.image))
+
+    # the same (cached) codebook index the mosaic was made with
+    render_height, render_width = compute_hw(
+        params.get('render_scale', params['scale']), params['height_aspect'], params['width_aspect'])
+    tile_index, images, _ = index_images(
+        paths=list(assignment.paths),
+        aspect_ratio=params['height_aspect'] / float(params['width_aspect']),
+        height=render_height,
+        width=render_width,
+        match_size=assignment.match_size,
+        caching=True,
+        use_detect_faces=params.get('detect_faces', False),
+        feature=params.get('feature'),
+        cascade_grid=tuple(params['cascade_grid']) if params.get('cascade_grid') else None,
+        cascade_factor=params.get('cascade_factor', DEFAULT_CASCADE_FACTOR),
+        storage=params.get('storage', 'float32'),
+        variants=params.get('variants'),
+        alpha_background=assignment.alpha_background,
+        aspect_tolerance=params.get('aspect_tolerance', 0.0),
+    )
+    if tile_index is None or [image.path for image in images] != assignment.paths:
+        print("The codebook changed since this mosaic was made, re-run mosaic.py instead")
+        return
+
+    cells = assignment.exclude(excluded, tile_index, target_image)
+    print("Excluding %d photos changed %d of %d tiles" % (len(excluded), len(cells), len(assignment.ids)))
+    assignment.patch(mosaic, cells, target_image=target_image)
+
+    savepath = args.savepath or args.image
+    print("Writing mosaic image to '%s' ..." % savepath)
+    cv2.imwrite(savepath, mosaic)
+    assignment.save(args.assignment)
@@ -0,0 +1,60 @@
+import os
+
+HELP = "Create a GIF of mosaics across a range of tile scales"
+
+
+def add_arguments(parser):
+    # required
+    parser.add_argument("--detect-faces", dest='detect_faces', action='store_true', default=False, help="If we should only include pictures with faces in them")
+    parser.add_argument("--codebook-dir", dest='codebook_dir', type=str, required=True, help="Source folder of images")
+    parser.add_argument("--target", dest='target', type=str, required=True, help="Video to mosaicify")
+    parser.add_argument("--min-scale", dest='min_scale', type=int, required=True, help="Start scale rendering here")
+    parser.add_argument("--max-scale", dest='max_scale', type=int, required=True, help="Continue rendering up until this scale")
+    parser.add_argument("--savepath", dest='savepath', type=str, required=True, help="Final name for the video, will add scale and base path name (use .gif extension)")
+    parser.add_argument("--fps", dest='fps', type=float, default=3, help="Frames per second to render") 
+    parser.add_argument("--fuzz", dest='fuzz', type=float, default=5, help="Percent color change under which a pixel is left unchanged between frames") 
+    parser.add_argument("--vectorization-factor", dest='vectorization_factor', type=float, default=1., 
+        help="Downsize the image by this much before vectorizing")
+
+    # optional / has default
+    parser.add_argument("--randomness", dest='randomness', type=float, default=0.0, help="Probability to use random tile")
+    parser.add_argument("--ascending", dest='ascending', type=int, default=1, help="1 for ascending, 0 for descending order of scales")
+    parser.add_argument("--nprocesses", dest='nprocesses', type=int, default=None, help="Processes used to render scales in parallel (defaults to all cores)")
+    parser.add_argument("--resize-height", dest='resize_height', type=int, default=None, help="Scale GIF frames to this height")
+    parser.add_argument("--height-aspect", dest='height_aspect', type=float, default=4.0, help="Height aspect")
+    parser.add_argument("--width-aspect", dest='width_aspect', type=float, default=3.0, help="Width aspect")
+
+
+def run(args):
+    import cv2
+
+    from emosaic.utils.gif import create_gif_from_frames
+    from emosaic.utils.indexing import index_at_multiple_scales
+
+    # index at various scales
+    scale2index, scale2mosaic = index_at_multiple_scales(
+        args.codebook_dir,
+        min_scale=args.min_scale,
+        max_scale=args.max_scale,
+        height_aspect=args.height_aspect,
+        width_aspect=args.width_aspect,
+        vectorization_factor=args.vectorization_factor,
+        precompute_target=cv2.imread(args.target),
+        use_stabilization=True,
+        stabilization_threshold=0.85,
+        caching=True,
+        use_detect_faces=args.detect_faces,
+        nprocesses=args.nprocesses,
+    )
+
+    # stream the mosaics straight from memory into the GIF, in scale order
+    scales = sorted(scale2mosaic.keys(), reverse=not args.ascending)
+    frames = [scale2mosaic[scale] for scale in scales]
+    savepath = args.savepath % (
+        os.path.basename(args.target), args.min_scale, args.max_scale)
+    print("Writing %d frame GIF to '%s' ..." % (len(frames), savepath))
+    create_gif_from_frames(
+        frames, savepath, 
+        fps=args.fps, fuzz=args.fuzz, 
+        palette_frames=frames,
+        resize_height=args.resize_height)
@@ -0,0 +1,49 @@
+HELP = "Index a codebook directory ahead of time so later runs hit the cache"
+
+
+def add_arguments(parser):
+    # required
+    parser.add_argument("--codebook-dir", dest='codebook_dir', type=str, required=True, help="Source folder of images")
+    parser.add_argument("--scale", dest='scale', type=int, required=True, help="How large to make tiles")
+
+    # optional
+    parser.add_argument("--max-scale", dest='max_scale', type=int, default=None, help="Also index every scale up until this one")
+    parser.add_argument("--detect-faces", dest='detect_faces', action='store_true', default=False, help="If we should only include pictures with faces in them")
+    parser.add_argument("--height-aspect", dest='height_aspect', type=float, default=4.0, help="Height aspect")
+    parser.add_argument("--width-aspect", dest='width_aspect', type=float, default=3.0, help="Width aspect")
+    parser.add_argument("--aspects", dest='aspects', type=str, nargs='*', default=None, 
+        help="Index these aspect ratios (height:width, like 4:3 3:4 16:9) instead of --height-aspect/--width-aspect")
+    parser.add_argument("--aspect-tolerance", dest='aspect_tolerance', type=float, default=0.0, 
+        help="Also use photos whose aspect ratio is off by up to this much (like 0.1 for 10%%), center cropped")
+    parser.add_argument("--vectorization-factor", dest='vectorization_factor', type=float, default=1., 
+        help="Downsize the image by this much before vectorizing")
+
+
+def run(args):
+    from emosaic.utils.image import compute_hw, parse_aspect
+    from emosaic.utils.indexing import index_images_at_sizes
+
+    if args.aspects:
+        aspects = [parse_aspect(spec) for spec in args.aspects]
+    else:
+        aspects = [(args.height_aspect, args.width_aspect)]
+    max_scale = args.scale if args.max_scale is None else args.max_scale
+
+    # every scale & aspect ratio is filled from one decode of each photo
+    jobs = []
+    for height_aspect, width_aspect in aspects:
+        for scale in range(args.scale, max_scale + 1):
+            jobs.append((scale, height_aspect, width_aspect, compute_hw(scale, height_aspect, width_aspect)))
+    print("Indexing %d scales x %d aspect ratios..." % (max_scale + 1 - args.scale, len(aspects)))
+
+    results = index_images_at_sizes(
+        paths='%s/*.jpg' % args.codebook_dir,
+        sizes=[size for _, _, _, size in jobs],
+        aspect_ratios=[height_aspect / float(width_aspect) for _, height_aspect, width_aspect, _ in jobs],
+        vectorization_scaling_factor=args.vectorization_factor,
+        caching=True,
+        use_detect_faces=args.detect_faces,
+        aspect_tolerance=args.aspect_tolerance,
+    )
+    for (scale, height_aspect, width_aspect, _), (_, images, _) in zip(jobs, results):
+        print("Indexed %d codebook images at scale=%d, aspect=%g:%g" % (len(images or []), scale, height_aspect, width_aspect))
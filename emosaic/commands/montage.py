@@ -0,0 +1,195 @@
+import glob
+import os
+import random
+import pickle
+from datetime import datetime
+from multiprocessing import Pool
+
+HELP = "Create a face-aligned montage of one person across a photo library"
+
+
+def add_arguments(parser):
+    # required
+    parser.add_argument("--target-face-dir", dest='target_face_dir', type=str, required=True, help="We'll train a model on the single face in photos in this directory")
+    parser.add_argument("--other-face-dir", dest='other_face_dir', type=str, required=True, help="Directory of negative examples of other faces")
+    parser.add_argument("--photos-dir", dest='photos_dir', type=str, required=True, help="Directory of photos to use in the actual montage")
+    parser.add_argument("--output-size", dest='output_size', type=int, required=True, help="Dimensions of the square images to output")
+    parser.add_argument("--savedir", dest='savedir', type=str, required=True, help="Directory where to save the face-aligned images")
+
+    parser.add_argument("--start-closeness", dest='start_closeness', type=float, default=0.4, help="Starting closenness (in range 0.2 - 0.49)")
+    parser.add_argument("--end-closeness", dest='end_closeness', type=float, default=0.49, help="Ending closeness (in range 0.2 - 0.49)")
+
+    # optional
+    parser.add_argument("--sort-by-photo-age", dest='sort_by_photo_age', action='store_true', default=False, help="Should we sort by photo age? Otherwise random order.")
+    parser.add_argument("--weights-dir", dest='weights_dir', type=str, default=None, help="Directory holding the dlib weights")
+    parser.add_argument("--download-weights", dest='download_weights', action='store_true', default=False, help="Download missing dlib weights from dlib.net")
+    parser.add_argument("--match-mode", dest='match_mode', type=str, default='svm', choices=['svm', 'centroid', 'index'],
+        help="How to find the target face: linear SVM, nearest centroid, or a range query over a faiss index of library faces")
+    parser.add_argument("--match-radius", dest='match_radius', type=float, default=0.6, help="Embedding distance for --match-mode index")
+    parser.add_argument("--gif-savepath", dest='gif_savepath', type=str, default=None, help="Also stream the aligned faces straight into a GIF here")
+    parser.add_argument("--fps", dest='fps', type=float, default=7, help="Frames per second of the --gif-savepath GIF")
+    parser.add_argument("--align-window", dest='align_window', type=int, default=32, help="Max faces being aligned or waiting to be written at once")
+    parser.add_argument("--nprocesses", dest='nprocesses', type=int, default=None, help="Processes used to detect & embed faces (defaults to all cores)")
+
+
+def get_taken_at_sort_key(m):
+    try:
+        taken_at = m['taken_at']
+        if not taken_at:
+            return datetime.now()
+        return taken_at
+    except Exception:
+        return datetime.now()
+
+
+def run(args):
+    import dlib
+    import cv2
+    import numpy as np
+    from sklearn.model_selection import cross_val_score, StratifiedKFold
+    from sklearn import svm
+
+    from emosaic import faces
+    from emosaic.image import Image
+    from emosaic.utils.gif import GifWriter
+    from emosaic.utils.misc import imap_bounded
+
+    # resolve weights up front, workers reuse the resolved paths
+    faces.get_weights_path('landmarks_5', savedir=args.weights_dir, allow_download=args.download_weights)
+    faces.get_weights_path('face_recognition', savedir=args.weights_dir, allow_download=args.download_weights)
+
+    # some settings
+    downsize = 0.25
+    face_detect_upsample_multiple = 2
+    num_embedding_jitters = 5
+    interactive = False  # show matches as they come up?
+    embedding_settings = dict(
+        downsize=downsize,
+        face_detect_upsample_multiple=face_detect_upsample_multiple,
+        num_embedding_jitters=num_embedding_jitters,
+        nprocesses=args.nprocesses,
+        weights_dir=args.weights_dir,
+        allow_download=args.download_weights,
+        verbose=1)
+
+    # get positive examples
+    print("Embedding target faces from (%s) so we can train a model that can find this face..." % args.target_face_dir)
+    positive_embeddings = faces.extract_embeddings(
+        args.target_face_dir, allow_single_face_per_photo=True, **embedding_settings)
+
+    # get negative examples
+    print("Embedding other faces from (%s)..." % args.other_face_dir)
+    negative_embeddings = faces.extract_embeddings(
+        args.other_face_dir, allow_single_face_per_photo=False, **embedding_settings)
+
+    # some stats on our training set composition
+    n_pos, n_neg = positive_embeddings.shape[0], negative_embeddings.shape[0]
+    print("Found %d positive and %d negative examples" % (n_pos, n_neg))
+
+    # create our training / testing matrices
+    pos_labels = np.ones((n_pos, 1))
+    neg_labels = np.zeros((n_neg, 1))
+    X = np.vstack((positive_embeddings, negative_embeddings))
+    y = np.vstack((pos_labels, neg_labels)).ravel()
+
+    # find matches
+    query_paths = glob.glob(os.path.join(args.photos_dir, "*.jpg"))
+    print("Photos dir has %d photos that we'll search over to find matches!" % len(query_paths))
+    random.shuffle(query_paths)
+
+    # detect & embed every face in the library, only new photos are embedded
+    path2faces = faces.extract_library_embeddings(query_paths, **embedding_settings)
+    library_embeddings, face_refs = faces.stack_library_faces(path2faces, query_paths)
+    print("Library has %d faces, scoring them all at once (mode=%s)..." % (
+        len(face_refs), args.match_mode))
+
+    if args.match_mode == 'index':
+        # one range query per target example over every library face
+        index = faces.build_face_index(library_embeddings)
+        match_ids = faces.search_face_index(index, positive_embeddings, radius=args.match_radius)
+        is_match = np.zeros(len(face_refs), dtype=bool)
+        is_match[match_ids] = True
+    elif args.match_mode == 'centroid':
+        scores = faces.nearest_centroid_scores(positive_embeddings, negative_embeddings, library_embeddings)
+        is_match = scores > 0
+    else:
+        # train a stupidly simple model
+        # THIS ML IS BAD AND I FEEL BAD
+        # IT JUST NEEDS TO BE A SUPER SIMPLE MODEL TO WORK GUYS PLZ DON'T HATE ME
+        print("Training a simple linear classifier on top of the embedding vectors...")
+        skf = StratifiedKFold(n_splits=5)
+        clf = svm.SVC(kernel='linear', C=1)
+        scores = cross_val_score(clf, X, y, cv=skf)
+        print("Cross validation scores: %s" % scores) # just for like, sanity's sake. these should all be near 1
+        clf.fit(X, y)
+        is_match = faces.linear_face_scores(clf, library_embeddings) > 0
+
+    if interactive:
+        print("Interactive mode is on - you'll see matches as we find them")
+        win = dlib.image_window()
+
+    # only keep lightweight match records, pixels are re-decoded when aligning
+    matches = []
+    for (path, face), matched in zip(face_refs, is_match):
+        if not matched:
+            continue
+
+        rect, keypoints = face['rect'], face['keypoints']
+        taken_at = getattr(Image(path), 'taken_at', None)
+        matches.append(dict(path=path, rect=rect, keypoints=keypoints, taken_at=taken_at))
+        if len(matches) % 5 == 0:
+            print("Have found %s matches so far" % len(matches))
+        if interactive:
+            img = cv2.imread(path)
+            resized = cv2.resize(img, None, fx=downsize, fy=downsize, interpolation=cv2.INTER_AREA)
+            win.clear_overlay()
+            win.set_image(resized[:, :, [2, 1, 0]])
+            win.add_overlay(dlib.rectangle(*rect))
+            dlib.hit_enter_to_continue()
+
+    # save as temporary measure
+    with open('cache/matches.pkl', 'wb') as pf:
+        pickle.dump(matches, pf)
+
+    # now that we have matches, we can actually create our montage
+    if args.sort_by_photo_age:
+        print("Sorting montage matches by photo taken date...")
+        matches.sort(key=get_taken_at_sort_key)
+
+    try:
+        # ensure directory
+        os.makedirs(args.savedir)
+    except OSError:
+        pass
+
+    # align in parallel workers, writing each frame (and the GIF) as it arrives
+    closenesses = np.linspace(args.start_closeness, args.end_closeness, len(matches))
+    jobs = (
+        (m['path'], downsize, m['keypoints'], (closeness, closeness), args.output_size)
+        for m, closeness in zip(matches, closenesses)
+    )
+    gif_writer = GifWriter(args.gif_savepath, fps=args.fps) if args.gif_savepath else None
+
+    saved = 0
+    pool = Pool(args.nprocesses)
+    try:
+        for aligned in imap_bounded(pool, faces.align_face_from_path, jobs, window=args.align_window):
+            if aligned is None:
+                continue
+            cv2.imwrite(os.path.join(args.savedir, '%08d.jpg' % saved), aligned)
+            if gif_writer is not None:
+                gif_writer.append(aligned)
+            saved += 1
+            if saved % 10 == 0:
+                print("Aligned %d images..." % saved)
+    finally:
+        pool.close()
+        pool.join()
+        if gif_writer is not None:
+            gif_writer.close()
+
+    print("Saved %d images to disk for the monage to directory=%s" % (saved, args.savedir))
+    if gif_writer is not None:
+        print("Wrote %d frame GIF montage to %s" % (gif_writer.num_frames, args.gif_savepath))
+    else:
+        print("=> Follow up by using the create_gif_from_photos_folder.py script! This will allow you to try different orderings, frames per second, etc.")
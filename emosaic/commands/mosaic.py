@@ -0,0 +1,226 @@
+import os
+
+HELP = "Create a mosaic image from a target image"
+
+# output formats written band by band, see MosaicAssignment.write()
+STREAMING_EXTENSIONS = ('.tif', '.tiff', '.npy', '.dzi')
+
+
+def add_arguments(parser):
+    # required
+    parser.add_argument("--codebook-dir", dest='codebook_dir', type=str, required=True, help="Source folder of images")
+    parser.add_argument("--savepath", dest='savepath', type=str, required=True, help="Where to save image to. Scale/filename is used in formatting.")
+    parser.add_argument("--target", dest='target', type=str, required=True, help="Image to make mosaic from")
+    parser.add_argument("--scale", dest='scale', type=int, required=True, help="How large to make tiles")
+
+    # optional
+    parser.add_argument("--best-k", dest='best_k', type=int, default=1, help="Choose tile from top K best matches")
+    parser.add_argument("--no-trim", dest='no_trim', action='store_true', default=False, help="If we shouldn't trim around the outside")
+    parser.add_argument("--detect-faces", dest='detect_faces', action='store_true', default=False, help="If we should only include pictures with faces in them")
+    parser.add_argument("--opacity", dest='opacity', type=float, default=0.0, help="Opacity of the original photo")
+    parser.add_argument("--color-correction", dest='color_correction', type=float, default=0.0, 
+        help="Shift each tile's mean color this far (0 to 1) towards the target's, best with --feature centered")
+    parser.add_argument("--randomness", dest='randomness', type=float, default=0.0, help="Probability to use random tile")
+    parser.add_argument("--height-aspect", dest='height_aspect', type=float, default=4.0, help="Height aspect")
+    parser.add_argument("--width-aspect", dest='width_aspect', type=float, default=3.0, help="Width aspect")
+    parser.add_argument("--aspect-tolerance", dest='aspect_tolerance', type=float, default=0.0, 
+        help="Also use photos whose aspect ratio is off by up to this much (like 0.1 for 10%%), center cropped")
+    parser.add_argument("--vectorization-factor", dest='vectorization_factor', type=float, default=1., 
+        help="Downsize the image by this much before vectorizing")
+    parser.add_argument("--render-scale", dest='render_scale', type=int, default=None, 
+        help="Size of tiles in the output, defaults to --scale. Larger makes a bigger, sharper mosaic without slowing matching")
+    parser.add_argument("--num-candidates", dest='num_candidates', type=int, default=8, 
+        help="Top matches cached per tile, so re-runs changing only best-k/randomness/opacity skip the search")
+    parser.add_argument("--seed", dest='seed', type=int, default=None, help="Random seed for tile selection")
+    parser.add_argument("--band-rows", dest='band_rows', type=int, default=4, 
+        help="Rows of tiles rendered at a time for .tif/.tiff/.npy output")
+    parser.add_argument("--exclude", dest='exclude', type=str, nargs='*', default=[], 
+        help="Codebook photos (paths or file names) never to use")
+    parser.add_argument("--feature", dest='feature', type=str, default='raw', 
+        help="What tiles are compared on: raw, lab, centered (ignoring mean color), grid:N (NxN mean colors) or histogram:N (N bins per channel)")
+    parser.add_argument("--cascade-grid", dest='cascade_grid', type=int, default=None, 
+        help="Shortlist matches on an NxN mean color grid before comparing them in full, much faster for big codebooks")
+    parser.add_argument("--cascade-factor", dest='cascade_factor', type=int, default=64, 
+        help="Shortlisted matches per candidate, with --cascade-grid")
+    parser.add_argument("--storage", dest='storage', type=str, default='float32', choices=('float32', 'float16', 'uint8'), 
+        help="How codebook vectors are kept in memory & cached, uint8 is 4x smaller and exact for raw/lab features")
+    parser.add_argument("--variants", dest='variants', type=str, default=None, 
+        help="Also match flipped/rotated photos, comma separated: hflip, vflip, rot180, and rot90, rot270 for square tiles")
+    parser.add_argument("--alpha-background", dest='alpha_background', type=str, default=None, 
+        help="Use .png codebook transparency: 'target' to match only opaque parts & let the target show through, "
+             "or an R,G,B color to put behind them")
+    parser.add_argument("--max-uses", dest='max_uses', type=int, default=None, 
+        help="Use each codebook photo at most this many times (instead of --best-k/--randomness)")
+    parser.add_argument("--min-repeat-distance", dest='min_repeat_distance', type=int, default=0, 
+        help="Repeats of a codebook photo must be at least this many tiles apart")
+
+
+def run(args):
+    import glob
+
+    import cv2
+
+    from emosaic.utils.indexing import index_images
+    from emosaic.utils.misc import is_running_jupyter
+    from emosaic.utils.image import compute_hw, compute_match_size
+    from emosaic.caching import CandidatesCacheConfig
+    from emosaic.candidates import TileCandidates
+    from emosaic.assignment import MosaicAssignment, assignment_path_for, match_codebook_paths
+    from emosaic.variants import parse_variants
+    from emosaic.utils.alpha import parse_background
+
+    print("=== Creating Mosaic Image ===")
+    print("Images=%s, target=%s, scale=%d, aspect_ratio=%.4f, vectorization=%.2f, randomness=%.2f, faces=%s" % (
+        args.codebook_dir, args.target, args.scale, args.height_aspect / args.width_aspect, 
+        args.vectorization_factor, args.randomness, args.detect_faces))
+
+    # sizing for mosaic tiles: cut from the target at `height` x `width`, matched
+    # at `match_size` and pasted into the output at `render_height` x `render_width`
+    height, width = compute_hw(args.scale, args.height_aspect, args.width_aspect)
+    aspect_ratio = height / float(width)
+    match_size = compute_match_size(height, width, args.vectorization_factor)
+    render_scale = args.render_scale or args.scale
+    render_height, render_width = compute_hw(render_scale, args.height_aspect, args.width_aspect)
+
+    cascade_grid = (args.cascade_grid, args.cascade_grid) if args.cascade_grid else None
+    variants = parse_variants(args.variants)
+    alpha_background = parse_background(args.alpha_background)
+
+    # get target image
+    target_image = cv2.imread(args.target)
+
+    # index all those images
+    paths = glob.glob('%s/*.jpg' % args.codebook_dir)
+    if alpha_background is not None:
+        # transparent codebooks, like emojis
+        paths += glob.glob('%s/*.png' % args.codebook_dir)
+    tile_index, images, tile_images = index_images(
+        paths=paths,
+        aspect_ratio=aspect_ratio, 
+        height=render_height,
+        width=render_width,
+        match_size=match_size,
+        caching=True,
+        use_detect_faces=args.detect_faces,
+        cascade_grid=cascade_grid,
+        cascade_factor=args.cascade_factor,
+        feature=args.feature,
+        storage=args.storage,
+        variants=variants,
+        alpha_background=alpha_background,
+        aspect_tolerance=args.aspect_tolerance,
+    )
+
+    print("Using %d tile codebook images..." % len(tile_images))
+
+    # search each tile's top candidates once, cached per target & codebook
+    candidates_cache = CandidatesCacheConfig(
+        target_path=args.target,
+        codebook_paths=paths,
+        height=height,
+        width=width,
+        k=max(args.num_candidates, args.best_k + 1),
+        detect_faces=args.detect_faces,
+        match_size=match_size,
+        cascade=(cascade_grid, args.cascade_factor) if cascade_grid else None,
+        feature=args.feature,
+        storage=args.storage,
+        variants=variants,
+        alpha_background=alpha_background,
+        aspect_tolerance=args.aspect_tolerance)
+    candidates = candidates_cache.load()
+    if candidates is None:
+        candidates = TileCandidates.search(
+            target_image, height, width, tile_index, k=candidates_cache.k, match_size=match_size,
+            feature=args.feature, variants=variants)
+        candidates_cache.save(candidates)
+    else:
+        print("Loaded cached tile candidates from '%s'" % candidates_cache.savepath)
+
+    # photos we've been asked to leave out are masked from selection & search
+    codebook_paths = [image.path for image in images]
+    excluded, unmatched = match_codebook_paths(args.exclude, codebook_paths)
+    if unmatched:
+        print("Not in the codebook, ignoring: %s" % ', '.join(unmatched))
+    exclude_ids = [codebook_paths.index(p) for p in excluded]
+
+    # transform!
+    if args.max_uses or args.min_repeat_distance > 1:
+        # spread tiles out over the codebook, as close to the best matches as possible
+        ids, report = candidates.select_constrained(
+            max_uses=args.max_uses,
+            min_distance=args.min_repeat_distance,
+            exclude=exclude_ids,
+            tile_index=tile_index,
+            target_image=target_image)
+        print("Tile constraints cost %.2f%% in match distance (%d of %d tiles changed, %d couldn't comply), took %.2fs" % (
+            100 * report['gap'], report['changed'], candidates.num_tiles, report['relaxed'], report['seconds']))
+    else:
+        ids = candidates.select(
+            best_k=args.best_k,
+            randomness=args.randomness,
+            exclude=exclude_ids,
+            num_images=len(tile_images),
+            seed=args.seed)
+    if exclude_ids:
+        ids = candidates.fill_excluded(ids, tile_index, target_image, exclude_ids)
+    # what the mosaic is made of, so it can be re-rendered at any size without searching
+    assignment = MosaicAssignment.from_candidates(
+        candidates, ids, codebook_paths,
+        target_path=args.target,
+        scale=args.scale,
+        render_scale=render_scale,
+        height_aspect=args.height_aspect,
+        width_aspect=args.width_aspect,
+        best_k=args.best_k,
+        randomness=args.randomness,
+        opacity=args.opacity,
+        color_correction=args.color_correction,
+        seed=args.seed,
+        trim=not args.no_trim,
+        excluded=excluded,
+        max_uses=args.max_uses,
+        min_repeat_distance=args.min_repeat_distance,
+        vectorization_factor=args.vectorization_factor,
+        storage=args.storage,
+        cascade_grid=cascade_grid,
+        cascade_factor=args.cascade_factor,
+        alpha_background=alpha_background,
+        aspect_tolerance=args.aspect_tolerance,
+        detect_faces=args.detect_faces)
+
+    filename = os.path.basename(args.target).split('.')[0]
+    savepath = args.savepath % (filename, args.scale)
+
+    if savepath.lower().endswith(STREAMING_EXTENSIONS):
+        # giant posters: written band by band, never held in memory whole
+        if args.no_trim:
+            print("--no-trim isn't supported for %s output, trimming" % os.path.splitext(savepath)[1])
+        print("Writing mosaic image to '%s' ..." % savepath)
+        assignment.write(
+            savepath, render_height, render_width,
+            band_rows=args.band_rows,
+            target_image=target_image,
+            tile_images=tile_images)
+    else:
+        trim = not args.no_trim
+        if not trim and render_scale != args.scale:
+            print("--no-trim isn't supported with a different --render-scale, trimming")
+            trim = True
+        mosaic_img = candidates.render(
+            tile_images, ids, target_image,
+            opacity=args.opacity,
+            trim=trim,
+            color_correction=args.color_correction)
+
+        # show in notebook, if running inside one
+        if is_running_jupyter():
+            import matplotlib.pyplot as plt
+            plt.figure(figsize = (64, 30))
+            plt.imshow(mosaic_img[:, :, [2,1,0]], interpolation='nearest')
+
+        # save to disk
+        print("Writing mosaic image to '%s' ..." % savepath)
+        cv2.imwrite(savepath, mosaic_img)
+
+    print("Writing tile assignment to '%s' ..." % assignment.save(assignment_path_for(savepath)))
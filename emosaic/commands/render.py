@@ -0,0 +1,66 @@
+HELP = "Re-render a saved mosaic assignment at any tile size, without searching"
+
+
+def add_arguments(parser):
+    # required
+    parser.add_argument("--assignment", dest='assignment', type=str, required=True, 
+        help="The .assignment.npz file saved next to a mosaic")
+    parser.add_argument("--savepath", dest='savepath', type=str, required=True, 
+        help="Where to save the image to. .tif/.tiff/.npy are written band by band, for prints bigger than memory, "
+             ".dzi writes a deep zoom tile pyramid")
+
+    # optional
+    parser.add_argument("--scale", dest='scale', type=int, default=None, 
+        help="Tile scale to render at, defaults to the one the mosaic was made with")
+    parser.add_argument("--target", dest='target', type=str, default=None, 
+        help="Target image to blend with opacity or color correct to, defaults to the recorded one")
+    parser.add_argument("--opacity", dest='opacity', type=float, default=None, help="Defaults to the recorded opacity")
+    parser.add_argument("--color-correction", dest='color_correction', type=float, default=None, 
+        help="Defaults to the recorded color correction")
+    parser.add_argument("--band-rows", dest='band_rows', type=int, default=4, 
+        help="Rows of tiles rendered at a time for .tif/.tiff/.npy output")
+    parser.add_argument("--max-cached-tiles", dest='max_cached_tiles', type=int, default=1024, 
+        help="Resized codebook photos kept in memory between bands")
+    parser.add_argument("--nthreads", dest='nthreads', type=int, default=4, help="Threads loading codebook photos")
+
+
+def run(args):
+    import os
+
+    import cv2
+
+    from emosaic.assignment import MosaicAssignment
+    from emosaic.utils.image import compute_hw
+
+    assignment = MosaicAssignment.load(args.assignment)
+    params = assignment.params
+
+    if args.scale is None:
+        tile_h, tile_w = params['tile_h'], params['tile_w']
+    else:
+        tile_h, tile_w = compute_hw(args.scale, params['height_aspect'], params['width_aspect'])
+
+    target_image = None
+    opacity = params.get('opacity', 0.0) if args.opacity is None else args.opacity
+    color_correction = params.get('color_correction', 0.0) if args.color_correction is None else args.color_correction
+    if opacity > 0 or color_correction > 0 or assignment.alpha_background == 'target':
+        target_path = args.target or params.get('target_path')
+        if target_path and os.path.exists(target_path):
+            target_image = cv2.imread(target_path)
+        else:
+            print("Target image not found, rendering without opacity or color correction")
+            if assignment.alpha_background == 'target':
+                raise IOError("Can't show the target through transparent tiles without it, pass --target")
+
+    rows, cols = assignment.grid_shape
+    print("Rendering %dx%d tiles at %dx%d pixels each from %d codebook photos..." % (
+        rows, cols, tile_h, tile_w, len(set(assignment.ids[assignment.ids >= 0]))))
+    print("Writing mosaic image to '%s' ..." % args.savepath)
+    assignment.write(
+        args.savepath, tile_h, tile_w,
+        band_rows=args.band_rows,
+        target_image=target_image,
+        opacity=opacity,
+        color_correction=color_correction,
+        max_cached_tiles=args.max_cached_tiles,
+        nthreads=args.nthreads)
@@ -0,0 +1,246 @@
+import os
+import math
+import collections
+from multiprocessing import Pool
+
+import numpy as np
+import cv2
+import PIL.Image as pillow
+
+from emosaic.utils.image import upscale_window, to_tile
+from emosaic.variants import VARIANTS, apply_variant
+from emosaic.candidates import correct_colors
+from emosaic.utils.alpha import composite, TARGET_BACKGROUND
+
+"""
+Deep Zoom (DZI) pyramids of mosaics, for viewers like OpenSeadragon that
+only fetch the tiles on screen:
+
+    beach.dzi
+    beach_files/0/0_0.jpg    <- 1x1 pixel
+    beach_files/1/0_0.jpg    <- 2x2
+    ...
+    beach_files/N/0_0.jpg    <- full resolution, in tile_size chunks
+    beach_files/N/0_1.jpg
+    ...
+
+Every level is rendered straight from the tile assignment, with each
+codebook photo drawn at that level's size, so the full resolution image
+never exists in memory or on disk.
+"""
+
+DZI_TEMPLATE = '''<?xml version="1.0" encoding="UTF-8"?>
+<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="%s" Overlap="%d" TileSize="%d">
+    <Size Width="%d" Height="%d"/>
+</Image>
+'''
+
+# set for each worker process, see init_deep_zoom_worker()
+DEEP_ZOOM_STATE = {}
+
+
+def num_levels(height, width):
+    return int(math.ceil(math.log(max(height, width), 2))) + 1
+
+def level_size(height, width, level, max_level):
+    scale = 0.5 ** (max_level - level)
+    return int(math.ceil(height * scale)), int(math.ceil(width * scale))
+
+def cell_edges(num_cells, level_pixels):
+    """
+    Pixel boundaries of each row (or column) of mosaic tiles at a level,
+    spread as evenly as integer pixels allow.
+    """
+    return np.round(np.linspace(0, level_pixels, num_cells + 1)).astype(np.int64)
+
+def load_photo_at_size(path, h, w, alpha_background=None):
+    """
+    Loads a codebook photo cropped & resized to (h, w), like to_tile. JPEGs
+    are decoded at reduced size when that's still big enough, which is much
+    faster for the small sizes of the upper pyramid levels.
+
+    @param: alpha_background (None, 'target' or (b, g, r)) keep transparency, see emosaic.utils.alpha
+    """
+    if alpha_background is not None:
+        img = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+        if img is None:
+            raise IOError("Can't read codebook photo '%s'" % path)
+        return to_tile(img, h, w, alpha_background)
+    img = pillow.open(path)
+    img.draft('RGB', (w, h))
+    arr = np.array(img.convert('RGB'))[:, :, ::-1]
+    return to_tile(arr, h, w)
+
+
+def init_deep_zoom_worker(paths, ids, grid_shape, region, opacity, max_cached_tiles, slots=None, variants=None,
+        means=None, color_correction=0.0, alpha_background=None):
+    DEEP_ZOOM_STATE.update(
+        alpha_background=alpha_background,
+        means=means,
+        color_correction=color_correction,
+        paths=paths,
+        ids=ids.reshape(grid_shape),
+        slots=None if slots is None else slots.reshape(grid_shape),
+        variants=variants or ['identity'],
+        region=region,
+        opacity=opacity,
+        max_cached_tiles=max_cached_tiles,
+        cache=collections.OrderedDict())
+
+def cached_photo(i, h, w):
+    state = DEEP_ZOOM_STATE
+    cache = state['cache']
+    key = (i, h, w)
+    if key in cache:
+        cache[key] = cache.pop(key)
+    else:
+        cache[key] = load_photo_at_size(state['paths'][i], h, w, state.get('alpha_background'))
+        while len(cache) > state['max_cached_tiles']:
+            cache.popitem(last=False)
+    return cache[key]
+
+def render_level_window(x0, x1, level_h, level_w):
+    """
+    Renders pixel rows [x0, x1) of a pyramid level from the shared
+    assignment in DEEP_ZOOM_STATE.
+    """
+    state = DEEP_ZOOM_STATE
+    ids, slots = state['ids'], state.get('slots')
+    rows, cols = ids.shape
+    ys, xs = cell_edges(rows, level_h), cell_edges(cols, level_w)
+
+    window = np.zeros((x1 - x0, level_w, 3), dtype=np.uint8)
+    first = max(0, np.searchsorted(ys, x0, side='right') - 1)
+    last = np.searchsorted(ys, x1, side='left')
+    for r in range(first, min(last, rows)):
+        top, bottom = ys[r], ys[r + 1]
+        if bottom <= top:
+            continue
+        for c in range(cols):
+            left, right = xs[c], xs[c + 1]
+            if right <= left or ids[r, c] < 0:
+                continue
+            name = state['variants'][slots[r, c]] if slots is not None else 'identity'
+            if VARIANTS[name][1]:
+                # rotated a quarter turn, so load it the other way round (cells can be off square by a pixel)
+                photo = apply_variant(cached_photo(ids[r, c], right - left, bottom - top), name)
+            else:
+                photo = apply_variant(cached_photo(ids[r, c], bottom - top, right - left), name)
+            if photo.shape[2] == 4:
+                # transparent, the target shows through
+                photo = composite(photo, upscale_window(
+                    state['region'], top, left, bottom - top, right - left,
+                    level_h / float(state['region'].shape[0]), level_w / float(state['region'].shape[1])))
+            if state['means'] is not None:
+                photo = correct_colors(photo[None], state['means'][r * cols + c][None], state['color_correction'])[0]
+            a, b = max(top, x0), min(bottom, x1)
+            window[a - x0 : b - x0, left : right] = photo[a - top : b - top]
+
+    region, opacity = state['region'], state['opacity']
+    if region is not None and opacity > 0:
+        target = upscale_window(
+            region, x0, 0, x1 - x0, level_w,
+            level_h / float(region.shape[0]), level_w / float(region.shape[1]))
+        window = cv2.addWeighted(target, opacity, window, 1 - opacity, 0)
+    return window
+
+def write_level_row(args):
+    """
+    Renders one row of DZI tiles of a level (plus overlap) and saves them.
+
+    @return: number of tiles written
+    """
+    level_dir, tile_row, level_h, level_w, tile_size, overlap, fmt, quality = args
+    x0 = max(0, tile_row * tile_size - overlap)
+    x1 = min(level_h, (tile_row + 1) * tile_size + overlap)
+    window = render_level_window(x0, x1, level_h, level_w)
+
+    params = [cv2.IMWRITE_JPEG_QUALITY, quality] if fmt in ('jpg', 'jpeg') else []
+    num_cols = int(math.ceil(level_w / float(tile_size)))
+    for tile_col in range(num_cols):
+        y0 = max(0, tile_col * tile_size - overlap)
+        y1 = min(level_w, (tile_col + 1) * tile_size + overlap)
+        path = os.path.join(level_dir, '%d_%d.%s' % (tile_col, tile_row, fmt))
+        cv2.imwrite(path, window[:, y0 : y1], params)
+    return num_cols
+
+
+def write_deep_zoom(
+        assignment,
+        savepath,
+        tile_h,
+        tile_w,
+        tile_size=254,
+        overlap=1,
+        fmt='jpg',
+        quality=90,
+        target_image=None,
+        opacity=None,
+        nprocesses=None,
+        max_cached_tiles=4096,
+        color_correction=None,
+    ):
+    """
+    @param: assignment (MosaicAssignment) what to render
+    @param: savepath (String) the .dzi file, tiles go in a '<name>_files' folder next to it
+    @param: tile_h, tile_w (int) size of each mosaic tile at full resolution
+    @param: tile_size, overlap (int) DZI tile size & overlap in pixels
+    @param: fmt (String) 'jpg' or 'png'
+    @param: target_image (numpy arr) original target, to blend with opacity
+    @param: opacity (float) defaults to the opacity the mosaic was made with
+    @param: color_correction (float) defaults to the one the mosaic was made with, needs target_image
+    @param: nprocesses (int) workers rendering rows of tiles, defaults to the number of cores
+
+    @return: tuple (height, width) of the full resolution level
+    """
+    rows, cols = assignment.grid_shape
+    height, width = rows * tile_h, cols * tile_w
+    max_level = num_levels(height, width) - 1
+
+    if opacity is None:
+        opacity = assignment.params.get('opacity', 0.0)
+    region = None
+    if target_image is not None and opacity > 0:
+        x0, y0 = assignment.params['origin']
+        h, w = assignment.params['tile_h'], assignment.params['tile_w']
+        region = target_image[x0 : x0 + rows * h, y0 : y0 + cols * w]
+
+    if color_correction is None:
+        color_correction = assignment.params.get('color_correction', 0.0)
+    means = None
+    if target_image is not None and color_correction > 0:
+        means = assignment.target_means(target_image)
+    if assignment.alpha_background == TARGET_BACKGROUND:
+        if target_image is None:
+            raise ValueError("Tiles with transparency need the target image to show through")
+        x0, y0 = assignment.params['origin']
+        h, w = assignment.params['tile_h'], assignment.params['tile_w']
+        region = target_image[x0 : x0 + rows * h, y0 : y0 + cols * w]
+
+    changed = assignment.changed_paths()
+    if changed:
+        print("Warning: %d codebook photos changed since this mosaic was made, e.g. '%s'" % (
+            len(changed), changed[0]))
+
+    files_dir = os.path.splitext(savepath)[0] + '_files'
+    initargs = (
+        assignment.paths, assignment.ids, assignment.grid_shape, region, opacity, max_cached_tiles,
+        assignment.slots, assignment.variants, means, color_correction, assignment.alpha_background)
+    pool = Pool(nprocesses, initializer=init_deep_zoom_worker, initargs=initargs)
+    try:
+        for level in range(max_level, -1, -1):
+            level_h, level_w = level_size(height, width, level, max_level)
+            level_dir = os.path.join(files_dir, str(level))
+            if not os.path.exists(level_dir):
+                os.makedirs(level_dir)
+
+            num_rows = int(math.ceil(level_h / float(tile_size)))
+            jobs = [(level_dir, r, level_h, level_w, tile_size, overlap, fmt, quality) for r in range(num_rows)]
+            pool.map(write_level_row, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    with open(savepath, 'w') as f:
+        f.write(DZI_TEMPLATE % (fmt, overlap, tile_size, width, height))
+    return height, width
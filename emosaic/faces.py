@@ -1,51 +1,140 @@
 import bz2
+import hashlib
 import os
 import glob
 
-import dlib
 import numpy as np
 import cv2
-import requests
+
+from emosaic.caching import EmbeddingsCacheConfig, DEFAULT_CACHE_DIR
 
 
 URL_WEIGHTS_5_FACE_LANDMARKS = "http://dlib.net/files/shape_predictor_5_face_landmarks.dat.bz2"
 URL_WEIGHTS_68_FACE_LANDMARKS = "http://dlib.net/files/shape_predictor_68_face_landmarks.dat.bz2"
 URL_WEIGHTS_FACE_RECOGNITION = "http://dlib.net/files/dlib_face_recognition_resnet_model_v1.dat.bz2"
 
-def extract_dlib_weights(url, savedir='weights'):
+WEIGHTS_2_URL = {
+    'landmarks_5' : URL_WEIGHTS_5_FACE_LANDMARKS,
+    'landmarks_68' : URL_WEIGHTS_68_FACE_LANDMARKS,
+    'face_recognition' : URL_WEIGHTS_FACE_RECOGNITION,
+}
+
+# expected sha256 of the *decompressed* weights, keyed like WEIGHTS_2_URL, to
+# check downloads against. None pins nothing: downloads are only checked for a
+# complete bz2 stream, & the sha256 recorded then only catches later changes
+WEIGHTS_2_SHA256 = {
+    'landmarks_5' : None,
+    'landmarks_68' : None,
+    'face_recognition' : None,
+}
+
+# where weights live, and whether we may go to the network for them
+DEFAULT_WEIGHTS_DIR = os.environ.get('EMOSAIC_WEIGHTS_DIR', 'weights')
+DEFAULT_ALLOW_DOWNLOAD = os.environ.get('EMOSAIC_DOWNLOAD_WEIGHTS', '0') == '1'
+
+# resolved (and verified) paths by (name, savedir), filled on first use
+WEIGHTS_2_PATH = {}
+
+def sha256_of_file(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def verify_dlib_weights(savepath, expected_sha256=None):
+    """
+    Checks the weights at `savepath` against `expected_sha256`, or, if that
+    is None, against the `<savepath>.sha256` sidecar written at download time
+    (which only tells whether the file changed since). Weights with nothing
+    to check against are accepted as-is.
+    """
+    sidecar = savepath + '.sha256'
+    if expected_sha256 is None and os.path.exists(sidecar):
+        with open(sidecar) as f:
+            expected_sha256 = f.read().strip()
+    if expected_sha256 is None:
+        return True
+    return sha256_of_file(savepath) == expected_sha256
+
+def extract_dlib_weights(url, savedir=DEFAULT_WEIGHTS_DIR, expected_sha256=None, chunk_size=1 << 20):
+    """
+    Downloads the bz2 weights at `url` and decompresses them into `savedir`,
+    streaming so the blob is never held in memory. Truncated downloads and
+    ones not matching `expected_sha256` are rejected, and a sha256 sidecar is
+    recorded so later changes to the file are noticed.
+    """
+    import requests
+
     # create savepath and check that we haven't already downloaded
     savename = os.path.basename(url).replace('.bz2', '')
     savepath = os.path.join(savedir, savename)
-    if os.path.exists(savepath):
-        print("Weights already loaded at: %s" % savepath)
+    if os.path.exists(savepath) and verify_dlib_weights(savepath, expected_sha256):
         return savepath
 
-    # otherwise download file
-    r = requests.get(url, allow_redirects=True)
-    tmp_path = '/tmp/%s' % os.path.basename(url)
-    with open(tmp_path, 'wb') as f:
-        f.write(r.content)
-
-    # extract the data by decompressing
-    data = bz2.BZ2File(tmp_path).read()
-
-    # save to savepath
     try:
         os.makedirs(savedir)
     except OSError:
         pass
 
-    with open(savepath, 'wb') as wf:
-        wf.write(data)
+    # download & decompress in chunks to a temporary path, never left behind half written
+    tmp_path = savepath + '.part'
+    decompressor = bz2.BZ2Decompressor()
+    digest = hashlib.sha256()
+    try:
+        r = requests.get(url, allow_redirects=True, stream=True)
+        r.raise_for_status()
+        with open(tmp_path, 'wb') as wf:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                data = decompressor.decompress(chunk)
+                digest.update(data)
+                wf.write(data)
+        if not decompressor.eof:
+            raise IOError("Download of %s was cut off" % url)
+
+        sha256 = digest.hexdigest()
+        if expected_sha256 is not None and sha256 != expected_sha256:
+            raise IOError("Checksum mismatch for weights downloaded from %s" % url)
+
+        os.rename(tmp_path, savepath)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    with open(savepath + '.sha256', 'w') as f:
+        f.write(sha256)
 
     print("Downloaded and unpackaged weights to: %s" % savepath)
     return savepath
 
-WEIGHTS_2_PATH = {
-    'landmarks_5' : extract_dlib_weights(URL_WEIGHTS_5_FACE_LANDMARKS, savedir='weights'),
-    'landmarks_68' : extract_dlib_weights(URL_WEIGHTS_68_FACE_LANDMARKS, savedir='weights'),
-    'face_recognition' : extract_dlib_weights(URL_WEIGHTS_FACE_RECOGNITION, savedir='weights'),
-}
+def get_weights_path(name, savedir=None, allow_download=None):
+    """
+    Resolves the local path of the dlib weights `name` (a key of WEIGHTS_2_URL),
+    checking it against its checksum (see verify_dlib_weights) the first
+    time. Only downloads when `allow_download` (or EMOSAIC_DOWNLOAD_WEIGHTS=1)
+    says we may.
+    """
+    savedir = DEFAULT_WEIGHTS_DIR if savedir is None else savedir
+    if (name, savedir) in WEIGHTS_2_PATH:
+        return WEIGHTS_2_PATH[(name, savedir)]
+
+    allow_download = DEFAULT_ALLOW_DOWNLOAD if allow_download is None else allow_download
+    url = WEIGHTS_2_URL[name]
+    expected_sha256 = WEIGHTS_2_SHA256.get(name)
+    savepath = os.path.join(savedir, os.path.basename(url).replace('.bz2', ''))
+
+    if os.path.exists(savepath):
+        if not verify_dlib_weights(savepath, expected_sha256):
+            raise IOError("Checksum mismatch for dlib weights at %s" % savepath)
+    elif allow_download:
+        savepath = extract_dlib_weights(url, savedir=savedir, expected_sha256=expected_sha256)
+    else:
+        raise IOError(
+            "Missing dlib weights at %s. Download them from %s, or set "
+            "EMOSAIC_DOWNLOAD_WEIGHTS=1 to fetch them automatically." % (savepath, url))
+
+    WEIGHTS_2_PATH[(name, savedir)] = savepath
+    return savepath
 
 from imutils.face_utils.helpers import FACIAL_LANDMARKS_5_IDXS, FACIAL_LANDMARKS_68_IDXS
 
@@ -121,55 +210,256 @@ def generate_aligned_face(
     (w, h) = (desired_face_size, desired_face_size)
     return cv2.warpAffine(img, M, (w, h), flags=cv2.INTER_CUBIC) 
 
+def align_face_from_path(args):
+    """
+    @args: (path, downsize, keypoints, desired_left_eye_percs, desired_face_size)
+        where keypoints are in the coordinates of the image downsized by `downsize`
+
+    @return: aligned face as numpy arr, or None if it couldn't be aligned
+    """
+    path, downsize, keypoints, desired_left_eye_percs, desired_face_size = args
+    try:
+        img = cv2.imread(path)
+        resized = cv2.resize(img, None, fx=downsize, fy=downsize, interpolation=cv2.INTER_AREA)
+        return generate_aligned_face(
+            resized, None, keypoints,
+            desired_left_eye_percs=desired_left_eye_percs,
+            desired_face_size=desired_face_size)
+    except Exception as e:
+        print("Could not align face in '%s': %s" % (path, e))
+        return None
+
+# dlib models, loaded once per (worker) process
+FACE_MODELS = {}
+
+def load_face_models(landmarks_path, face_recognition_path):
+    import dlib
+
+    key = (landmarks_path, face_recognition_path)
+    if key not in FACE_MODELS:
+        FACE_MODELS[key] = (
+            dlib.get_frontal_face_detector(),
+            dlib.shape_predictor(landmarks_path),
+            dlib.face_recognition_model_v1(face_recognition_path),
+        )
+    return FACE_MODELS[key]
+
+def face_area(face):
+    left, top, right, bottom = face['rect']
+    return (right - left) * (bottom - top)
+
+def embed_faces_in_image(args):
+    """
+    @args: (path, downsize, face_detect_upsample_multiple, num_embedding_jitters,
+            landmarks_path, face_recognition_path)
+
+    @return: tuple (path, list of faces), where each face is a dict with 'rect',
+        'keypoints' and 'embedding' in the coordinates of the downsized image
+    """
+    import dlib
+
+    path, downsize, face_detect_upsample_multiple, num_embedding_jitters, \
+        landmarks_path, face_recognition_path = args
+    face_detector, keypoint_finder, face_embedder = load_face_models(
+        landmarks_path, face_recognition_path)
+
+    img = cv2.imread(path)
+    if img is None:
+        return path, []
+
+    # downsize 
+    resized = cv2.resize(img, None, fx=downsize, fy=downsize, interpolation=cv2.INTER_AREA)
+
+    # detect facial bounding boxes & their keypoints
+    rects = face_detector(resized, face_detect_upsample_multiple)
+    if not rects:
+        return path, []
+
+    shapes = dlib.full_object_detections()
+    for rect in rects:
+        shapes.append(keypoint_finder(resized, rect))
+
+    # embed every face in the photo in 128D with a single batched call
+    embeddings = face_embedder.compute_face_descriptor(resized, shapes, num_embedding_jitters)
+
+    faces = []
+    for rect, shape, embedding in zip(rects, shapes, embeddings):
+        faces.append(dict(
+            rect=(rect.left(), rect.top(), rect.right(), rect.bottom()),
+            keypoints=shape_to_np(shape),
+            embedding=np.array(embedding, dtype=np.float32),
+        ))
+    return path, faces
+
+def extract_library_embeddings(
+        paths,
+        downsize=0.25, 
+        face_detect_upsample_multiple=1, 
+        num_embedding_jitters=1,
+        verbose=0,
+        caching=True,
+        cache_dir=DEFAULT_CACHE_DIR,
+        nprocesses=None,
+        save_every=500,
+        weights_dir=None,
+        allow_download=None):
+    """
+    @param: weights_dir, allow_download where the dlib weights are & whether they may be
+            downloaded, see get_weights_path
+
+    @return: dict of {path: list of faces} for every path (see embed_faces_in_image)
+
+    Only files missing from the per-file EmbeddingsCacheConfig are decoded,
+    spread across a process pool, and appended to the cache as they finish.
+    """
+    from multiprocessing import Pool
+
+    cache = EmbeddingsCacheConfig(
+        downsize=downsize,
+        face_detect_upsample_multiple=face_detect_upsample_multiple,
+        num_embedding_jitters=num_embedding_jitters,
+        cache_dir=cache_dir)
+
+    path2faces = {}
+    todo = list(paths)
+    if caching:
+        records = cache.load()
+        path2faces = dict((p, records[p]) for p in paths if p in records)
+        todo = [p for p in paths if p not in records]
+
+    if verbose:
+        print("Embeddings: %d photos cached, %d to embed" % (len(path2faces), len(todo)))
+    if not todo:
+        return path2faces
+
+    # resolve weights in the parent so workers never need to download
+    landmarks_path = get_weights_path('landmarks_5', savedir=weights_dir, allow_download=allow_download)
+    face_recognition_path = get_weights_path('face_recognition', savedir=weights_dir, allow_download=allow_download)
+    jobs = [(p, downsize, face_detect_upsample_multiple, num_embedding_jitters,
+             landmarks_path, face_recognition_path) for p in todo]
+
+    pending = {}
+    pool = Pool(nprocesses)
+    try:
+        for path, faces in pool.imap_unordered(embed_faces_in_image, jobs, chunksize=4):
+            path2faces[path] = faces
+            pending[path] = faces
+            if caching and len(pending) >= save_every:
+                cache.save(pending)
+                pending = {}
+            if verbose and len(path2faces) % save_every == 0:
+                print("Embedded %d photos..." % len(path2faces))
+    finally:
+        pool.close()
+        pool.join()
+        if caching and pending:
+            cache.save(pending)
+
+    return path2faces
+
 def extract_embeddings(
         face_folder, 
         downsize=0.25, 
         face_detect_upsample_multiple=1, 
         num_embedding_jitters=1,
         verbose=0,
-        allow_single_face_per_photo=False):
+        allow_single_face_per_photo=False,
+        caching=True,
+        cache_dir=DEFAULT_CACHE_DIR,
+        nprocesses=None,
+        weights_dir=None,
+        allow_download=None):
     paths = glob.glob(os.path.join(face_folder, "*.jpg"))
-    
-    # load detector, keypoints, and face embedder
-    face_detector = dlib.get_frontal_face_detector()
-    keypoint_finder = dlib.shape_predictor(WEIGHTS_2_PATH['landmarks_5'])
-    face_embedder = dlib.face_recognition_model_v1(WEIGHTS_2_PATH['face_recognition'])
-    
+    paths.sort()
+    path2faces = extract_library_embeddings(
+        paths,
+        downsize=downsize,
+        face_detect_upsample_multiple=face_detect_upsample_multiple,
+        num_embedding_jitters=num_embedding_jitters,
+        verbose=verbose,
+        caching=caching,
+        cache_dir=cache_dir,
+        nprocesses=nprocesses,
+        weights_dir=weights_dir,
+        allow_download=allow_download)
+
     embeddings = []
     for path in paths:
-        if verbose:
-            print("Reading %s..." % path)
-        img = cv2.imread(path)
-
-        # downsize 
-        resized = cv2.resize(img, None, fx=downsize, fy=downsize, interpolation=cv2.INTER_AREA)
-
-        # detect facial bounding boxes, get one with largest area
-        rects = face_detector(resized, face_detect_upsample_multiple)
-        if rects:
-            if allow_single_face_per_photo:
-                rect = max(rects, key=lambda r: r.area())
-
-                # extract keypoints
-                keypoints = keypoint_finder(resized, rect)
-
-                # embed the face in 128D
-                embedding = face_embedder.compute_face_descriptor(resized, keypoints, num_embedding_jitters)
-                embeddings.append(embedding)
-            else:
-                for rect in rects:
-                    # extract keypoints
-                    keypoints = keypoint_finder(resized, rect)
-
-                    # embed the face in 128D
-                    embedding = face_embedder.compute_face_descriptor(resized, keypoints, num_embedding_jitters)
-                    embeddings.append(embedding)
-        else:
+        faces = path2faces[path]
+        if not faces:
             print("%s had no faces!" % path)
+            continue
+
+        # only keep the face with the largest area if asked
+        if allow_single_face_per_photo:
+            faces = [max(faces, key=face_area)]
+        embeddings.extend(face['embedding'] for face in faces)
     
     embedding_matrix = np.array(embeddings)
     return embedding_matrix
 
+def stack_library_faces(path2faces, paths):
+    """
+    @return: tuple (N x 128 float32 matrix of every face embedding, list of
+        (path, face) for each row), in the order of `paths`
+    """
+    embeddings, face_refs = [], []
+    for path in paths:
+        for face in path2faces.get(path, []):
+            embeddings.append(face['embedding'])
+            face_refs.append((path, face))
+    matrix = np.array(embeddings, dtype=np.float32).reshape(-1, 128)
+    return matrix, face_refs
+
+def linear_face_scores(clf, embeddings):
+    """
+    Decision function of a fitted linear classifier (eg: svm.SVC(kernel='linear'))
+    for every embedding at once; positive scores are the target face.
+    """
+    w = np.asarray(clf.coef_, dtype=np.float32).ravel()
+    b = float(np.ravel(clf.intercept_)[0])
+    return embeddings.dot(w) + b
+
+def nearest_centroid_scores(positive_embeddings, negative_embeddings, embeddings):
+    """
+    Distance to the negative centroid minus distance to the positive centroid,
+    so positive scores are closer to the target face.
+    """
+    positive_centroid = positive_embeddings.mean(axis=0)
+    negative_centroid = negative_embeddings.mean(axis=0)
+    to_positive = np.linalg.norm(embeddings - positive_centroid, axis=1)
+    to_negative = np.linalg.norm(embeddings - negative_centroid, axis=1)
+    return to_negative - to_positive
+
+def build_face_index(embeddings, index_class=None):
+    """
+    Faiss index over library face embeddings, row ids match `embeddings`.
+    """
+    if index_class is None:
+        import faiss
+        index_class = faiss.IndexFlatL2
+
+    index = index_class(embeddings.shape[1])
+    index.add(np.ascontiguousarray(embeddings, dtype=np.float32))
+    return index
+
+def search_face_index(index, query_embeddings, radius=0.6, k=None):
+    """
+    @param: radius (float) euclidean distance under which two faces are the same
+            person (0.6 is dlib's recommended threshold)
+    @param: k (int) if given, also cap each query to its k nearest faces
+
+    @return: sorted numpy array of the ids of every face matching any query
+    """
+    queries = np.ascontiguousarray(query_embeddings, dtype=np.float32)
+    if k is None:
+        # faiss works with squared L2 distances
+        _, _, ids = index.range_search(queries, radius ** 2)
+    else:
+        distances, ids = index.search(queries, k)
+        ids = ids[(distances <= radius ** 2) & (ids >= 0)]
+    return np.unique(ids)
+
 def compute_centroid(points):
     # points = (68, 2) array
     return points.mean(axis=0)
@@ -216,6 +506,10 @@ def rect_to_bb(rect):
 
 def shape_to_np(shape):
     # https://www.pyimagesearch.com/2017/04/03/facial-landmarks-dlib-opencv-python/
+    # keypoints that were already converted (eg: read from cache) pass through
+    if isinstance(shape, np.ndarray):
+        return shape
+
     # initialize the list of (x, y)-coordinates
     coords = np.zeros((shape.num_parts, 2), dtype=np.int64)
  
@@ -227,13 +521,19 @@ def shape_to_np(shape):
     # return the list of (x, y)-coordinates
     return coords
 
-def detect_faces_dlib(img, weights_path, downsize=0.25, upsample_multiple=1):
+def detect_faces_dlib(img, weights_path=None, downsize=0.25, upsample_multiple=1):
     """
     img: np.array of image
-    weights_path: path to dlib predictor weights path
+    weights_path: path to dlib predictor weights path, defaults to the 68
+        landmark predictor resolved by get_weights_path()
     downsize: how much to shrink image before detecting/predicting - this is 
         for performance (smaller => faster)
     """
+    import dlib
+
+    if weights_path is None:
+        weights_path = get_weights_path('landmarks_68')
+
     detector = dlib.get_frontal_face_detector()
     predictor = dlib.shape_predictor(weights_path)
 
@@ -0,0 +1,161 @@
+import numpy as np
+import cv2
+
+from emosaic.utils.cascade import mean_grid_projection
+
+"""
+What tiles are compared on. Codebook images (index_images) and target
+tiles (TileCandidates, mosaicify) are both shrunk to the match size and
+then go through the same feature extractor, picked by a short spec:
+
+    'raw'           BGR pixels, like to_vector (the default)
+    'lab'           Lab pixels, distances closer to how different colors look
+    'centered'      pixels minus the tile's mean color, matches ignore brightness &
+                    tint (pair with color correction when rendering, see TileCandidates.render)
+    'grid:4'        mean color over a 4x4 grid, tiny & fast but blurry
+    'histogram:8'   8 bin per channel color histogram, ignores layout entirely
+
+    extractor = get_feature_extractor('grid:4')
+    vectors = extractor.vectors(matrix, match_h, match_w, 3)
+
+New ones subclass FeatureExtractor and are added with
+@register_feature_extractor.
+"""
+
+FEATURE_EXTRACTORS = {}
+
+
+def register_feature_extractor(cls):
+    FEATURE_EXTRACTORS[cls.name] = cls
+    return cls
+
+def get_feature_extractor(spec=None):
+    """
+    @param: spec (String) like 'lab' or 'grid:4', a FeatureExtractor, or None for raw pixels
+    """
+    if isinstance(spec, FeatureExtractor):
+        return spec
+    if not spec:
+        spec = 'raw'
+    name, _, param = spec.partition(':')
+    if name not in FEATURE_EXTRACTORS:
+        raise ValueError("Unknown feature '%s', choose from: %s" % (name, ', '.join(sorted(FEATURE_EXTRACTORS))))
+    return FEATURE_EXTRACTORS[name](int(param) if param else None)
+
+
+class FeatureExtractor(object):
+    """
+    Turns a batch of tiles, already shrunk to the match size, into one
+    float32 vector each.
+    """
+    name = None
+    default_param = None
+
+    # vectors keep to_vector's pixel layout, which cascade indexes rely on
+    pixel_layout = False
+
+    # values stay within 0-255, so uint8 storage can hold them
+    nonnegative = True
+
+    def __init__(self, param=None):
+        self.param = self.default_param if param is None else param
+
+    @property
+    def spec(self):
+        return self.name if self.param is None else '%s:%d' % (self.name, self.param)
+
+    def dimensions(self, h, w, c):
+        raise NotImplementedError
+
+    def extract(self, tiles):
+        """
+        @param: tiles (numpy arr) N x h x w x c, pixel values 0-255
+
+        @return: N x dimensions array
+        """
+        raise NotImplementedError
+
+    def vectors(self, matrix, h, w, c):
+        """
+        @param: matrix (numpy arr) N x (h * w * c) pixel vectors, as from to_vector
+
+        @return: N x dimensions float32 matrix
+        """
+        tiles = np.asarray(matrix).reshape(-1, h, w, c)
+        return np.ascontiguousarray(self.extract(tiles), dtype=np.float32).reshape(len(tiles), -1)
+
+
+@register_feature_extractor
+class RawPixels(FeatureExtractor):
+    name = 'raw'
+    pixel_layout = True
+
+    def dimensions(self, h, w, c):
+        return h * w * c
+
+    def extract(self, tiles):
+        return tiles.reshape(len(tiles), -1)
+
+
+@register_feature_extractor
+class LabPixels(FeatureExtractor):
+    name = 'lab'
+    pixel_layout = True
+
+    def dimensions(self, h, w, c):
+        return h * w * c
+
+    def extract(self, tiles):
+        n, h, w, c = tiles.shape
+        # one conversion for the whole batch, stacked as a tall image
+        stacked = np.ascontiguousarray(tiles, dtype=np.uint8).reshape(n * h, w, c)
+        return cv2.cvtColor(stacked, cv2.COLOR_BGR2Lab).reshape(n, -1)
+
+
+@register_feature_extractor
+class CenteredPixels(FeatureExtractor):
+    name = 'centered'
+    pixel_layout = True
+    nonnegative = False
+
+    def dimensions(self, h, w, c):
+        return h * w * c
+
+    def extract(self, tiles):
+        tiles = tiles.astype(np.float32)
+        return (tiles - tiles.mean(axis=(1, 2), keepdims=True)).reshape(len(tiles), -1)
+
+
+@register_feature_extractor
+class GridMeans(FeatureExtractor):
+    name = 'grid'
+    default_param = 4
+
+    def dimensions(self, h, w, c):
+        return min(self.param, h) * min(self.param, w) * c
+
+    def extract(self, tiles):
+        n, h, w, c = tiles.shape
+        projection = mean_grid_projection(h, w, c, self.param, self.param, area_weighted=False)
+        return tiles.reshape(n, -1).astype(np.float32).dot(projection.T)
+
+
+@register_feature_extractor
+class ColorHistogram(FeatureExtractor):
+    name = 'histogram'
+    default_param = 8
+
+    def dimensions(self, h, w, c):
+        return self.param * c
+
+    def extract(self, tiles):
+        n, h, w, c = tiles.shape
+        bins = self.param
+        which = np.minimum(tiles.astype(np.int64) * bins // 256, bins - 1)
+
+        # every (tile, channel, bin) gets its own slot, so one bincount does the whole batch
+        slots = (np.arange(n)[:, None, None, None] * c + np.arange(c)) * bins + which
+        counts = np.bincount(slots.ravel(), minlength=n * c * bins).reshape(n, c * bins)
+
+        # fraction of pixels, on the same 0-255 scale as pixel features
+        return counts * (255. / (h * w))
@@ -4,15 +4,14 @@ import os
 import random
 import traceback
 from datetime import datetime
-import matplotlib.pyplot as plt
 
 import numpy as np
 import cv2
 import PIL.Image as pillow
-from sklearn.cluster import KMeans
 
 from emosaic.utils.exif import get_exif_lat_lon
 from emosaic.faces import detect_faces_dlib
+from emosaic.utils.alpha import to_bgra
 
 
 class Image(object):
@@ -21,7 +20,8 @@ class Image(object):
                 num_dominant_colors=3, 
                 dominant_color_subsample=0.1, 
                 compute_dominant_colors=False,
-                detect_faces=False):
+                detect_faces=False,
+                keep_alpha=False):
         
         # save some useful stuff
         self.path = path
@@ -29,6 +29,7 @@ class Image(object):
         self.num_dominant_colors = num_dominant_colors
         self.compute_dominant_colors = compute_dominant_colors
         self.detect_faces = detect_faces
+        self.keep_alpha = keep_alpha
         self.faces = []
         
         # load EXIF data
@@ -60,9 +61,14 @@ class Image(object):
             pass
         
     def load_image(self):
+        if self.keep_alpha:
+            # BGRA, opaque if the file has no alpha
+            return to_bgra(cv2.imread(self.path, cv2.IMREAD_UNCHANGED))
         return cv2.imread(self.path)  #, cv2.COLOR_BGR2Lab)
     
     def show_dominant_colors(self, img=None, dominant_color_width=300):
+        import matplotlib.pyplot as plt
+
         img = self.load_image() if img is None else img
         
          # plot dominant colors
@@ -86,6 +92,8 @@ class Image(object):
         plt.show()
     
     def show_color_histograms(self):
+        import matplotlib.pyplot as plt
+
         # plot color histograms
         colors = ('b', 'g', 'r')
         for i, c in enumerate(colors):
@@ -114,6 +122,8 @@ class Image(object):
             self.normalized_color_channel_histograms.append(hist / num_pixels)
             
     def compute_dominant_colors(self, img=None):
+        from sklearn.cluster import KMeans
+
         img = self.load_image() if img is None else img
         
         # subsample for performance
@@ -145,7 +155,7 @@ class Image(object):
             self.compute_dominant_colors(img)
 
         if self.detect_faces:
-            self.compute_face_detections(img)
+            self.compute_face_detections(img[:, :, :3])
 
         return img
 
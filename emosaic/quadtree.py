@@ -0,0 +1,134 @@
+import numpy as np
+import cv2
+
+"""
+Adaptive tiling: flat areas of the target (sky, walls) get big tiles and
+detailed ones (faces, edges) small ones, so a mosaic doesn't spend as many
+searches on a blue sky as on a face:
+
+    origin, cells = quadtree_cells(target_image, tile_h, tile_w, levels=3)
+    mosaic, ids = quadtree_mosaicify(target_image, origin, cells, level2codebook, tile_h, tile_w, 3)
+
+Level 0 tiles are the largest, 2 ** (levels - 1) times the smallest
+(tile_h, tile_w), and every level halves them.
+"""
+
+
+def level_tile_size(tile_h, tile_w, levels, level):
+    factor = 2 ** (levels - 1 - level)
+    return tile_h * factor, tile_w * factor
+
+def box_variance(integral, integral_sq, xs, ys, h, w):
+    """
+    Variance of every (h, w) box with top left corners (xs, ys), from
+    integral images (see cv2.integral2), in constant time per box.
+    """
+    n = float(h * w)
+    s = integral[xs + h, ys + w] - integral[xs, ys + w] - integral[xs + h, ys] + integral[xs, ys]
+    sq = integral_sq[xs + h, ys + w] - integral_sq[xs, ys + w] - integral_sq[xs + h, ys] + integral_sq[xs, ys]
+    return sq / n - (s / n) ** 2
+
+def intersects_any(xs, ys, h, w, rects):
+    """
+    @param: rects (list of tuples) (left, top, right, bottom) in pixels, e.g. face detections
+    """
+    hit = np.zeros(len(xs), dtype=bool)
+    for left, top, right, bottom in rects:
+        hit |= (xs < bottom) & (xs + h > top) & (ys < right) & (ys + w > left)
+    return hit
+
+def quadtree_cells(target_image, tile_h, tile_w, levels=3, variance_threshold=300., detail_rects=None):
+    """
+    Starts from a grid of the largest tiles and splits every cell into
+    four while its grayscale variance is above `variance_threshold` (or it
+    overlaps one of `detail_rects`), down to (tile_h, tile_w).
+
+    @param: tile_h, tile_w (int) smallest tile size
+    @param: levels (int) number of tile sizes
+    @param: variance_threshold (float) grayscale variance above which cells are split
+    @param: detail_rects (list of tuples) (left, top, right, bottom) regions always given the smallest tiles
+
+    @return: tuple ((x0, y0) origin of the tiled area, N x 3 int array of cells (x, y, level))
+    """
+    big_h, big_w = level_tile_size(tile_h, tile_w, levels, 0)
+    height, width = target_image.shape[:2]
+    rows, cols = height // big_h, width // big_w
+    if not rows or not cols:
+        raise ValueError("Target is smaller than one %dx%d tile" % (big_h, big_w))
+    x0, y0 = (height % big_h) // 2, (width % big_w) // 2
+
+    gray = cv2.cvtColor(target_image, cv2.COLOR_BGR2GRAY)
+    integral, integral_sq = cv2.integral2(gray, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+
+    grid_x, grid_y = np.meshgrid(np.arange(rows) * big_h + x0, np.arange(cols) * big_w + y0, indexing='ij')
+    xs, ys = grid_x.ravel(), grid_y.ravel()
+
+    cells = []
+    for level in range(levels):
+        h, w = level_tile_size(tile_h, tile_w, levels, level)
+        if level == levels - 1:
+            split = np.zeros(len(xs), dtype=bool)
+        else:
+            split = box_variance(integral, integral_sq, xs, ys, h, w) > variance_threshold
+            if detail_rects:
+                split |= intersects_any(xs, ys, h, w, detail_rects)
+
+        keep = ~split
+        cells.append(np.stack([xs[keep], ys[keep], np.full(keep.sum(), level)], axis=1))
+
+        # children of the split cells, in reading order
+        xs, ys = xs[split], ys[split]
+        hh, hw = h // 2, w // 2
+        xs = np.stack([xs, xs, xs + hh, xs + hh], axis=1).ravel()
+        ys = np.stack([ys, ys + hw, ys, ys + hw], axis=1).ravel()
+
+    return (x0, y0), np.concatenate(cells).astype(np.int64)
+
+def level_queries(region, cells, origin, h, w, match_size):
+    """
+    Vectors for cells of one size, by shrinking the whole tiled area once
+    so every (h, w) cell becomes a match_size block.
+    """
+    match_h, match_w = match_size
+    rows, cols = region.shape[0] // h, region.shape[1] // w
+    small = cv2.resize(region[: rows * h, : cols * w], (cols * match_w, rows * match_h), interpolation=cv2.INTER_AREA)
+    grid = small.reshape(rows, match_h, cols, match_w, -1).swapaxes(1, 2).reshape(rows, cols, -1)
+    r, c = (cells[:, 0] - origin[0]) // h, (cells[:, 1] - origin[1]) // w
+    return grid[r, c].astype(np.float32)
+
+def quadtree_mosaicify(target_image, origin, cells, level2codebook, tile_h, tile_w, levels, opacity=0.0):
+    """
+    @param: origin, cells from quadtree_cells()
+    @param: level2codebook (dict) of level => (tile_index, tile_images, match_size), with
+            tile_images at that level's tile size
+    @param: tile_h, tile_w (int) smallest tile size
+    @param: levels (int) as given to quadtree_cells()
+
+    @return: tuple (uint8 mosaic of the tiled area, array of codebook ids per cell)
+    """
+    big_h, big_w = level_tile_size(tile_h, tile_w, levels, 0)
+    height, width = target_image.shape[:2]
+    x0, y0 = origin
+    region = target_image[x0 : x0 + (height // big_h) * big_h, y0 : y0 + (width // big_w) * big_w]
+
+    mosaic = np.zeros(region.shape, dtype=np.uint8)
+    ids = np.full(len(cells), -1, dtype=np.int64)
+    for level in range(levels):
+        sel = np.flatnonzero(cells[:, 2] == level)
+        if not len(sel):
+            continue
+
+        # one batched search per tile size
+        h, w = level_tile_size(tile_h, tile_w, levels, level)
+        tile_index, tile_images, match_size = level2codebook[level]
+        queries = level_queries(region, cells[sel], origin, h, w, match_size)
+        _, found = tile_index.search(queries, 1)
+        ids[sel] = found[:, 0]
+
+        for (x, y, _), tile_id in zip(cells[sel], found[:, 0]):
+            if tile_id >= 0:
+                mosaic[x - x0 : x - x0 + h, y - y0 : y - y0 + w] = tile_images[tile_id]
+
+    if opacity > 0:
+        mosaic = cv2.addWeighted(region, opacity, mosaic, 1 - opacity, 0)
+    return mosaic, ids
@@ -0,0 +1,92 @@
+import numpy as np
+import cv2
+
+from emosaic.features import get_feature_extractor
+
+
+class TargetIntegral(object):
+    """
+    Integral image of a target, built once and shared by every scale:
+
+        integral = TargetIntegral(target_image)
+        matrix, grid_shape, origin = integral.grid_vectors(tile_h, tile_w, match_size=(4, 3))
+
+    The mean of any box, even with fractional edges, is a few lookups
+    into the integral image (it's bilinear within each pixel), which is
+    exactly what an INTER_AREA shrink computes. So query vectors for any
+    tile grid & match size come without resizing the target again.
+    """
+    def __init__(self, target_image):
+        self.image = target_image
+        self.shape = target_image.shape
+        # float64 so sums over big targets stay exact
+        self.integral = cv2.integral(target_image, sdepth=cv2.CV_64F).reshape(
+            self.shape[0] + 1, self.shape[1] + 1, -1)
+
+    def _interpolate(self, x_edges, y_edges):
+        """
+        Integral at fractional (x, y) positions, for every pair of edges.
+        """
+        def split(edges, size):
+            i = np.minimum(np.floor(edges).astype(np.int64), size - 1)
+            return i, (edges - i)
+
+        (ix, ax), (iy, ay) = split(x_edges, self.shape[0]), split(y_edges, self.shape[1])
+
+        # separable: interpolate whole rows first, then columns of the (much smaller) result
+        rows = np.take(self.integral, ix, axis=0)
+        if ax.any():
+            ax = ax[:, None, None]
+            rows = rows * (1 - ax) + np.take(self.integral, ix + 1, axis=0) * ax
+        s = np.take(rows, iy, axis=1)
+        if ay.any():
+            ay = ay[None, :, None]
+            s = s * (1 - ay) + np.take(rows, iy + 1, axis=1) * ay
+        return s
+
+    def box_means(self, x_edges, y_edges):
+        """
+        @param: x_edges, y_edges (float arrays) increasing box boundaries in pixels
+
+        @return: (len(x_edges) - 1) x (len(y_edges) - 1) x channels float64 array of box means
+        """
+        x_edges = np.asarray(x_edges, dtype=np.float64)
+        y_edges = np.asarray(y_edges, dtype=np.float64)
+        s = self._interpolate(x_edges, y_edges)
+        sums = s[1:, 1:] - s[:-1, 1:] - s[1:, :-1] + s[:-1, :-1]
+        areas = np.diff(x_edges)[:, None] * np.diff(y_edges)[None, :]
+        return sums / areas[:, :, None]
+
+    def grid_means(self, tile_h, tile_w, match_size=None):
+        """
+        The target's tile grid (same layout as `divide_image_rectangularly`)
+        with every tile shrunk to match_size, as one uint8 image.
+
+        @return: tuple (rows * match_h x cols * match_w x channels uint8 array, (rows, cols), (x0, y0))
+        """
+        height, width = self.shape[:2]
+        rows, cols = height // tile_h, width // tile_w
+        x0, y0 = (height % tile_h) // 2, (width % tile_w) // 2
+        match_h, match_w = match_size or (tile_h, tile_w)
+
+        if (match_h, match_w) == (tile_h, tile_w):
+            means = self.image[x0 : x0 + rows * tile_h, y0 : y0 + cols * tile_w]
+        else:
+            x_edges = x0 + np.arange(rows * match_h + 1) * (tile_h / float(match_h))
+            y_edges = y0 + np.arange(cols * match_w + 1) * (tile_w / float(match_w))
+            means = np.rint(self.box_means(x_edges, y_edges)).astype(np.uint8)
+        return means, (rows, cols), (x0, y0)
+
+    def grid_vectors(self, tile_h, tile_w, match_size=None, feature=None):
+        """
+        Same as `emosaic.candidates.grid_vectors`, without touching the target.
+
+        @return: tuple (N x (match_h * match_w * c) float32 matrix, (rows, cols), (x0, y0))
+        """
+        means, (rows, cols), origin = self.grid_means(tile_h, tile_w, match_size=match_size)
+        match_h, match_w = means.shape[0] // rows, means.shape[1] // cols
+        tiles = means.reshape(rows, match_h, cols, match_w, -1).swapaxes(1, 2)
+        matrix = tiles.reshape(rows * cols, -1).astype(np.float32)
+        if feature is not None:
+            matrix = get_feature_extractor(feature).vectors(matrix, match_h, match_w, means.shape[2])
+        return matrix, (rows, cols), origin
@@ -0,0 +1,111 @@
+import os
+
+import cv2
+import numpy as np
+import faiss
+
+from emosaic.assignment import MosaicAssignment, assignment_path_for
+from emosaic.candidates import TileCandidates
+from emosaic.utils.image import to_vector
+
+
+def _make_codebook(tmp_path, h, w, n=12):
+  rng = np.random.RandomState(0)
+  paths, tile_images = [], []
+  for i in range(n):
+    path = str(tmp_path / ('%02d.png' % i))
+    cv2.imwrite(path, np.full((h * 2, w * 2, 3), rng.randint(0, 256, 3), dtype=np.uint8))
+    paths.append(path)
+    tile_images.append(cv2.resize(cv2.imread(path), (w, h), interpolation=cv2.INTER_AREA))
+  matrix = np.vstack([to_vector(tile, h, w) for tile in tile_images])
+  index = faiss.IndexFlatL2(matrix.shape[1])
+  index.add(matrix)
+  return paths, index, tile_images
+
+def test_assignment_round_trip_and_rerender(tmp_path):
+  paths, index, tile_images = _make_codebook(tmp_path, 8, 6)
+  target = (np.random.RandomState(1).rand(80, 60, 3) * 255).astype(np.uint8)
+  candidates = TileCandidates.search(target, 8, 6, index, k=4)
+  ids = candidates.select(randomness=0.3, num_images=len(paths), seed=0)
+
+  savepath = assignment_path_for(str(tmp_path / 'mosaic-8.jpg'))
+  assert savepath.endswith('mosaic-8.jpg.assignment.npz')
+  # other formats of the same mosaic don't overwrite it
+  assert assignment_path_for(str(tmp_path / 'mosaic-8.tif')) != savepath
+  MosaicAssignment.from_candidates(candidates, ids, paths, opacity=0.0, best_k=1).save(savepath)
+  assignment = MosaicAssignment.load(savepath)
+
+  assert assignment.grid_shape == candidates.grid_shape
+  assert np.all(assignment.ids == ids)
+  assert assignment.params['best_k'] == 1
+  assert np.isnan(assignment.distances).any()
+  assert assignment.changed_paths() == []
+
+  # same tile size reproduces the mosaic, any other size scales it
+  assert np.all(assignment.render(8, 6) == candidates.render(tile_images, ids))
+  assert assignment.render(32, 24).shape == (10 * 32, 10 * 24, 3)
+
+  os.remove(paths[0])
+  assert assignment.changed_paths() == [paths[0]]
+
+def test_exclude_redraws_only_affected_cells(tmp_path):
+  paths, index, tile_images = _make_codebook(tmp_path, 8, 6)
+  target = (np.random.RandomState(2).rand(80, 60, 3) * 255).astype(np.uint8)
+  candidates = TileCandidates.search(target, 8, 6, index, k=2)
+  assignment = MosaicAssignment.from_candidates(candidates, candidates.select(), paths, opacity=0.25)
+  before = assignment.ids.copy()
+  mosaic = assignment.render(16, 12, target_image=target)
+
+  # the two most used photos, so some cells run out of cached candidates
+  used, counts = np.unique(before, return_counts=True)
+  gone = [paths[i] for i in used[np.argsort(-counts)[:2]]]
+  cells = assignment.exclude(gone, index, target)
+
+  assert set(cells) == set(np.flatnonzero(np.isin(before, [paths.index(p) for p in gone])))
+  assert not np.isin(assignment.ids, [paths.index(p) for p in gone]).any()
+  assert assignment.params['excluded'] == sorted(gone)
+
+  # the masked search agrees with a full search over the remaining photos
+  keep = [i for i in range(len(paths)) if paths[i] not in gone]
+  full = TileCandidates.search(target, 8, 6, index, k=len(paths)).select(exclude=[paths.index(p) for p in gone])
+  assert np.all(assignment.ids == full)
+
+  patched = assignment.patch(mosaic.copy(), cells, target_image=target)
+  expected = assignment.render(16, 12, target_image=target)
+  assert np.all(patched == expected)
+
+def test_exclude_keeps_use_limits(tmp_path):
+  paths, index, tile_images = _make_codebook(tmp_path, 8, 6, n=30)
+  target = (np.random.RandomState(3).rand(80, 60, 3) * 255).astype(np.uint8)
+  candidates = TileCandidates.search(target, 8, 6, index, k=8)
+  ids, report = candidates.select_constrained(max_uses=5, min_distance=2, tile_index=index, target_image=target)
+  assert report['relaxed'] == 0
+  assignment = MosaicAssignment.from_candidates(candidates, ids, paths, max_uses=5, min_repeat_distance=2)
+  before = assignment.ids.copy()
+
+  used, counts = np.unique(before, return_counts=True)
+  gone = [paths[i] for i in used[np.argsort(-counts)[:3]]]
+  cells = assignment.exclude(gone, index, target)
+  assert len(cells) and np.all(np.delete(assignment.ids, cells) == np.delete(before, cells))
+  assert not np.isin(assignment.ids, [paths.index(p) for p in gone]).any()
+
+  # every photo at most 5 times, & never next to itself
+  assert np.bincount(assignment.ids).max() <= 5
+  grid = assignment.ids.reshape(assignment.grid_shape)
+  assert not (grid[1:, :] == grid[:-1, :]).any() and not (grid[:, 1:] == grid[:, :-1]).any()
+  assert not (grid[1:, 1:] == grid[:-1, :-1]).any() and not (grid[1:, :-1] == grid[:-1, 1:]).any()
+
+def test_banded_writes_match_render(tmp_path):
+  paths, index, tile_images = _make_codebook(tmp_path, 8, 6)
+  target = (np.random.RandomState(3).rand(80, 60, 3) * 255).astype(np.uint8)
+  candidates = TileCandidates.search(target, 8, 6, index, k=2)
+  assignment = MosaicAssignment.from_candidates(candidates, candidates.select(), paths, opacity=0.3)
+  expected = assignment.render(12, 9, target_image=target)
+
+  npy = str(tmp_path / 'big.npy')
+  assignment.write(npy, 12, 9, band_rows=3, target_image=target, max_cached_tiles=2)
+  assert np.all(np.load(npy, mmap_mode='r') == expected)
+
+  tif = str(tmp_path / 'big.tif')
+  assert assignment.write(tif, 12, 9, band_rows=4, target_image=target) == expected.shape[:2]
+  assert np.all(cv2.imread(tif) == expected)
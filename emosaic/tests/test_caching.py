@@ -0,0 +1,88 @@
+import os
+import shutil
+
+import numpy as np
+
+from emosaic.caching import EmbeddingsCacheConfig
+from emosaic.faces import extract_embeddings
+
+
+CACHE_DIR = '/tmp/emosaic-test-cache'
+PHOTOS_DIR = '/tmp/emosaic-test-photos'
+
+def setup_function(function):
+  for directory in (CACHE_DIR, PHOTOS_DIR):
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+
+def teardown_function(function):
+  for directory in (CACHE_DIR, PHOTOS_DIR):
+    shutil.rmtree(directory, ignore_errors=True)
+
+def _make_photo(name):
+  path = os.path.join(PHOTOS_DIR, name)
+  with open(path, 'wb') as f:
+    f.write(b'not really a jpg')
+  return path
+
+def _make_face(rect, value):
+  return dict(rect=rect, keypoints=np.zeros((5, 2)), embedding=np.full(128, value, dtype=np.float32))
+
+def test_embeddings_cache_is_per_file_and_incremental():
+  a, b = _make_photo('a.jpg'), _make_photo('b.jpg')
+  cache = EmbeddingsCacheConfig(0.25, 1, 1, cache_dir=CACHE_DIR)
+  assert cache.missing([a, b]) == [a, b]
+
+  cache.save({a: [_make_face((0, 0, 10, 10), 1.0)]})
+  cache.save({b: []})
+
+  # a fresh config reads every appended chunk back
+  reloaded = EmbeddingsCacheConfig(0.25, 1, 1, cache_dir=CACHE_DIR)
+  assert reloaded.missing([a, b]) == []
+  assert len(reloaded.load()[a]) == 1
+  assert reloaded.load()[b] == []
+
+  # different settings never share entries
+  other = EmbeddingsCacheConfig(0.5, 1, 1, cache_dir=CACHE_DIR)
+  assert other.missing([a, b]) == [a, b]
+
+def test_embeddings_cache_invalidates_changed_files():
+  a = _make_photo('a.jpg')
+  cache = EmbeddingsCacheConfig(0.25, 1, 1, cache_dir=CACHE_DIR)
+  cache.save({a: []})
+
+  with open(a, 'ab') as f:
+    f.write(b' but longer now')
+  reloaded = EmbeddingsCacheConfig(0.25, 1, 1, cache_dir=CACHE_DIR)
+  assert reloaded.missing([a]) == [a]
+
+def test_extract_embeddings_reads_from_cache():
+  a = _make_photo('a.jpg')
+  cache = EmbeddingsCacheConfig(0.25, 1, 1, cache_dir=CACHE_DIR)
+  cache.save({a: [_make_face((0, 0, 10, 10), 1.0), _make_face((0, 0, 20, 20), 2.0)]})
+
+  everyone = extract_embeddings(PHOTOS_DIR, downsize=0.25, cache_dir=CACHE_DIR)
+  assert everyone.shape == (2, 128)
+
+  largest = extract_embeddings(
+    PHOTOS_DIR, downsize=0.25, allow_single_face_per_photo=True, cache_dir=CACHE_DIR)
+  assert largest.shape == (1, 128)
+  assert np.all(largest == 2.0)
+
+def test_embeddings_cache_is_compacted():
+  a, b = _make_photo('a.jpg'), _make_photo('b.jpg')
+  cache = EmbeddingsCacheConfig(0.25, 1, 1, cache_dir=CACHE_DIR)
+  cache.save({b: []})
+  # re-embedding the same photo leaves superseded entries behind
+  for value in range(5):
+    cache.save({a: [_make_face((0, 0, 10, 10), float(value))]})
+  grown = os.path.getsize(cache.savepath)
+
+  reloaded = EmbeddingsCacheConfig(0.25, 1, 1, cache_dir=CACHE_DIR)
+  assert reloaded.load()[a][0]['embedding'][0] == 4.0
+  assert os.path.getsize(reloaded.savepath) < grown
+
+  # & nothing live was lost
+  again = EmbeddingsCacheConfig(0.25, 1, 1, cache_dir=CACHE_DIR)
+  assert again.missing([a, b]) == []
+  assert again.load()[a][0]['embedding'][0] == 4.0
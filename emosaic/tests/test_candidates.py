@@ -0,0 +1,92 @@
+import cv2
+import numpy as np
+import faiss
+
+from emosaic import mosaicify
+from emosaic.candidates import TileCandidates
+from emosaic.utils.image import to_vector
+
+
+def _make_codebook(h, w, n=30, seed=0):
+  rng = np.random.RandomState(seed)
+  tile_images = [np.full((h, w, 3), rng.randint(0, 256, 3), dtype=np.uint8) for _ in range(n)]
+  matrix = np.vstack([to_vector(tile, h, w) for tile in tile_images])
+  index = faiss.IndexFlatL2(matrix.shape[1])
+  index.add(matrix)
+  return index, tile_images
+
+def _setup():
+  target = (np.random.RandomState(1).rand(125, 95, 3) * 255).astype(np.uint8)
+  index, tile_images = _make_codebook(8, 6)
+  return target, index, tile_images, TileCandidates.search(target, 8, 6, index, k=5)
+
+def test_best_match_render_equals_mosaicify():
+  target, index, tile_images, candidates = _setup()
+  for opacity, trim in [(0.0, True), (0.3, True), (0.3, False)]:
+    expected, rect_starts, _ = mosaicify(target, 8, 6, index, tile_images, opacity=opacity, trim=trim)
+    mosaic = candidates.render(tile_images, candidates.select(), target, opacity=opacity, trim=trim)
+    assert candidates.rect_starts == rect_starts
+    assert mosaic.shape == expected.shape
+    assert np.abs(mosaic.astype(int) - expected.astype(int)).max() <= 1
+
+def test_select_is_seeded_and_respects_exclusions():
+  _, _, tile_images, candidates = _setup()
+  a = candidates.select(best_k=3, uniform_k=False, randomness=0.2, num_images=len(tile_images), seed=7)
+  b = candidates.select(best_k=3, uniform_k=False, randomness=0.2, num_images=len(tile_images), seed=7)
+  assert np.all(a == b)
+
+  exclude = set(candidates.select()[:10])
+  ids = candidates.select(best_k=2, exclude=exclude, randomness=0.5, num_images=len(tile_images), seed=0)
+  assert not np.isin(ids, list(exclude)).any()
+
+  # top choices among the first best_k usable candidates only
+  ids = candidates.select(best_k=2, seed=0)
+  assert np.all((ids == candidates.ids[:, 0]) | (ids == candidates.ids[:, 1]))
+
+def test_random_tiles_dont_repeat_until_codebook_runs_out():
+  _, _, tile_images, candidates = _setup()
+  ids = candidates.select(randomness=1.0, num_images=len(tile_images), seed=0)
+  assert len(set(ids[:len(tile_images)])) == len(tile_images)
+
+def test_small_match_size_with_big_render_tiles():
+  target = (np.random.RandomState(4).rand(125, 95, 3) * 255).astype(np.uint8)
+  rng = np.random.RandomState(5)
+  big_tiles = [np.full((16, 12, 3), rng.randint(0, 256, 3), dtype=np.uint8) for _ in range(20)]
+  matrix = np.vstack([to_vector(tile, 4, 3) for tile in big_tiles])
+  index = faiss.IndexFlatL2(matrix.shape[1])
+  index.add(matrix)
+
+  # matching on 4x3 vectors of 8x6 target cells agrees with mosaicify
+  candidates = TileCandidates.search(target, 8, 6, index, k=3, match_size=(4, 3))
+  small_tiles = [tile[::2, ::2] for tile in big_tiles]
+  expected, _, _ = mosaicify(target, 8, 6, index, [cv2.resize(t, (6, 8)) for t in small_tiles], match_size=(4, 3))
+  ids = candidates.select()
+  assert np.all(candidates.render([cv2.resize(t, (6, 8)) for t in small_tiles], ids) == expected)
+
+  # while pasting 16x12 tiles makes a mosaic twice the size
+  mosaic = candidates.render(big_tiles, ids, target, opacity=0.2)
+  assert mosaic.shape == (2 * expected.shape[0], 2 * expected.shape[1], 3)
+
+def test_mosaicify_selection_is_seeded():
+  target, index, tile_images, candidates = _setup()
+  for kwargs in [dict(best_k=3), dict(best_k=3, uniform_k=False), dict(randomness=0.3)]:
+    a, _, _ = mosaicify(target, 8, 6, index, tile_images, seed=3, **kwargs)
+    b, _, _ = mosaicify(target, 8, 6, index, tile_images, seed=3, **kwargs)
+    assert np.array_equal(a, b)
+
+def test_constrained_selection_caps_uses_and_spaces_repeats():
+  target, index, tile_images, candidates = _setup()
+  rows, cols = candidates.grid_shape
+  ids, report = candidates.select_constrained(max_uses=8, min_distance=3, tile_index=index, target_image=target)
+  assert report['relaxed'] == 0 and report['gap'] >= 0
+  assert np.bincount(ids).max() <= 8
+
+  grid = ids.reshape(rows, cols)
+  for r in range(rows):
+    for c in range(cols):
+      window = grid[max(0, r - 2) : r + 3, max(0, c - 2) : c + 3]
+      assert (window == grid[r, c]).sum() == 1
+
+  # without constraints it's just the best matches
+  ids, report = candidates.select_constrained()
+  assert np.all(ids == candidates.ids[:, 0]) and report['gap'] == 0
@@ -0,0 +1,16 @@
+import subprocess
+import sys
+
+
+HEAVY_MODULES = ['faiss', 'dlib', 'moviepy', 'sklearn', 'matplotlib']
+
+def test_cli_startup_skips_heavy_imports():
+  # use a fresh interpreter so modules imported by other tests don't leak in
+  code = (
+    "import sys\n"
+    "from emosaic.cli import build_parser\n"
+    "build_parser().parse_args(['index', '--codebook-dir', 'x', '--scale', '1'])\n"
+    "print(','.join(m for m in %r if m in sys.modules))\n" % HEAVY_MODULES
+  )
+  out = subprocess.check_output([sys.executable, '-c', code])
+  assert out.decode().strip() == ''
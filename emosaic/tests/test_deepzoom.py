@@ -0,0 +1,43 @@
+import os
+
+import cv2
+import numpy as np
+
+from emosaic.assignment import MosaicAssignment
+from emosaic.deepzoom import write_deep_zoom, num_levels
+
+
+def _make_assignment(tmp_path, rows=6, cols=5, n=8):
+  rng = np.random.RandomState(0)
+  paths = []
+  for i in range(n):
+    path = str(tmp_path / ('%02d.png' % i))
+    cv2.imwrite(path, (rng.rand(40, 30, 3) * 255).astype(np.uint8))
+    paths.append(path)
+  ids = rng.randint(0, n, rows * cols)
+  params = dict(tile_h=8, tile_w=6, origin=[0, 0], target_shape=[rows * 8, cols * 6, 3])
+  return MosaicAssignment((rows, cols), ids, np.zeros(rows * cols), paths, [(0, 0)] * n, params)
+
+def test_deep_zoom_pyramid(tmp_path):
+  assignment = _make_assignment(tmp_path)
+  savepath = str(tmp_path / 'poster.dzi')
+  height, width = write_deep_zoom(assignment, savepath, 20, 15, tile_size=32, overlap=1, fmt='png', nprocesses=2)
+  assert (height, width) == (120, 75)
+
+  with open(savepath) as f:
+    dzi = f.read()
+  assert 'TileSize="32"' in dzi and 'Width="75" Height="120"' in dzi
+
+  files_dir = str(tmp_path / 'poster_files')
+  max_level = num_levels(height, width) - 1
+  assert sorted(int(d) for d in os.listdir(files_dir)) == list(range(max_level + 1))
+  assert cv2.imread(os.path.join(files_dir, '0', '0_0.png')).shape == (1, 1, 3)
+
+  # full resolution level stitches back into the plain render
+  expected = assignment.render(20, 15)
+  top = os.path.join(files_dir, str(max_level))
+  for name in os.listdir(top):
+    col, row = [int(v) for v in name.split('.')[0].split('_')]
+    x0, y0 = max(0, row * 32 - 1), max(0, col * 32 - 1)
+    tile = cv2.imread(os.path.join(top, name))
+    assert np.all(tile == expected[x0 : x0 + tile.shape[0], y0 : y0 + tile.shape[1]])
@@ -0,0 +1,121 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+from emosaic import faces
+
+
+WEIGHTS_DIR = '/tmp/emosaic-test-weights'
+
+def setup_function(function):
+  faces.WEIGHTS_2_PATH.clear()
+  shutil.rmtree(WEIGHTS_DIR, ignore_errors=True)
+  os.makedirs(WEIGHTS_DIR)
+
+def teardown_function(function):
+  faces.WEIGHTS_2_PATH.clear()
+  shutil.rmtree(WEIGHTS_DIR, ignore_errors=True)
+
+def _write_weights(name, content):
+  savename = os.path.basename(faces.WEIGHTS_2_URL[name]).replace('.bz2', '')
+  savepath = os.path.join(WEIGHTS_DIR, savename)
+  with open(savepath, 'wb') as f:
+    f.write(content)
+  return savepath
+
+def test_missing_weights_never_downloads():
+  with pytest.raises(IOError):
+    faces.get_weights_path('landmarks_5', savedir=WEIGHTS_DIR, allow_download=False)
+  assert ('landmarks_5', WEIGHTS_DIR) not in faces.WEIGHTS_2_PATH
+
+def test_local_weights_are_resolved_and_memoized():
+  savepath = _write_weights('landmarks_5', b'weights')
+  assert faces.get_weights_path('landmarks_5', savedir=WEIGHTS_DIR) == savepath
+  assert faces.WEIGHTS_2_PATH[('landmarks_5', WEIGHTS_DIR)] == savepath
+
+  # another directory isn't answered from the memo of the first
+  with pytest.raises(IOError):
+    faces.get_weights_path('landmarks_5', savedir=WEIGHTS_DIR + '-other', allow_download=False)
+
+def test_failed_download_leaves_no_partial_file(monkeypatch):
+  import bz2
+  import requests
+
+  class Truncated(object):
+    def raise_for_status(self):
+      pass
+    def iter_content(self, chunk_size):
+      yield bz2.compress(b'weights' * 1000)[:50]
+      raise IOError("connection reset")
+
+  monkeypatch.setattr(requests, 'get', lambda *args, **kwargs: Truncated())
+  with pytest.raises(IOError):
+    faces.extract_dlib_weights(faces.WEIGHTS_2_URL['landmarks_5'], savedir=WEIGHTS_DIR)
+  assert os.listdir(WEIGHTS_DIR) == []
+
+def test_checksum_sidecar_is_verified():
+  savepath = _write_weights('landmarks_5', b'weights')
+  with open(savepath + '.sha256', 'w') as f:
+    f.write(faces.sha256_of_file(savepath))
+  assert faces.verify_dlib_weights(savepath)
+
+  # corrupt the weights after the checksum was recorded
+  _write_weights('landmarks_5', b'corrupted')
+  assert not faces.verify_dlib_weights(savepath)
+  with pytest.raises(IOError):
+    faces.get_weights_path('landmarks_5', savedir=WEIGHTS_DIR)
+
+def test_cut_off_download_is_rejected(monkeypatch):
+  import bz2
+  import requests
+
+  class CutOff(object):
+    def raise_for_status(self):
+      pass
+    def iter_content(self, chunk_size):
+      # a valid start of the stream, then the connection just ends
+      yield bz2.compress(b'weights' * 1000)[:-20]
+
+  monkeypatch.setattr(requests, 'get', lambda *args, **kwargs: CutOff())
+  with pytest.raises(IOError):
+    faces.extract_dlib_weights(faces.WEIGHTS_2_URL['landmarks_5'], savedir=WEIGHTS_DIR)
+  assert os.listdir(WEIGHTS_DIR) == []
+
+def _fake_embed(job):
+  # stands in for dlib, reports which weights the worker was handed
+  path, _, _, _, landmarks_path, face_recognition_path = job
+  return path, [dict(weights=(landmarks_path, face_recognition_path))]
+
+def test_library_embeddings_use_the_weights_dir(monkeypatch):
+  landmarks = _write_weights('landmarks_5', b'weights')
+  face_recognition = _write_weights('face_recognition', b'weights')
+  monkeypatch.setattr(faces, 'embed_faces_in_image', _fake_embed)
+
+  path2faces = faces.extract_library_embeddings(
+    ['a.jpg'], caching=False, nprocesses=1, weights_dir=WEIGHTS_DIR, allow_download=False)
+  assert path2faces['a.jpg'][0]['weights'] == (landmarks, face_recognition)
+
+def test_linear_face_scores_match_decision_function():
+  from sklearn import svm
+
+  rng = np.random.RandomState(0)
+  X = np.vstack((rng.normal(1, 0.1, (20, 128)), rng.normal(-1, 0.1, (20, 128)))).astype(np.float32)
+  y = np.array([1] * 20 + [0] * 20)
+  clf = svm.SVC(kernel='linear', C=1).fit(X, y)
+
+  queries = rng.normal(0, 1, (50, 128)).astype(np.float32)
+  scores = faces.linear_face_scores(clf, queries)
+  assert np.allclose(scores, clf.decision_function(queries), atol=1e-3)
+  assert np.all((scores > 0) == clf.predict(queries).astype(bool))
+
+def test_face_index_finds_faces_within_radius():
+  rng = np.random.RandomState(0)
+  library = rng.normal(0, 1, (100, 128)).astype(np.float32)
+  target = library[[3, 42]]
+  library[7] = target[0] + 0.01
+
+  index = faces.build_face_index(library)
+  assert list(faces.search_face_index(index, target, radius=0.6)) == [3, 7, 42]
+  assert list(faces.search_face_index(index, target, radius=0.6, k=2)) == [3, 7, 42]
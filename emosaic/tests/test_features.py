@@ -0,0 +1,66 @@
+import cv2
+import numpy as np
+import faiss
+import pytest
+
+from emosaic import mosaicify
+from emosaic.features import get_feature_extractor, FEATURE_EXTRACTORS
+from emosaic.utils.image import to_vector
+
+
+def _tiles(n=6, h=4, w=3, seed=0):
+  return (np.random.RandomState(seed).rand(n, h, w, 3) * 255).astype(np.uint8)
+
+def test_batches_match_single_tiles():
+  tiles = _tiles()
+  matrix = tiles.reshape(len(tiles), -1).astype(np.float32)
+  for spec in ['raw', 'lab', 'grid:2', 'histogram:4']:
+    extractor = get_feature_extractor(spec)
+    batch = extractor.vectors(matrix, 4, 3, 3)
+    assert batch.shape == (len(tiles), extractor.dimensions(4, 3, 3))
+    for i in range(len(tiles)):
+      assert np.allclose(batch[i], extractor.vectors(matrix[i : i + 1], 4, 3, 3)[0])
+
+  lab = get_feature_extractor('lab').vectors(matrix, 4, 3, 3)
+  assert np.all(lab[0] == cv2.cvtColor(tiles[0], cv2.COLOR_BGR2Lab).ravel())
+  grid = get_feature_extractor('grid:2').vectors(matrix, 4, 3, 3)
+  assert np.allclose(grid[0, :3], tiles[0, :2, :2].reshape(-1, 3).mean(axis=0))
+  hist = get_feature_extractor('histogram:4').vectors(matrix, 4, 3, 3)
+  assert np.allclose(hist.reshape(-1, 3, 4).sum(axis=2), 255)
+
+def test_unknown_feature():
+  with pytest.raises(ValueError):
+    get_feature_extractor('sift')
+
+def test_same_feature_on_both_sides():
+  # a target made of codebook tiles is rebuilt exactly whichever feature is used
+  tile_images = list(_tiles(n=12, h=8, w=6, seed=1))
+  rng = np.random.RandomState(2)
+  layout = rng.randint(0, 12, (5, 4))
+  target = np.vstack([np.hstack([tile_images[i] for i in row]) for row in layout])
+
+  for spec in sorted(FEATURE_EXTRACTORS):
+    extractor = get_feature_extractor(spec)
+    raw = np.vstack([to_vector(tile, 8, 6) for tile in tile_images])
+    matrix = extractor.vectors(raw, 8, 6, 3)
+    index = faiss.IndexFlatL2(matrix.shape[1])
+    index.add(matrix)
+    mosaic, _, _ = mosaicify(target, 8, 6, index, tile_images, feature=spec)
+    assert np.array_equal(mosaic, target), spec
+
+def test_centered_matching_with_color_correction():
+  # tiles brightened / tinted a little are still found, and corrected back exactly
+  rng = np.random.RandomState(3)
+  tile_images = list(rng.randint(40, 200, (12, 8, 6, 3)).astype(np.uint8))
+  layout = rng.randint(0, 12, (5, 4))
+  offsets = rng.randint(-30, 30, (5, 4, 3))
+  target = np.vstack([
+    np.hstack([tile_images[i].astype(np.int16) + offset for i, offset in zip(row, row_offsets)])
+    for row, row_offsets in zip(layout, offsets)]).astype(np.uint8)
+
+  raw = np.vstack([to_vector(tile, 8, 6) for tile in tile_images])
+  matrix = get_feature_extractor('centered').vectors(raw, 8, 6, 3)
+  index = faiss.IndexFlatL2(matrix.shape[1])
+  index.add(matrix)
+  mosaic, _, _ = mosaicify(target, 8, 6, index, tile_images, feature='centered', color_correction=1.0)
+  assert np.array_equal(mosaic, target)
@@ -0,0 +1,52 @@
+import numpy as np
+import faiss
+
+from emosaic.quadtree import quadtree_cells, quadtree_mosaicify, level_tile_size
+from emosaic.utils.image import to_vector
+
+
+def _target():
+  # flat gray on the left, noise on the right
+  target = np.full((64, 96, 3), 128, dtype=np.uint8)
+  target[:, 48:] = (np.random.RandomState(0).rand(64, 48, 3) * 255).astype(np.uint8)
+  return target
+
+def test_cells_split_only_where_there_is_detail():
+  target = _target()
+  origin, cells = quadtree_cells(target, 4, 6, levels=3, variance_threshold=100.)
+  assert origin == (0, 0)
+
+  # cells exactly cover the tiled area, without overlaps
+  covered = np.zeros(target.shape[:2], dtype=int)
+  for x, y, level in cells:
+    h, w = level_tile_size(4, 6, 3, level)
+    covered[x : x + h, y : y + w] += 1
+  assert np.all(covered == 1)
+
+  assert np.all(cells[cells[:, 1] < 48, 2] == 0)
+  assert np.all(cells[cells[:, 1] >= 48, 2] == 2)
+
+  # faces always get the smallest tiles
+  _, cells = quadtree_cells(target, 4, 6, levels=3, variance_threshold=100., detail_rects=[(0, 0, 10, 10)])
+  assert cells[(cells[:, 0] == 0) & (cells[:, 1] == 0), 2].tolist() == [2]
+
+def test_each_size_matched_against_its_own_codebook():
+  target = _target()
+  origin, cells = quadtree_cells(target, 4, 6, levels=3, variance_threshold=100.)
+  rng = np.random.RandomState(1)
+  colors = rng.randint(0, 256, (20, 3))
+  colors[0] = 128
+
+  level2codebook = {}
+  for level in range(3):
+    h, w = level_tile_size(4, 6, 3, level)
+    tile_images = [np.full((h, w, 3), color, dtype=np.uint8) for color in colors]
+    matrix = np.vstack([to_vector(tile, 2, 3) for tile in tile_images])
+    index = faiss.IndexFlatL2(matrix.shape[1])
+    index.add(matrix)
+    level2codebook[level] = (index, tile_images, (2, 3))
+
+  mosaic, ids = quadtree_mosaicify(target, origin, cells, level2codebook, 4, 6, 3)
+  assert mosaic.shape == target.shape
+  assert np.all(ids[cells[:, 2] == 0] == 0)
+  assert np.all(mosaic[:, :48] == 128)
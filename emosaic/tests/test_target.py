@@ -0,0 +1,22 @@
+import numpy as np
+
+from emosaic.candidates import grid_vectors
+from emosaic.target import TargetIntegral
+
+
+def test_box_means_are_exact_area_averages():
+  target = (np.random.RandomState(0).rand(50, 40, 3) * 255).astype(np.uint8)
+  integral = TargetIntegral(target)
+  means = integral.box_means([2, 10, 12.5], [0, 7.25, 40])
+  assert means.shape == (2, 2, 3)
+  assert np.allclose(means[0, 1], target[2:10, 8:40].reshape(-1, 3).mean(axis=0) * (32 / 32.75)
+    + target[2:10, 7].reshape(-1, 3).mean(axis=0) * (0.75 / 32.75))
+
+def test_grid_vectors_match_resizing_the_target():
+  target = (np.random.RandomState(1).rand(301, 202, 3) * 255).astype(np.uint8)
+  integral = TargetIntegral(target)
+  for tile_h, tile_w, match_size in [(12, 9, None), (12, 9, (4, 3)), (12, 9, (5, 2)), (10, 7, (3, 3))]:
+    matrix, grid_shape, origin = integral.grid_vectors(tile_h, tile_w, match_size=match_size)
+    expected, expected_shape, expected_origin = grid_vectors(target, tile_h, tile_w, match_size=match_size)
+    assert (grid_shape, origin) == (expected_shape, expected_origin)
+    assert np.abs(matrix - expected).max() <= 1
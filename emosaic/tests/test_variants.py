@@ -0,0 +1,47 @@
+import numpy as np
+import faiss
+import pytest
+
+from emosaic.candidates import assign_with_constraints
+from emosaic.variants import (
+  parse_variants, check_variants, apply_variant, vector_permutation, add_variant_vectors,
+  decode_ids, expand_ids, variant_tiles)
+
+
+def _tiles(n, h, w, seed=0):
+  return np.random.RandomState(seed).randint(0, 256, (n, h, w, 3)).astype(np.uint8)
+
+def test_permuted_vectors_are_the_variant_tiles():
+  tile = _tiles(1, 6, 6)[0]
+  assert np.array_equal(apply_variant(tile, 'rot90'), np.rot90(tile))
+  assert np.array_equal(apply_variant(tile, 'rot270'), np.rot90(tile, -1))
+  for name in parse_variants('hflip,vflip,rot180,rot90,rot270'):
+    assert np.array_equal(tile.ravel()[vector_permutation(name, 6, 6, 3)], apply_variant(tile, name).ravel())
+
+  with pytest.raises(ValueError):
+    check_variants('hflip,rot90', (6, 6), (8, 6))
+  with pytest.raises(ValueError):
+    parse_variants('sideways')
+
+def test_variants_are_found_and_rendered():
+  tiles = _tiles(10, 8, 6)
+  variants = parse_variants('hflip,rot180')
+  matrix = tiles.reshape(10, -1).astype(np.float32)
+  index = faiss.IndexFlatL2(matrix.shape[1])
+  index.add(matrix)
+  add_variant_vectors(index, matrix, variants, 8, 6, 3)
+  assert index.ntotal == 30
+
+  queries = np.stack([apply_variant(tiles[3], 'hflip'), apply_variant(tiles[7], 'rot180'), tiles[1]])
+  _, ids = index.search(queries.reshape(3, -1).astype(np.float32), 1)
+  images, slots = decode_ids(ids[:, 0], 10)
+  assert list(images) == [3, 7, 1] and list(slots) == [1, 2, 0]
+  assert np.array_equal(variant_tiles(tiles, ids[:, 0], variants), queries)
+
+def test_variants_count_as_their_photo():
+  # every cell's best two matches are photo 0 and its flip, then photo 1
+  ids = np.array([[0, 2, 1]] * 4)
+  distances = np.array([[1., 2., 3.]] * 4)
+  chosen, _ = assign_with_constraints(ids, distances, (2, 2), max_uses=2, num_images=2)
+  assert sorted(decode_ids(chosen, 2)[0]) == [0, 0, 1, 1]
+  assert sorted(expand_ids([1], 2, 3)) == [1, 3, 5]
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from emosaic.utils.alpha import AlphaMaskedIndex, composite, parse_background, resize_premultiplied
+
+
+def _codebook(n, seed, h=6, w=5):
+  rng = np.random.RandomState(seed)
+  tiles = rng.randint(0, 256, (n, h, w, 4)).astype(np.uint8)
+  # some fully opaque, one fully transparent
+  tiles[:3, :, :, 3] = 255
+  tiles[-1, :, :, 3] = 0
+  return tiles
+
+def _brute_force(tiles, queries):
+  """ mean squared error over the opaque pixels, times the tile area """
+  premultiplied = np.stack([resize_premultiplied(t, t.shape[0], t.shape[1], dtype=np.float32) for t in tiles])
+  n = len(tiles)
+  alpha = premultiplied[..., 3:].reshape(n, -1, 1) / 255.
+  colors = premultiplied[..., :3].reshape(n, -1, 3) / np.maximum(alpha, 1e-6)
+  q = queries.reshape(len(queries), 1, -1, 3)
+  err = (alpha[None] * (q - colors[None]) ** 2).sum(axis=(2, 3))
+  coverage = alpha.sum(axis=(1, 2))
+  with np.errstate(divide='ignore', invalid='ignore'):
+    return np.where(coverage > 1e-3, err * alpha.shape[1] / coverage, np.inf)
+
+def test_masked_index_matches_brute_force():
+  tiles = _codebook(40, 0)
+  queries = np.random.RandomState(1).randint(0, 256, (20, 6 * 5 * 3)).astype(np.float32)
+  matrix = np.stack([resize_premultiplied(t, 6, 5) for t in tiles]).reshape(len(tiles), -1)
+  index = AlphaMaskedIndex(matrix)
+  assert index.ntotal == 40 and index.d == 6 * 5 * 3
+
+  expected = _brute_force(np.stack([t for t in tiles]), queries)
+  # rounding the premultiplied colors to uint8 moves distances a little
+  distances, ids = index.search(queries, 5)
+  assert np.all(ids[:, 0] == expected.argmin(axis=1))
+  assert np.allclose(distances, np.take_along_axis(expected, ids, axis=1), rtol=0.02)
+
+  # the transparent tile is never returned, and runs out like faiss
+  distances, ids = index.search(queries, 45)
+  assert not np.any(ids == 39)
+  assert np.all(ids[:, 39:] == -1) and np.all(distances[:, 39:] == np.finfo(np.float32).max)
+
+  # excluded tiles are skipped
+  _, ids = index.search(queries, 5, exclude=expected.argmin(axis=1))
+  assert not np.any(ids[:, 0] == expected.argmin(axis=1))
+
+def test_opaque_tiles_are_plain_l2():
+  tiles = _codebook(3, 2)
+  tiles[..., 3] = 255
+  matrix = tiles.reshape(3, -1).astype(np.float32)
+  queries = np.random.RandomState(3).randint(0, 256, (4, 6 * 5 * 3)).astype(np.float32)
+  distances, ids = AlphaMaskedIndex(matrix).search(queries, 3)
+  colors = tiles[..., :3].reshape(3, -1).astype(np.float64)
+  expected = ((queries[:, None, :] - colors[None]) ** 2).sum(axis=2)
+  assert np.allclose(distances, np.take_along_axis(expected, ids, axis=1), rtol=1e-4)
+
+def test_composite_and_parse_background():
+  assert parse_background('255,128,0') == (0, 128, 255)
+  assert parse_background('target') == 'target' and parse_background(None) is None
+  with pytest.raises(ValueError):
+    parse_background('white')
+
+  tile = np.array([[[0, 0, 255, 255], [0, 0, 255, 0], [0, 0, 255, 128]]], dtype=np.uint8)
+  out = composite(resize_premultiplied(tile, 1, 3), (255, 255, 255))
+  assert out.tolist() == [[[0, 0, 255], [255, 255, 255], [127, 127, 255]]]
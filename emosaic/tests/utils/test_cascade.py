@@ -0,0 +1,49 @@
+import cv2
+import numpy as np
+import faiss
+
+from emosaic.candidates import masked_search
+from emosaic.utils.cascade import build_cascade_index, mean_grid_projection, coarse_vectors
+from emosaic.utils.indexing import index_images
+
+
+def _vectors(n, seed):
+  rng = np.random.RandomState(seed)
+  colors = rng.rand(n, 1, 1, 3) * 255
+  return np.clip(colors + rng.randn(n, 8, 6, 3) * 10, 0, 255).reshape(n, -1).astype(np.float32)
+
+def test_coarse_distances_never_exceed_full_ones():
+  projection = mean_grid_projection(8, 6, 3, 2, 2)
+  a, b = _vectors(50, 0), _vectors(50, 1)
+  full = ((a - b) ** 2).sum(axis=1)
+  coarse = ((coarse_vectors(a, projection) - coarse_vectors(b, projection)) ** 2).sum(axis=1)
+  assert np.all(coarse <= full * (1 + 1e-5))
+
+def test_cascade_finds_the_same_matches():
+  matrix, queries = _vectors(2000, 2), _vectors(200, 3)
+  flat = faiss.IndexFlatL2(matrix.shape[1])
+  flat.add(matrix)
+  cascade = build_cascade_index(matrix, (8, 6), 3, grid_size=(2, 2), cascade_factor=32)
+  assert cascade.ntotal == 2000
+
+  _, expected = flat.search(queries, 4)
+  distances, ids = cascade.search(queries, 4)
+  assert (ids[:, 0] == expected[:, 0]).mean() > 0.95
+
+  # exclusions reach the shortlist
+  _, ids = masked_search(cascade, queries, exclude=expected[:, 0], k=2)
+  assert not np.isin(ids, expected[:, 0]).any()
+
+def test_index_images_caches_cascade(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  rng = np.random.RandomState(4)
+  paths = []
+  for i in range(12):
+    paths.append(str(tmp_path / ('%d.jpg' % i)))
+    cv2.imwrite(paths[-1], np.full((40, 30, 3), rng.randint(0, 256, 3), dtype=np.uint8))
+
+  kwargs = dict(aspect_ratio=4 / 3., height=8, width=6, caching=True, verbose=0, nprocesses=1, cascade_grid=(2, 2))
+  index, _, _ = index_images(list(paths), **kwargs)
+  cached, _, _ = index_images(list(paths), **kwargs)
+  queries = _vectors(5, 5)
+  assert np.all(index.search(queries, 3)[1] == cached.search(queries, 3)[1])
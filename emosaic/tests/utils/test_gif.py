@@ -0,0 +1,67 @@
+import os
+
+import numpy as np
+import PIL.Image as pillow
+
+from emosaic.utils.gif import GifWriter, create_gif_from_frames, compute_shared_palette
+
+
+def _make_frame(seed, h=48, w=64):
+  rng = np.random.RandomState(seed)
+  frame = np.zeros((h, w, 3), dtype=np.uint8)
+  frame[:h // 2] = rng.randint(0, 256, 3)
+  frame[h // 2:] = rng.randint(0, 256, 3)
+  return frame
+
+def test_gif_writer_streams_frames():
+  savepath = '/tmp/emosaic-test.gif'
+  frames = [_make_frame(seed) for seed in range(5)]
+  with GifWriter(savepath, fps=5) as writer:
+    for frame in frames:
+      writer.append(frame)
+  assert writer.num_frames == 5
+
+  gif = pillow.open(savepath)
+  assert gif.n_frames == 5
+  assert gif.size == (64, 48)
+  assert gif.info['duration'] == 200
+  for i, frame in enumerate(frames):
+    gif.seek(i)
+    rgb = np.array(gif.convert('RGB')).astype(np.int32)
+    # two flat colors survive quantization (almost) exactly, BGR -> RGB
+    assert np.abs(rgb - frame[:, :, [2, 1, 0]]).max() <= 2
+
+def test_gif_writer_resizes_to_first_frame():
+  savepath = '/tmp/emosaic-test-resize.gif'
+  with GifWriter(savepath) as writer:
+    writer.append(_make_frame(0))
+    writer.append(_make_frame(1, h=96, w=128))
+
+  gif = pillow.open(savepath)
+  gif.seek(1)
+  assert gif.size == (64, 48)
+
+def test_shared_palette_gif_only_writes_changed_regions():
+  rng = np.random.RandomState(0)
+  base = (rng.rand(60, 80, 3) * 255).astype(np.uint8)
+  frames = []
+  for i in range(6):
+    frame = base.copy()
+    frame[10:20, 10 * i : 10 * i + 10] = (0, 0, 255)
+    frames.append(frame)
+
+  delta_path, full_path = '/tmp/emosaic-test-delta.gif', '/tmp/emosaic-test-full.gif'
+  assert create_gif_from_frames(frames, delta_path, fuzz=0, palette_frames=frames) == 6
+  with GifWriter(full_path) as writer:
+    for frame in frames:
+      writer.append(frame)
+  assert os.path.getsize(delta_path) < os.path.getsize(full_path) / 2
+
+  # every frame still decodes to (a quantized version of) the original
+  gif = pillow.open(delta_path)
+  palette = compute_shared_palette(frames)
+  for i, frame in enumerate(frames):
+    gif.seek(i)
+    rgb = np.array(gif.convert('RGB'))
+    expected = np.array(pillow.fromarray(frame[:, :, [2, 1, 0]]).quantize(palette=palette, dither=0).convert('RGB'))
+    assert np.all(rgb == expected)
@@ -7,17 +7,18 @@ matplotlib.use('Agg') # Force matplotlib to not use any Xwindows backend.
 import matplotlib.pyplot as plt
 
 from emosaic.utils.image import divide_image, load_png_image, \
-  resize_square_image, bgr_to_rgb, rgb_to_bgr, bgr_to_hsv, hsv_to_bgr
+  resize_square_image, bgr_to_rgb, rgb_to_bgr, bgr_to_hsv, hsv_to_bgr, \
+  to_vector, compute_match_size
 
 
-def test_divide_image_margins():
+def test_divide_image_margins(tmp_path):
   image = np.random.random((150, 150, 3))
   pixels = 32
   box_starts = divide_image(image, pixels)
 
   # visualization only
   plt.scatter([b[0] for b in box_starts], [b[1] for b in box_starts], marker='+')
-  plt.savefig('emosaic/tests/output/divide_image.png')
+  plt.savefig(str(tmp_path / 'divide_image.png'))
 
   # check first & last box
   assert box_starts[0] == (11, 11)
@@ -26,14 +27,14 @@ def test_divide_image_margins():
   # check number of boxes
   assert len(box_starts) == 4 * 4
 
-def test_divide_image_exact():
+def test_divide_image_exact(tmp_path):
   image = np.random.random((64, 64, 3))
   pixels = 8
   box_starts = divide_image(image, pixels)
 
   # visualization only
   plt.scatter([b[0] for b in box_starts], [b[1] for b in box_starts], marker='+')
-  plt.savefig('emosaic/tests/output/divide_image_exact.png')
+  plt.savefig(str(tmp_path / 'divide_image_exact.png'))
 
   # check first & last box
   assert box_starts[0] == (0, 0)
@@ -89,3 +90,16 @@ def test_resize_square_image():
   # should round up to the nearest integer size
   bgr_smaller = resize_square_image(bgr_img, factor=0.334)
   assert bgr_smaller.shape == (214, 214, 3)
+
+def test_to_vector_downsizes_non_square():
+  img = np.zeros((8, 6, 3), dtype=np.uint8)
+  img[:4] = 200
+  v = to_vector(img, 4, 3)
+  assert v.shape == (1, 4 * 3 * 3)
+
+  # area averaging, top half stays bright
+  assert np.all(v.reshape(4, 3, 3)[:2] == 200)
+  assert np.all(v.reshape(4, 3, 3)[2:] == 0)
+
+  assert compute_match_size(40, 30, 0.25) == (10, 8)
+  assert compute_match_size(4, 3, 0.01) == (1, 1)
@@ -0,0 +1,65 @@
+import os
+
+import cv2
+import numpy as np
+import faiss
+
+from emosaic.utils.image import compute_hw, to_vector, crop_to_aspect
+from emosaic.utils.indexing import (
+  iter_mosaics_at_multiple_scales, estimate_render_cost, index_images, index_images_at_sizes)
+from emosaic.assignment import load_tile
+
+
+def _make_codebook(h, w, n=20, seed=0):
+  rng = np.random.RandomState(seed)
+  tile_images = [np.full((h, w, 3), rng.randint(0, 256, 3), dtype=np.uint8) for _ in range(n)]
+  matrix = np.vstack([to_vector(tile, h, w) for tile in tile_images])
+  index = faiss.IndexFlatL2(matrix.shape[1])
+  index.add(matrix)
+  return index, tile_images
+
+def test_small_scales_cost_more():
+  shape = (120, 90, 3)
+  assert estimate_render_cost(shape, *compute_hw(1, 4, 3)) > estimate_render_cost(shape, *compute_hw(5, 4, 3))
+
+def test_parallel_scales_match_sequential():
+  target = (np.random.RandomState(1).rand(120, 90, 3) * 255).astype(np.uint8)
+  scale2index = {}
+  for scale in range(1, 5):
+    scale2index[scale] = _make_codebook(*compute_hw(scale, 4, 3))
+
+  sequential = dict(iter_mosaics_at_multiple_scales(target, scale2index, 4, 3, nprocesses=1))
+  parallel = dict(iter_mosaics_at_multiple_scales(target, scale2index, 4, 3, nprocesses=2))
+  assert sorted(parallel) == [1, 2, 3, 4]
+  for scale in scale2index:
+    assert np.all(parallel[scale] == sequential[scale])
+
+def test_one_pass_indexes_every_aspect_ratio(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  (tmp_path / 'cache').mkdir()
+  rng = np.random.RandomState(2)
+  # 4:3, 3:4, 4:3 cut a little narrow & 9:16 landscape
+  shapes = {'tall': (40, 30), 'wide': (30, 40), 'narrow': (40, 28), 'screen': (27, 48)}
+  paths = []
+  for name, (h, w) in sorted(shapes.items()):
+    paths.append(str(tmp_path / ('%s.jpg' % name)))
+    cv2.imwrite(paths[-1], rng.randint(0, 256, (h, w, 3)).astype(np.uint8))
+
+  kwargs = dict(caching=True, verbose=0, nprocesses=1, aspect_tolerance=0.1)
+  results = index_images_at_sizes(list(paths), [(16, 12), (12, 16)], **kwargs)
+  names = [[os.path.basename(image.path) for image in images] for _, images, _ in results]
+  assert names == [['narrow.jpg', 'tall.jpg'], ['wide.jpg']]
+  assert [index.ntotal for index, _, _ in results] == [2, 1]
+
+  # cropped, not squashed, & cropped the same when re-rendering from the photo
+  _, images, tile_images = results[0]
+  narrow = images[0].path
+  assert crop_to_aspect(cv2.imread(narrow), 16, 12).shape[:2] == (37, 28)
+  assert np.all(tile_images[0] == load_tile((narrow, 16, 12)))
+
+  # filled the cache index_images reads from, & without the tolerance only exact matches
+  _, cached, _ = index_images(list(paths), 16 / 12., 16, 12, **kwargs)
+  assert [image.path for image in cached] == [image.path for image in images]
+  kwargs['aspect_tolerance'] = 0
+  _, exact, _ = index_images(list(paths), 16 / 12., 16, 12, **kwargs)
+  assert [os.path.basename(image.path) for image in exact] == ['tall.jpg']
@@ -0,0 +1,39 @@
+import time
+
+import cv2
+import numpy as np
+
+from emosaic.utils.rendering import ScaleRenderer, preview_at_scale
+
+
+def test_preview_is_tile_grid():
+  target = (np.random.RandomState(0).rand(120, 90, 3) * 255).astype(np.uint8)
+  preview = preview_at_scale(target, 5, 4, 3)
+  assert preview.shape == (120, 90, 3)
+  # every 20x15 tile is a single color
+  assert np.all(preview[:20, :15] == preview[0, 0])
+
+def test_renderer_prefetches_and_bounds_cache(tmp_path):
+  rng = np.random.RandomState(0)
+  for i in range(10):
+    cv2.imwrite(str(tmp_path / ('%d.jpg' % i)), np.full((40, 30, 3), rng.randint(0, 256, 3), dtype=np.uint8))
+  target = (rng.rand(120, 90, 3) * 255).astype(np.uint8)
+
+  renderer = ScaleRenderer(target, str(tmp_path), 4, 3, min_scale=1, max_scale=5,
+    max_cached=2, prefetch=1, nprocesses=2, index_kwargs=dict(caching=False, nprocesses=1))
+  try:
+    mosaic = None
+    deadline = time.time() + 60
+    while mosaic is None and time.time() < deadline:
+      mosaic = renderer.get(3)
+      time.sleep(0.05)
+    assert mosaic is not None and mosaic.shape[2] == 3
+
+    # neighbours were queued too, but only the most recent renders are kept
+    while renderer.pending and time.time() < deadline:
+      renderer.get(3)
+      time.sleep(0.05)
+    assert 3 in renderer.rendered
+    assert len(renderer.rendered) <= 2
+  finally:
+    renderer.close()
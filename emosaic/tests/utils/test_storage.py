@@ -0,0 +1,64 @@
+import glob
+import pickle
+
+import cv2
+import numpy as np
+import faiss
+
+from emosaic.utils.storage import build_storage_index, compact_matrix
+from emosaic.utils.cascade import build_cascade_index
+from emosaic.utils.indexing import index_images
+
+
+def _pixels(n, seed):
+  rng = np.random.RandomState(seed)
+  return rng.randint(0, 256, (n, 8 * 6 * 3)).astype(np.float32)
+
+def test_uint8_storage_matches_flat_exactly():
+  matrix, queries = _pixels(500, 0), _pixels(50, 1)
+  flat = faiss.IndexFlatL2(matrix.shape[1])
+  flat.add(matrix)
+  compact = compact_matrix(matrix, 'uint8')
+  assert compact.dtype == np.uint8
+
+  expected_distances, expected = flat.search(queries, 5)
+  distances, ids = build_storage_index(compact, 'uint8').search(queries, 5)
+  assert np.all(ids == expected)
+  assert np.allclose(distances, expected_distances)
+
+  # and in the refine stage of a cascade
+  cascade = build_cascade_index(compact, (8, 6), 3, cascade_factor=500, storage='uint8')
+  assert np.all(cascade.search(queries, 5)[1] == expected)
+
+def test_float16_storage_is_close():
+  matrix, queries = _pixels(500, 2) / 255., _pixels(50, 3) / 255.
+  flat = faiss.IndexFlatL2(matrix.shape[1])
+  flat.add(matrix)
+  expected_distances, expected = flat.search(queries, 1)
+  distances, ids = build_storage_index(compact_matrix(matrix, 'float16'), 'float16').search(queries, 1)
+  assert (ids == expected).mean() > 0.95
+  assert np.allclose(distances, expected_distances, rtol=1e-2)
+
+def test_index_images_caches_compact_vectors(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  (tmp_path / 'cache').mkdir()
+  rng = np.random.RandomState(4)
+  paths = []
+  for i in range(12):
+    paths.append(str(tmp_path / ('%d.jpg' % i)))
+    cv2.imwrite(paths[-1], rng.randint(0, 256, (40, 30, 3)).astype(np.uint8))
+
+  kwargs = dict(aspect_ratio=4 / 3., height=8, width=6, caching=True, verbose=0, nprocesses=1)
+  flat, _, _ = index_images(list(paths), **kwargs)
+  index, _, _ = index_images(list(paths), storage='uint8', **kwargs)
+  cached, _, _ = index_images(list(paths), storage='uint8', **kwargs)
+
+  queries = _pixels(5, 5)
+  assert np.all(index.search(queries, 3)[1] == flat.search(queries, 3)[1])
+  assert np.all(cached.search(queries, 3)[1] == flat.search(queries, 3)[1])
+
+  dtypes = set()
+  for path in glob.glob(str(tmp_path / 'cache' / '*.pkl')):
+    with open(path, 'rb') as f:
+      dtypes.add(pickle.load(f)['matrix'].dtype)
+  assert dtypes == {np.dtype(np.float32), np.dtype(np.uint8)}
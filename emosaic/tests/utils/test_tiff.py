@@ -0,0 +1,34 @@
+import os
+
+import numpy as np
+import PIL.Image as pillow
+import pytest
+
+from emosaic.utils.tiff import StripTiffWriter
+
+
+@pytest.mark.parametrize('bigtiff', [False, True])
+def test_strip_tiff_round_trip(tmp_path, bigtiff):
+  img = (np.random.RandomState(0).rand(50, 37, 3) * 255).astype(np.uint8)
+  savepath = str(tmp_path / 'strips.tif')
+  with StripTiffWriter(savepath, 50, 37, bigtiff=bigtiff) as writer:
+    for x in range(0, 50, 16):
+      writer.append(img[x : x + 16])
+
+  # written as RGB, read back & compared as BGR
+  read = np.array(pillow.open(savepath))[:, :, ::-1]
+  assert np.all(read == img)
+
+def test_strip_tiff_rejects_short_strip_in_the_middle(tmp_path):
+  writer = StripTiffWriter(str(tmp_path / 'bad.tif'), 30, 10)
+  writer.append(np.zeros((10, 10, 3), np.uint8))
+  with pytest.raises(ValueError):
+    writer.append(np.zeros((5, 10, 3), np.uint8))
+
+def test_strip_tiff_failed_render_keeps_its_error(tmp_path):
+  savepath = str(tmp_path / 'failed.tif')
+  with pytest.raises(RuntimeError):
+    with StripTiffWriter(savepath, 30, 10) as writer:
+      writer.append(np.zeros((10, 10, 3), np.uint8))
+      raise RuntimeError("band failed")
+  assert not os.path.exists(savepath)
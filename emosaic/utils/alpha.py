@@ -0,0 +1,169 @@
+import numpy as np
+import cv2
+
+"""
+Codebooks with transparency, like emoji PNGs. What shows through the
+transparent parts of a tile is its background:
+
+    a color (b, g, r)   tiles are composited over it as they're loaded, then
+                        everything works as for opaque photos
+    'target'            the target itself shows through, so only the opaque
+                        parts of a tile are compared (AlphaMaskedIndex) and
+                        tiles are composited over the target when rendering
+
+Tiles & vectors with alpha are kept premultiplied (BGR times alpha, plus
+alpha) so resizing doesn't bleed the color of invisible pixels in.
+"""
+
+TARGET_BACKGROUND = 'target'
+
+
+def parse_background(spec):
+    """
+    @param: spec (String) 'target' or an 'R,G,B' color, None for opaque codebooks
+
+    @return: None, 'target' or a (b, g, r) tuple
+    """
+    if spec is None or spec == TARGET_BACKGROUND:
+        return spec
+    try:
+        r, g, b = [int(v) for v in spec.split(',')]
+    except ValueError:
+        raise ValueError("Background must be 'target' or an R,G,B color like 255,255,255, not '%s'" % spec)
+    return (b, g, r)
+
+def to_bgra(img):
+    """
+    @return: img with an alpha channel, opaque if it had none
+    """
+    if img.ndim == 2:
+        img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    if img.shape[2] == 3:
+        img = np.dstack([img, np.full(img.shape[:2], 255, dtype=img.dtype)])
+    return img
+
+def resize_premultiplied(img, h, w, dtype=np.uint8):
+    """
+    @param: img (numpy arr) BGRA image, straight (not premultiplied) alpha
+
+    @return: (h, w, 4) premultiplied BGRA, area averaged
+    """
+    img = to_bgra(img).astype(np.float32)
+    img[:, :, :3] *= img[:, :, 3:] / 255.
+    if img.shape[:2] != (h, w):
+        img = cv2.resize(img, (w, h), interpolation=cv2.INTER_AREA)
+    if dtype == np.uint8:
+        return np.clip(np.rint(img), 0, 255).astype(np.uint8)
+    return img.astype(dtype)
+
+def composite(premultiplied, background):
+    """
+    Premultiplied BGRA tiles over a background, any number of them at once.
+
+    @param: premultiplied (numpy arr) (..., 4)
+    @param: background (numpy arr or (b, g, r) tuple) (..., 3) broadcastable, or one color
+
+    @return: uint8 (..., 3)
+    """
+    premultiplied = np.asarray(premultiplied, dtype=np.float32)
+    background = np.asarray(background, dtype=np.float32)
+    out = premultiplied[..., :3] + (1 - premultiplied[..., 3:] / 255.) * background
+    return np.clip(np.rint(out), 0, 255).astype(np.uint8)
+
+def alpha_vector(img, h, w, background):
+    """
+    Like to_vector, for images with alpha: premultiplied BGRA when the
+    target shows through, composited over the background color otherwise.
+    """
+    premultiplied = resize_premultiplied(img, h, w, dtype=np.float32)
+    if background == TARGET_BACKGROUND:
+        return premultiplied.reshape(1, -1)
+    background = np.asarray(background, dtype=np.float32)
+    return (premultiplied[..., :3] + (1 - premultiplied[..., 3:] / 255.) * background).reshape(1, -1)
+
+def alpha_tile(img, h, w, background):
+    """
+    Like alpha_vector, for the uint8 tiles that get pasted.
+    """
+    premultiplied = resize_premultiplied(img, h, w)
+    if background == TARGET_BACKGROUND:
+        return premultiplied
+    return composite(premultiplied, background)
+
+
+class AlphaMaskedIndex(object):
+    """
+    Exact search of opaque BGR queries against premultiplied BGRA codebook
+    vectors, comparing only where tiles are opaque: the alpha weighted
+    squared error, averaged over each tile's coverage (& scaled back up by
+    the tile's area, so distances are on the same scale as plain L2).
+
+    Expanding sum(a * (q - t)^2) gives q^2 . a - 2 q . (a t) + sum(a t^2),
+    so with those per tile weights & norms precomputed every batch of
+    queries is one matmul, like a flat index:
+
+        index = AlphaMaskedIndex(matrix)   # N x (h * w * 4) premultiplied vectors
+        distances, ids = index.search(queries, k)   # queries N x (h * w * 3)
+
+    Tiles with (almost) nothing opaque are never matched.
+    """
+    # query rows searched at once are limited so the distance block stays ~64MB
+    max_block = 2 ** 24
+
+    def __init__(self, matrix, nchannels=3):
+        matrix = np.asarray(matrix, dtype=np.float32)
+        n = len(matrix)
+        pixels = matrix.reshape(n, -1, nchannels + 1)
+        alpha = pixels[:, :, nchannels:] / 255.
+        premultiplied = pixels[:, :, :nchannels]
+
+        coverage = alpha.sum(axis=(1, 2))
+        usable = coverage > 1e-3
+        scale = np.where(usable, pixels.shape[1] / np.maximum(coverage, 1e-3), 0.)[:, None, None]
+
+        weights = np.broadcast_to(alpha, premultiplied.shape) * scale
+        # a t^2 = (a t)^2 / a, zero where the tile is transparent
+        squares = np.where(alpha > 0, premultiplied ** 2 / np.maximum(alpha, 1e-6), 0.)
+
+        # one matrix, so [q^2, q] . row = q^2 . a - 2 q . (a t)
+        self.rows = np.ascontiguousarray(np.hstack([
+            weights.reshape(n, -1), -2 * (premultiplied * scale).reshape(n, -1)]), dtype=np.float32)
+        self.norms = np.where(usable, (squares * scale).sum(axis=(1, 2)), np.inf).astype(np.float32)
+        self.d = premultiplied.shape[1] * nchannels
+
+    @property
+    def ntotal(self):
+        return len(self.rows)
+
+    def search(self, queries, k, exclude=None):
+        """
+        @param: queries (numpy arr) N x d opaque BGR vectors
+        @param: exclude (iterable of ints) ids to leave out
+
+        @return: tuple (distances, ids), each N x k & best first, like a faiss index
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        norms = self.norms
+        if exclude is not None and len(exclude):
+            norms = norms.copy()
+            norms[np.asarray(list(exclude), dtype=np.int64)] = np.inf
+
+        # padded like faiss: float32 max & -1 where there's nothing to return
+        missing = np.finfo(np.float32).max
+        n = len(queries)
+        distances = np.full((n, k), missing, dtype=np.float32)
+        ids = np.full((n, k), -1, dtype=np.int64)
+        kk = min(k, self.ntotal)
+        block = max(1, self.max_block // max(1, self.ntotal))
+        for start in range(0, n, block):
+            q = queries[start : start + block]
+            d = np.hstack([q ** 2, q]).dot(self.rows.T) + norms
+            top = np.argpartition(d, kk - 1, axis=1)[:, :kk] if kk < self.ntotal else np.tile(np.arange(kk), (len(q), 1))
+            top_d = np.take_along_axis(d, top, axis=1)
+            order = np.argsort(top_d, axis=1, kind='stable')
+            top, top_d = np.take_along_axis(top, order, axis=1), np.take_along_axis(top_d, order, axis=1)
+
+            found = np.isfinite(top_d)
+            distances[start : start + len(q), :kk] = np.where(found, np.maximum(top_d, 0), missing)
+            ids[start : start + len(q), :kk] = np.where(found, top, -1)
+        return distances, ids
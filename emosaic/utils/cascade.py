@@ -0,0 +1,93 @@
+import numpy as np
+
+"""
+Coarse-to-fine codebook search. Every tile vector is also summarized by
+its mean color over a small grid (e.g. 2x2). Queries are first compared on
+those few numbers to shortlist candidates, and only the shortlist is
+scored exactly on the full vectors:
+
+    index = build_cascade_index(matrix, (match_h, match_w), 3, grid_size=(2, 2))
+    distances, ids = index.search(queries, k)   # same as a flat index, mostly
+
+The mean grid is scaled so its distances never exceed the full ones (the
+sum of squared differences over a cell is at least the cell's area times
+the squared difference of its means), so matches that are close in full
+are also close on the coarse grid.
+"""
+
+DEFAULT_CASCADE_FACTOR = 64
+
+
+def mean_grid_projection(match_h, match_w, nchannels, grid_h, grid_w, area_weighted=True):
+    """
+    Linear map from a flattened (match_h, match_w, nchannels) tile vector
+    (see to_vector) to its mean color over a grid_h x grid_w grid, each cell
+    scaled by sqrt(area) when area_weighted, plain means otherwise.
+
+    @return: (grid_h * grid_w * nchannels) x (match_h * match_w * nchannels) float32 matrix
+    """
+    grid_h, grid_w = min(grid_h, match_h), min(grid_w, match_w)
+    ys, xs, cs = np.meshgrid(np.arange(match_h), np.arange(match_w), np.arange(nchannels), indexing='ij')
+    cells = ((ys * grid_h // match_h) * grid_w + xs * grid_w // match_w) * nchannels + cs
+
+    areas = np.bincount(cells.ravel()).astype(np.float64)
+    projection = np.zeros((grid_h * grid_w * nchannels, match_h * match_w * nchannels), dtype=np.float32)
+    weights = np.sqrt(areas) if area_weighted else areas
+    projection[cells.ravel(), np.arange(cells.size)] = 1. / weights[cells.ravel()]
+    return projection
+
+def build_cascade_index(matrix, match_size, nchannels, grid_size=(2, 2), cascade_factor=DEFAULT_CASCADE_FACTOR,
+        coarse_class=None, coarse_matrix=None, storage='float32'):
+    """
+    @param: matrix (numpy arr) N x D codebook vectors, vectorized at match_size
+    @param: grid_size (tuple of ints) (rows, cols) of the mean color grid used to shortlist
+    @param: cascade_factor (int) shortlisted candidates per match asked for, scored in full
+    @param: coarse_class (Faiss Index class) for the coarse vectors, defaults to faiss.IndexFlatL2
+    @param: coarse_matrix (numpy arr) N x d coarse vectors already computed (e.g. cached)
+    @param: storage (String) how the refine stage keeps the full vectors, see emosaic.utils.storage
+
+    @return: faiss index searching like an IndexFlatL2 on matrix
+    """
+    import faiss
+    from emosaic.utils.storage import build_storage_index
+
+    if coarse_class is None:
+        coarse_class = faiss.IndexFlatL2
+    if storage == 'float32':
+        matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+    projection = mean_grid_projection(match_size[0], match_size[1], nchannels, *grid_size)
+    if coarse_matrix is None:
+        coarse_matrix = coarse_vectors(matrix, projection)
+
+    transform = faiss.LinearTransform(projection.shape[1], projection.shape[0], False)
+    faiss.copy_array_to_vector(projection.ravel(), transform.A)
+    transform.is_trained = True
+
+    coarse = coarse_class(projection.shape[0])
+    coarse.add(np.ascontiguousarray(coarse_matrix, dtype=np.float32))
+    base = faiss.IndexPreTransform(transform, coarse)
+    base.ntotal = coarse.ntotal
+
+    # the refine stage keeps the full vectors to score the shortlist exactly
+    if storage == 'float32':
+        index = faiss.IndexRefineFlat(base, faiss.swig_ptr(matrix))
+        refine = None
+    else:
+        refine = build_storage_index(matrix, storage)
+        index = faiss.IndexRefine(base, refine)
+    index.k_factor = cascade_factor
+
+    # python owns the pieces, keep them alive as long as the index
+    index.referenced_objects = [base, coarse, transform, refine]
+    return index
+
+def coarse_vectors(matrix, projection, chunk_rows=4096):
+    # chunked, so compact (uint8 / float16) matrices are never copied whole to float32
+    return np.concatenate([
+        np.asarray(matrix[start : start + chunk_rows], dtype=np.float32).dot(projection.T)
+        for start in range(0, len(matrix), chunk_rows)
+    ] or [np.zeros((0, projection.shape[0]), dtype=np.float32)])
+
+def is_cascade_index(index):
+    import faiss
+    return isinstance(index, faiss.IndexRefine)
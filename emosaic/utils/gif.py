@@ -1,29 +1,273 @@
-import os
-import moviepy.editor as mpy
+import io
+import math
+import struct
 
-def create_gif_from_images(image_paths, savepath, fps=3, fuzz=5, ascending=None, compress=True, resize_height=None):
+import cv2
+import numpy as np
+import PIL.Image as pillow
+
+def skip_gif_sub_blocks(data, pos):
+    # sub-blocks are length-prefixed, terminated by a zero length
+    while True:
+        size = data[pos]
+        pos += 1
+        if size == 0:
+            return pos
+        pos += size
+
+def split_gif_frame(data):
+    """
+    @param: data (bytes) a single-frame GIF
+
+    @return: tuple (color table bytes, image data bytes starting at the LZW
+        minimum code size and ending after the block terminator)
+    """
+    data = bytearray(data)
+    flags = data[10]
+    pos = 13
+    color_table = b''
+    if flags & 0x80:
+        size = 3 * 2 ** ((flags & 0x07) + 1)
+        color_table = bytes(data[pos : pos + size])
+        pos += size
+
+    while pos < len(data):
+        if data[pos] == 0x21:
+            # extension block: introducer, label, sub-blocks
+            pos = skip_gif_sub_blocks(data, pos + 2)
+        elif data[pos] == 0x2C:
+            image_flags = data[pos + 9]
+            pos += 10
+            if image_flags & 0x80:
+                size = 3 * 2 ** ((image_flags & 0x07) + 1)
+                color_table = bytes(data[pos : pos + size])
+                pos += size
+            end = skip_gif_sub_blocks(data, pos + 1)
+            return color_table, bytes(data[pos : end])
+        else:
+            break
+    raise ValueError("No image block found in GIF data")
+
+def encode_gif_frame(paletted):
+    """
+    LZW-encodes a Pillow 'P' mode image with Pillow's encoder and returns
+    (color table bytes, image data bytes), see split_gif_frame()
+    """
+    buf = io.BytesIO()
+    paletted.save(buf, format='GIF', interlace=False, optimize=False)
+    return split_gif_frame(buf.getvalue())
+
+def color_table_bits(color_table):
+    # GIF color tables hold 2 ** (bits + 1) entries
+    entries = max(len(color_table) // 3, 2)
+    return max(int(math.ceil(math.log(entries, 2))) - 1, 0)
+
+
+def pad_palette(palette):
+    # pad to a full 256 color table by repeating the first color, so padding
+    # never introduces a new color (index 255 is reserved for transparency)
+    return list(palette) + list(palette[:3]) * ((768 - len(palette)) // 3)
+
+def compute_shared_palette(frames, colors=255, max_pixels_per_frame=1 << 16):
+    """
+    Computes one palette for a whole animation from a subsample of the
+    pixels of every frame in `frames` (BGR uint8 numpy arrays).
+
+    @return: Pillow 'P' mode image holding the palette, for Image.quantize()
+    """
+    samples = []
+    for frame in frames:
+        pixels = frame.reshape(-1, 3)
+        step = max(1, pixels.shape[0] // max_pixels_per_frame)
+        samples.append(pixels[::step])
+    pixels = np.vstack(samples)[:, [2, 1, 0]]
+
+    strip = pillow.fromarray(np.ascontiguousarray(pixels.reshape(-1, 1, 3)))
+    paletted = strip.quantize(colors=colors)
+
+    palette_image = pillow.new('P', (1, 1))
+    palette_image.putpalette(pad_palette(paletted.getpalette()[: 3 * colors]))
+    return palette_image
+
+
+class GifWriter(object):
+    """
+    Writes an animated GIF one frame at a time, so frames can come straight
+    from memory or a generator and never need to be held all at once:
+
+        with GifWriter(savepath, fps=7) as writer:
+            for frame in frames:
+                writer.append(frame)
+
+    Frames are BGR uint8 numpy arrays (like everything from cv2), and are
+    resized to the size of the first frame if they differ.
+
+    With `palette` (see compute_shared_palette(), or 'shared' to compute one
+    from the first frame) every frame is quantized to one global color table,
+    and only the bounding box of pixels that changed by more than `fuzz`
+    percent is written, with unchanged pixels inside it left transparent.
+    Without it, each frame gets its own adaptive palette.
+    """
+    def __init__(self, savepath, fps=3, loop=0, palette=None, fuzz=0, resize_height=None):
+        self.savepath = savepath
+        self.delay = int(round(100.0 / fps))
+        self.loop = loop
+        self.palette = palette
+        self.fuzz = fuzz
+        self.resize_height = resize_height
+        self.size = None
+        self.num_frames = 0
+        self.previous = None
+        self.global_color_table = None
+        self.f = open(savepath, 'wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def _write_header(self, w, h):
+        self.f.write(b'GIF89a')
+
+        # logical screen descriptor, with the shared palette as global color table
+        if self.global_color_table is not None:
+            self.f.write(struct.pack('<HHBBB', w, h, 0x80 | 0x07, 0, 0))
+            self.f.write(self.global_color_table)
+        else:
+            self.f.write(struct.pack('<HHBBB', w, h, 0, 0, 0))
+
+        # NETSCAPE2.0 application extension so the animation loops
+        self.f.write(b'\x21\xff\x0bNETSCAPE2.0\x03\x01')
+        self.f.write(struct.pack('<H', self.loop))
+        self.f.write(b'\x00')
+
+    def _write_frame(self, color_table, image_data, left=0, top=0, w=None, h=None, transparent_index=None, disposal=1):
+        w = self.size[0] if w is None else w
+        h = self.size[1] if h is None else h
+
+        # graphic control extension: disposal, delay & transparency
+        packed = (disposal << 2) | (1 if transparent_index is not None else 0)
+        self.f.write(struct.pack('<BBBBHBB', 0x21, 0xF9, 4, packed, self.delay,
+            transparent_index or 0, 0))
+
+        # image descriptor, with a local color table only if it differs from the global one
+        bits = color_table_bits(color_table)
+        color_table = color_table.ljust(3 * 2 ** (bits + 1), b'\x00')
+        if color_table == self.global_color_table:
+            self.f.write(struct.pack('<BHHHHB', 0x2C, left, top, w, h, 0))
+        else:
+            self.f.write(struct.pack('<BHHHHB', 0x2C, left, top, w, h, 0x80 | bits))
+            self.f.write(color_table)
+        self.f.write(image_data)
+
+    def _append_delta(self, rgb):
+        # no dithering, so unchanged regions map to identical indices
+        indices = np.array(rgb.quantize(palette=self.palette, dither=0))
+        transparent_index = 255
+        indices[indices == transparent_index] = 0  # same color, see pad_palette()
+
+        if self.previous is None:
+            changed = np.ones(indices.shape, dtype=bool)
+            transparent_index = None
+        else:
+            changed = indices != self.previous
+            if self.fuzz > 0:
+                colors = self.palette_colors
+                distance = np.abs(colors[indices] - colors[self.previous]).max(axis=2)
+                changed &= distance > self.fuzz * 2.55
+
+        if changed.any():
+            rows = np.where(changed.any(axis=1))[0]
+            cols = np.where(changed.any(axis=0))[0]
+            top, bottom, left, right = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+        else:
+            # nothing changed, still emit a (transparent) pixel to keep the timing
+            top, bottom, left, right = 0, 1, 0, 1
+
+        crop = indices[top : bottom, left : right].copy()
+        if transparent_index is not None:
+            crop[~changed[top : bottom, left : right]] = transparent_index
+
+        # keep track of what is actually displayed
+        if self.previous is None:
+            self.previous = indices
+        else:
+            self.previous[changed] = indices[changed]
+
+        h, w = crop.shape
+        paletted = pillow.frombytes('P', (w, h), np.ascontiguousarray(crop).tobytes())
+        paletted.putpalette(self.palette.getpalette())
+        color_table, image_data = encode_gif_frame(paletted)
+        self._write_frame(color_table, image_data, left=int(left), top=int(top), w=w, h=h,
+            transparent_index=transparent_index)
+
+    def append(self, frame):
+        h, w = frame.shape[:2]
+        if self.size is None:
+            if self.resize_height:
+                w, h = int(round(w * self.resize_height / float(h))), self.resize_height
+            self.size = (w, h)
+            if isinstance(self.palette, str):
+                self.palette = compute_shared_palette([frame])
+            if self.palette is not None:
+                palette = pad_palette(self.palette.getpalette())
+                self.palette.putpalette(palette)
+                self.global_color_table = bytes(bytearray(palette))
+                self.palette_colors = np.array(palette, dtype=np.int32).reshape(-1, 3)
+            self._write_header(w, h)
+
+        if (frame.shape[1], frame.shape[0]) != self.size:
+            frame = cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA)
+
+        rgb = pillow.fromarray(np.ascontiguousarray(frame[:, :, [2, 1, 0]]))
+        if self.palette is not None:
+            self._append_delta(rgb)
+        else:
+            paletted = rgb.quantize(colors=256)
+            color_table, image_data = encode_gif_frame(paletted)
+            self._write_frame(color_table, image_data)
+        self.num_frames += 1
+
+    def close(self):
+        if self.f.closed:
+            return
+        self.f.write(b'\x3b')
+        self.f.close()
+
+
+def create_gif_from_frames(frames, savepath, fps=3, fuzz=5, palette_frames=None, resize_height=None):
+    """
+    @param: frames (iterable of BGR numpy arrs) may be a generator
+    @param: fuzz (float) percent color change under which a pixel counts as unchanged
+    @param: palette_frames (list of BGR numpy arrs) frames to compute the shared
+            palette from, otherwise the first frame is used
+    """
+    palette = 'shared' if palette_frames is None else compute_shared_palette(palette_frames)
+    with GifWriter(savepath, fps=fps, palette=palette, fuzz=fuzz, resize_height=resize_height) as writer:
+        for frame in frames:
+            writer.append(frame)
+    return writer.num_frames
+
+def create_gif_from_images(image_paths, savepath, fps=3, fuzz=5, ascending=None, compress=True, resize_height=None, 
+        num_palette_samples=16):
     if ascending is True:
         image_paths.sort(reverse=False)
     elif ascending is False:
-        image_paths.sort()
-
-    tmp_path = os.path.join('/tmp', os.path.basename(savepath))
-    clip = mpy.ImageSequenceClip(image_paths, fps=fps)
-    clip.write_gif(tmp_path, fps=fps, fuzz=fuzz)
-
-    # now compress
-    if compress:
-        try:
-            os.system("du -h %s" % tmp_path)
-            print("Attempting to compress file at: %s" % tmp_path)
-            if resize_height:
-                cmd = "gifsicle -O3 --resize-height %d < %s > %s" % (resize_height, tmp_path, savepath)
-            else:
-                cmd = "gifsicle -O3 < %s > %s" % (tmp_path, savepath)
-            os.system(cmd)
-        except Exception:
-            os.system("cp %s %s" % (tmp_path, savepath))
-    else:
-        os.system("cp %s %s" % (tmp_path, savepath))
-
-    os.remove(tmp_path)
+        image_paths.sort(reverse=True)
+
+    frames = (cv2.imread(path) for path in image_paths)
+    if not compress:
+        # one adaptive palette per frame, every frame written in full
+        with GifWriter(savepath, fps=fps, resize_height=resize_height) as writer:
+            for frame in frames:
+                writer.append(frame)
+        return
+
+    # shared palette from an evenly spaced sample of frames
+    step = max(1, len(image_paths) // num_palette_samples)
+    palette_frames = [cv2.imread(path) for path in image_paths[::step]]
+    create_gif_from_frames(
+        frames, savepath, fps=fps, fuzz=fuzz, 
+        palette_frames=palette_frames, resize_height=resize_height)
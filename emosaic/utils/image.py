@@ -1,9 +1,9 @@
 import numpy as np
 
 import cv2
-import faiss
 
 from emosaic.image import Image
+from emosaic.utils.alpha import alpha_vector, alpha_tile
 
 
 def rotate_bound(image, angle):
@@ -35,27 +35,84 @@ def compute_hw(scale, height_aspect, width_aspect):
   height, width = int(height_aspect * scale), int(width_aspect * scale)
   return height, width
 
-def load_and_vectorize_image(args):
+def load_and_vectorize_aspects(args):
   """
-  @args: (path, h, w, c, aspect_ratio)
-      path (String) to load image from
-      h (int) height
-      w (int) width
-      c (int) number of channels
-      aspect_ratio (float) that is allowed (height / width)
+  Decodes a photo once for every tile size it's indexed at.
+
+  @args: (path, groups, c, use_detect_faces, alpha_background, aspect_tolerance)
+      groups (list of tuples) (aspect_ratio, match_h, match_w, h, w) per index: the aspect
+          ratio photos must have, the size they're vectorized at & the size of their tile
+      aspect_tolerance (float) see aspect_matches
       
-  @return: tuple (Image object, numpy arr of vectorized image), but
-      returns (None, None) if the aspect ratio of the image doesn't match 
-      the argument aspect_ratio given
+  @return: tuple (Image object, list of (vector, tile) per group), None for groups
+      the photo's aspect ratio doesn't fit (& all of them without faces, when detecting)
   """
-  path, h, w, c, aspect_ratio, use_detect_faces = args
-  image = Image(path, detect_faces=use_detect_faces)
+  path, groups, c, use_detect_faces, alpha_background, aspect_tolerance = args
+  image = Image(path, detect_faces=use_detect_faces, keep_alpha=alpha_background is not None)
   img = image.compute_statistics()
-  if image.aspect_ratio == aspect_ratio:
-    v = to_vector(img, h, w, c)
-    return image, v
-  else:
-    return None, None
+  results = []
+  for aspect_ratio, match_h, match_w, h, w in groups:
+    if not aspect_matches(image.aspect_ratio, aspect_ratio, aspect_tolerance) or (use_detect_faces and not image.faces):
+      results.append(None)
+      continue
+    cropped = crop_to_aspect(img, match_h, match_w)
+    if alpha_background is not None:
+      vector = alpha_vector(cropped, match_h, match_w, alpha_background)
+    else:
+      vector = to_vector(cropped, match_h, match_w, c)
+    results.append((vector, to_tile(img, h, w, alpha_background)))
+  return image, results
+
+def aspect_matches(aspect_ratio, target_aspect_ratio, tolerance=0.0):
+  """
+  @param: tolerance (float) relative difference allowed, like 0.1 for 10%, 0 for exactly equal
+  """
+  if not tolerance:
+    return aspect_ratio == target_aspect_ratio
+  return abs(aspect_ratio / float(target_aspect_ratio) - 1) <= tolerance
+
+def crop_to_aspect(img, h, w):
+  """
+  Center crops img to the aspect ratio of an (h, w) tile, so photos a little
+  off get cropped rather than squashed. Photos that resize to (h, w) squashed
+  by less than a pixel are left alone, so photos of the tile's aspect ratio
+  (& their tiles at any nearby size) are never cropped.
+  """
+  img_h, img_w = img.shape[:2]
+  if img_h * w > (h + 1) * img_w:
+    keep = max(1, int(round(img_w * h / float(w))))
+    top = (img_h - keep) // 2
+    return img[top : top + keep]
+  if img_w * h > (w + 1) * img_h:
+    keep = max(1, int(round(img_h * w / float(h))))
+    left = (img_w - keep) // 2
+    return img[:, left : left + keep]
+  return img
+
+def to_tile(img, h, w, alpha_background=None):
+  """
+  @param: alpha_background (None, 'target' or (b, g, r)) for images with alpha, see emosaic.utils.alpha
+
+  @return: img cropped to the aspect ratio of (h, w) & resized to it, what gets pasted into mosaics
+  """
+  img = crop_to_aspect(img, h, w)
+  if alpha_background is not None:
+    return alpha_tile(img, h, w, alpha_background)
+  return cv2.resize(img, (w, h), interpolation=cv2.INTER_AREA)
+
+def parse_aspect(spec):
+  """
+  @param: spec (String) like '4:3', height first like --height-aspect & --width-aspect
+
+  @return: tuple (height_aspect, width_aspect) floats
+  """
+  try:
+    height_aspect, width_aspect = [float(v) for v in spec.split(':')]
+  except ValueError:
+    raise ValueError("Aspect ratios look like 4:3 (height:width), not '%s'" % spec)
+  if height_aspect <= 0 or width_aspect <= 0:
+    raise ValueError("Aspect ratios must be positive, not '%s'" % spec)
+  return height_aspect, width_aspect
 
 def divide_image(img, pixels):
   """
@@ -166,6 +223,17 @@ def make_image_with_noise_background(img_with_alpha):
 
   return img_with_noise
 
+def compute_match_size(h, w, vectorization_scaling_factor=1):
+  """
+  @param: h, w (int) tile size
+  @param: vectorization_scaling_factor (float) how much to shrink tiles by before matching
+
+  @return: tuple (height, width) tiles are vectorized at, at least 1x1
+  """
+  return (
+    max(1, int(round(h * vectorization_scaling_factor))),
+    max(1, int(round(w * vectorization_scaling_factor))))
+
 def to_vector(img, h, w, c=3):
   """
   @param: img (numpy arr), image to vectorize
@@ -176,9 +244,20 @@ def to_vector(img, h, w, c=3):
   @return: np.float32 array of shape: (-1, h * w * c)
   """
   img_h, img_w, _ = img.shape
-  resized = cv2.resize(
-    img, None,
-    fx=h / float(img_h),
-    fy=w / float(img_w),
-    interpolation=cv2.INTER_AREA)
-  return resized.reshape(-1, h * w * c).astype(np.float32)
+  if (img_h, img_w) != (h, w):
+    # cv2 sizes are (width, height)
+    img = cv2.resize(img, (w, h), interpolation=cv2.INTER_AREA)
+  return img.reshape(-1, h * w * c).astype(np.float32)
+
+def upscale_window(region, x, y, out_h, out_w, scale_h, scale_w):
+  """
+  One window of `region` bilinearly resized by (scale_h, scale_w), the
+  same pixels cv2.resize would give for that part of the whole image, so
+  bands & single cells blend identically to a full render.
+
+  @param: x, y (int) top left of the window in resized coordinates
+  """
+  ys = (np.arange(x, x + out_h, dtype=np.float32) + 0.5) / scale_h - 0.5
+  xs = (np.arange(y, y + out_w, dtype=np.float32) + 0.5) / scale_w - 0.5
+  map_x, map_y = np.meshgrid(xs, ys)
+  return cv2.remap(region, map_x, map_y, interpolation=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
@@ -1,15 +1,21 @@
 import time
 import glob
+from multiprocessing import Pool
 from multiprocessing.pool import ThreadPool
 
 import numpy as np
-import faiss
-import cv2 
 
-from emosaic.utils.image import load_and_vectorize_image, compute_hw
+from emosaic.utils.image import load_and_vectorize_aspects, compute_hw, compute_match_size
 from emosaic.utils.misc import is_running_jupyter
 from emosaic import mosaicify
 from emosaic.caching import MosaicCacheConfig
+from emosaic.target import TargetIntegral
+from emosaic.features import get_feature_extractor
+from emosaic.utils.cascade import (
+    build_cascade_index, coarse_vectors, mean_grid_projection, DEFAULT_CASCADE_FACTOR)
+from emosaic.utils.storage import check_storage, compact_matrix, build_storage_index
+from emosaic.variants import parse_variants, check_variants, add_variant_vectors, augment_matrix
+from emosaic.utils.alpha import AlphaMaskedIndex, TARGET_BACKGROUND
 
 if is_running_jupyter():
     from tqdm import tqdm_notebook as tqdm
@@ -17,6 +23,96 @@ else:
     from tqdm import tqdm
 
 
+# codebooks & target shared with render workers: inherited when the pool
+# forks, or sent once per worker by the pool initializer when it spawns
+RENDER_STATE = {}
+
+def init_render_worker(target, integral, scale2codebook, mosaicify_kwargs):
+    RENDER_STATE.update(
+        target=target,
+        integral=integral,
+        scale2codebook=scale2codebook,
+        mosaicify_kwargs=mosaicify_kwargs)
+
+def render_scale(args):
+    """
+    @args: (scale, tile height, tile width, match size)
+
+    @return: tuple (scale, mosaic numpy arr)
+    """
+    import faiss
+
+    scale, h, w, match_size = args
+    serialized_index, tile_images = RENDER_STATE['scale2codebook'][scale]
+    tile_index = faiss.deserialize_index(serialized_index)
+    mosaic, _, _ = mosaicify(
+        RENDER_STATE['target'], h, w, tile_index, tile_images,
+        match_size=match_size,
+        integral=RENDER_STATE['integral'],
+        **RENDER_STATE['mosaicify_kwargs'])
+    return scale, mosaic
+
+def estimate_render_cost(target_shape, h, w):
+    # each scale is one batched search & paste. Distances cover the target's
+    # area whatever the tile size (tiles x pixels per tile), what's left to
+    # differ is the per-tile work (top-k heaps, selection, gathering tiles),
+    # so the number of tiles ranks the scales
+    return max(1, target_shape[0] // h) * max(1, target_shape[1] // w)
+
+def iter_mosaics_at_multiple_scales(
+        target,
+        scale2index,
+        height_aspect,
+        width_aspect,
+        nprocesses=None,
+        vectorization_factor=1,
+        **mosaicify_kwargs):
+    """
+    @param: target (numpy arr) image to render as a mosaic
+    @param: scale2index (dict) of scale => (tile_index, tile_images)
+    @param: nprocesses (int) worker processes, 1 renders in this process
+    @param: vectorization_factor (float) the indexes were built with, see index_images()
+
+    Renders every scale across a process pool, most expensive (smallest)
+    scales first so the pool isn't left waiting on one straggler, and
+    yields (scale, mosaic) as each one finishes.
+    """
+    import faiss
+
+    # built once, every scale's tile vectors are then cheap lookups into it
+    integral = TargetIntegral(target)
+
+    jobs = []
+    for scale in scale2index:
+        h, w = compute_hw(scale, height_aspect, width_aspect)
+        jobs.append((scale, h, w, compute_match_size(h, w, vectorization_factor)))
+    jobs.sort(key=lambda job: estimate_render_cost(target.shape, job[1], job[2]), reverse=True)
+
+    if nprocesses == 1:
+        for scale, h, w, match_size in jobs:
+            tile_index, tile_images = scale2index[scale]
+            mosaic, _, _ = mosaicify(
+                target, h, w, tile_index, tile_images,
+                match_size=match_size, integral=integral, **mosaicify_kwargs)
+            yield scale, mosaic
+        return
+
+    # faiss indexes can't be pickled, ship them serialized
+    scale2codebook = {}
+    for scale, (tile_index, tile_images) in scale2index.items():
+        scale2codebook[scale] = (faiss.serialize_index(tile_index), tile_images)
+
+    pool = Pool(
+        nprocesses,
+        initializer=init_render_worker,
+        initargs=(target, integral, scale2codebook, mosaicify_kwargs))
+    try:
+        for scale, mosaic in pool.imap_unordered(render_scale, jobs):
+            yield scale, mosaic
+    finally:
+        pool.close()
+        pool.join()
+
 def index_at_multiple_scales(
         codebook_dir,
         min_scale,
@@ -30,41 +126,41 @@ def index_at_multiple_scales(
         randomness=0.0,
         caching=True,
         use_detect_faces=True,
+        nprocesses=None,
     ):
     scale2index = {}
     scale2mosaic = {}
-    count = 0
     scales = range(min_scale, max_scale + 1, 1)
     aspect_ratio = height_aspect / float(width_aspect)
 
-    with tqdm(total=len(scales)) as pbar:
-        for scale in scales:
-            print("Indexing scale=%d..." % scale)
-            h, w = compute_hw(scale, height_aspect, width_aspect)
-            tile_index, _, tile_images = index_images(
-                paths='%s/*.jpg' % codebook_dir,
-                aspect_ratio=aspect_ratio, 
-                height=h, width=w,
-                vectorization_scaling_factor=vectorization_factor,
-                caching=True,
-                use_detect_faces=use_detect_faces,
-            )
-            scale2index[scale] = (tile_index, tile_images)
-
-            # then precompute the mosaic 
-            h, w = compute_hw(scale, height_aspect, width_aspect)
-
-            # mosaic-ify & show it
-            if precompute_target is not None:
-                mosaic, _, _ = mosaicify(
-                    precompute_target, h, w, tile_index, tile_images, 
-                    use_stabilization=use_stabilization,
-                    stabilization_threshold=stabilization_threshold,
-                    randomness=randomness)
-                scale2mosaic[scale] = mosaic
+    # every scale from one decode of each photo
+    print("Indexing scales %d to %d..." % (min_scale, max_scale))
+    results = index_images_at_sizes(
+        paths='%s/*.jpg' % codebook_dir,
+        sizes=[compute_hw(scale, height_aspect, width_aspect) for scale in scales],
+        aspect_ratios=[aspect_ratio] * len(scales),
+        vectorization_scaling_factor=vectorization_factor,
+        caching=caching,
+        use_detect_faces=use_detect_faces,
+    )
+    for scale, (tile_index, _, tile_images) in zip(scales, results):
+        scale2index[scale] = (tile_index, tile_images)
 
-            count += 1
-            pbar.update(1)
+    # then precompute the mosaics, in parallel
+    if precompute_target is not None:
+        mosaics = iter_mosaics_at_multiple_scales(
+            precompute_target, scale2index,
+            height_aspect, width_aspect,
+            nprocesses=nprocesses,
+            vectorization_factor=vectorization_factor,
+            use_stabilization=use_stabilization,
+            stabilization_threshold=stabilization_threshold,
+            randomness=randomness)
+
+        with tqdm(desc='Rendering', total=len(scales)) as pbar:
+            for scale, mosaic in mosaics:
+                scale2mosaic[scale] = mosaic
+                pbar.update(1)
 
     return scale2index, scale2mosaic
 
@@ -75,26 +171,140 @@ def index_images(
         width, 
         nchannels=3, 
         vectorization_scaling_factor=1, 
-        index_class=faiss.IndexFlatL2,
+        index_class=None,
         verbose=1,
         caching=True,
         use_detect_faces=False,
-        nprocesses=4):
+        nprocesses=4,
+        match_size=None,
+        cascade_grid=None,
+        cascade_factor=DEFAULT_CASCADE_FACTOR,
+        feature=None,
+        storage='float32',
+        variants=None,
+        alpha_background=None,
+        aspect_tolerance=0.0):
     """
     @param: paths (list of Strings OR glob pattern string) image paths to load
     @param: aspect_ratio (float) height / width
-    @param: height (int) desired height of tile images
+    @param: height (int) desired height of tile images (the render size, what gets pasted into mosaics)
     @param: width (int) desired width of tile images
     @param: nchannels (int) number of channels in image
-    @param: vectorization_scaling_factor (float) the factor to multiply by for the vectorization
-            values smaller than 1 will save memory space at the cost of quality of matches because the
-            image will be downsized before vectorization
-    @param: index_class (Faiss Index class) the ANN class to lookup codebook images with
+    @param: vectorization_scaling_factor (float) the factor to shrink tiles by before vectorizing,
+            values smaller than 1 save memory & search time at the cost of quality of matches
+    @param: index_class (Faiss Index class) the ANN class to lookup codebook images with,
+            defaults to faiss.IndexFlatL2
+    @param: match_size (tuple of ints) (height, width) images are vectorized at, overrides
+            vectorization_scaling_factor. Queries must be vectorized at the same size.
+    @param: cascade_grid (tuple of ints) (rows, cols) of a mean color grid to shortlist matches
+            with before scoring them in full (see build_cascade_index), index_class is then
+            used for the shortlisting. None searches every vector in full.
+    @param: cascade_factor (int) shortlisted candidates per match asked for
+    @param: feature (String) what tiles are compared on, like 'lab' or 'grid:4' (see emosaic.features),
+            queries must use the same one. Defaults to raw pixels.
+    @param: storage (String) 'float32', 'float16' or 'uint8', how codebook vectors are kept in
+            memory & in the cache (see emosaic.utils.storage). Compact storage uses a scalar
+            quantizer index in place of index_class, uint8 is exact for raw & lab pixels.
+    @param: variants (String or list) flips & rotations to also match every photo as, like
+            'hflip,rot180' (see emosaic.variants). They're only added to the index, ids
+            of variants are `slot * len(images) + image id`.
+    @param: alpha_background (None, 'target' or (b, g, r)) keep codebook transparency (see
+            emosaic.utils.alpha): composite over a color as photos are loaded, or compare only
+            their opaque parts & composite over the target when rendering ('target', which
+            returns an AlphaMaskedIndex & premultiplied BGRA tile_images)
+    @param: aspect_tolerance (float) also use photos whose aspect ratio is this close (relative,
+            like 0.1), cropped to aspect_ratio. 0 only uses photos of exactly aspect_ratio.
+
+    See index_images_at_sizes to index several sizes & aspect ratios in one pass.
     """
+    return index_images_at_sizes(
+        paths, [(height, width)],
+        aspect_ratios=[aspect_ratio],
+        match_sizes=[match_size],
+        nchannels=nchannels,
+        vectorization_scaling_factor=vectorization_scaling_factor,
+        index_class=index_class,
+        verbose=verbose,
+        caching=caching,
+        use_detect_faces=use_detect_faces,
+        nprocesses=nprocesses,
+        cascade_grid=cascade_grid,
+        cascade_factor=cascade_factor,
+        feature=feature,
+        storage=storage,
+        variants=variants,
+        alpha_background=alpha_background,
+        aspect_tolerance=aspect_tolerance)[0]
+
+def index_images_at_sizes(
+        paths,
+        sizes,
+        aspect_ratios=None,
+        match_sizes=None,
+        nchannels=3,
+        vectorization_scaling_factor=1,
+        index_class=None,
+        verbose=1,
+        caching=True,
+        use_detect_faces=False,
+        nprocesses=4,
+        cascade_grid=None,
+        cascade_factor=DEFAULT_CASCADE_FACTOR,
+        feature=None,
+        storage='float32',
+        variants=None,
+        alpha_background=None,
+        aspect_tolerance=0.0):
+    """
+    Indexes a codebook for several tile sizes & aspect ratios at once, decoding
+    every photo only once. Each size gets its own index of the photos whose
+    aspect ratio matches its own (within aspect_tolerance), cached exactly as
+    index_images would, so one run fills the cache for all of them:
+
+        sizes = [compute_hw(scale, 4, 3), compute_hw(scale, 3, 4), compute_hw(scale, 9, 16)]
+        for tile_index, images, tile_images in index_images_at_sizes(paths, sizes, aspect_tolerance=0.1):
+            ...
+
+    @param: sizes (list of tuples) (height, width) of the tiles of every index
+    @param: aspect_ratios (list of floats) height / width photos must have for each size,
+            defaults to the sizes' own
+    @param: match_sizes (list of tuples) (height, width) each size is vectorized at, defaults
+            to the sizes shrunk by vectorization_scaling_factor
+
+    The rest are as for index_images.
+
+    @return: list of (tile_index, images, tile_images) tuples, one per size, tile_images
+             a (num images, height, width, channels) uint8 array
+    """
+    if index_class is None:
+        import faiss
+        index_class = faiss.IndexFlatL2
+
     try:
-        # index our images
-        vectorization_dimensionality = int(height * width * nchannels * vectorization_scaling_factor)
-        index = index_class(vectorization_dimensionality)  
+        sizes = [tuple(size) for size in sizes]
+        if aspect_ratios is None:
+            aspect_ratios = [h / float(w) for h, w in sizes]
+        if match_sizes is None:
+            match_sizes = [None] * len(sizes)
+        match_sizes = [
+            tuple(match_size or compute_match_size(h, w, vectorization_scaling_factor))
+            for (h, w), match_size in zip(sizes, match_sizes)]
+
+        extractor = get_feature_extractor(feature)
+        if cascade_grid and not extractor.pixel_layout:
+            raise ValueError("Cascade indexes need pixel features, not '%s'" % extractor.spec)
+        check_storage(storage)
+        if storage == 'uint8' and not extractor.nonnegative:
+            raise ValueError("uint8 storage can't hold '%s' features, use float16" % extractor.spec)
+        variants = parse_variants(variants)
+        if len(variants) > 1:
+            if not extractor.pixel_layout:
+                raise ValueError("Variants need pixel features, not '%s'" % extractor.spec)
+            for size, match_size in zip(sizes, match_sizes):
+                check_variants(variants, match_size, size)
+        masked = alpha_background == TARGET_BACKGROUND
+        if masked and (extractor.spec != 'raw' or cascade_grid or storage != 'float32' or len(variants) > 1):
+            raise ValueError("Matching over the target's background only works with raw pixels, flat float32 indexes")
 
         # create our pool and go!
         starttime = time.time()
@@ -103,84 +313,121 @@ def index_images(
             # paths is a glob pattern like: 'images/blah/*.jpg'
             paths = glob.glob(paths)
 
-        # should we retrieve a cached index?
+        results = [None] * len(sizes)
+        caches = [None] * len(sizes)
+
+        # should we retrieve cached indexes?
         if caching:
             print("Caching is ON, checking for previously cached index...")
-            cache = MosaicCacheConfig(
-                paths=paths,
-                height=height,
-                width=width,
-                nchannels=nchannels,
-                index_class=index_class,
-                dimensions=vectorization_dimensionality,
-                detect_faces=use_detect_faces)
-            cached = cache.load()
-            if cached is not None:
-                print("Found cached index, reading from disk...")
-                return cached['index'], cached['images'], cached['tile_images']
-            else:
-                print("No cached index found, creating from scratch...")
+            for i, ((height, width), (match_h, match_w)) in enumerate(zip(sizes, match_sizes)):
+                # (sorts paths, which sets the order of the index)
+                caches[i] = MosaicCacheConfig(
+                    paths=paths,
+                    height=height,
+                    width=width,
+                    nchannels=nchannels,
+                    index_class=index_class,
+                    dimensions=extractor.dimensions(match_h, match_w, nchannels),
+                    detect_faces=use_detect_faces,
+                    match_size=(match_h, match_w),
+                    cascade_grid=cascade_grid,
+                    feature=extractor.spec,
+                    storage=storage,
+                    variants=variants,
+                    alpha_background=alpha_background,
+                    aspect_tolerance=aspect_tolerance)
+                cached = caches[i].load()
+                if cached is not None:
+                    print("Found cached index for (%d, %d) tiles, reading from disk..." % (height, width))
+                    if cascade_grid:
+                        cached['index'].k_factor = cascade_factor
+                    results[i] = (cached['index'], cached['images'], np.asarray(cached['tile_images']))
+            if all(result is not None for result in results):
+                return results
+            print("No cached index found, creating from scratch...")
 
-        # nothing cached, let's index
-        path_jobs = [(p, height, width, nchannels, aspect_ratio, use_detect_faces) for p in paths]  #[:200]
+        # nothing cached, let's index: each photo is decoded once for every size still missing
+        todo = [i for i, result in enumerate(results) if result is None]
+        groups = [(aspect_ratios[i],) + match_sizes[i] + sizes[i] for i in todo]
+        path_jobs = [(p, groups, nchannels, use_detect_faces, alpha_background, aspect_tolerance) for p in paths]
         pool = ThreadPool(nprocesses)
-        results = pool.map(load_and_vectorize_image, path_jobs)
+        loaded = pool.map(load_and_vectorize_aspects, path_jobs)
         pool.close()
 
         # how fast did we go?
         elapsed = time.time() - starttime
         if verbose:
             print("Indexing: %d images, %.4f seconds (%.4f per image)" % (
-                len(path_jobs), elapsed, elapsed / len(path_jobs)))
-
-        # get the results, store in ordered (indexed) list
-        images = []
-        vectors = []
-        for image, vector in results:
-            if image is not None and vector is not None:
-                if use_detect_faces and not image.faces:
-                    # if we're told to use faces, skip any images
-                    # without them
+                len(path_jobs), elapsed, elapsed / max(1, len(path_jobs))))
+
+        for g, i in enumerate(todo):
+            (height, width), (match_h, match_w) = sizes[i], match_sizes[i]
+
+            # get the results, store in ordered (indexed) list
+            images = []
+            vectors = []
+            tile_images = []
+            for image, per_group in loaded:
+                if per_group[g] is not None:
+                    vector, tile = per_group[g]
+                    # pixel vectors are whole numbers 0-255, so uint8 holds them exactly
+                    vectors.append(vector if storage == 'float32' else vector.astype(np.uint8))
+                    images.append(image)
+                    tile_images.append(tile)
+                    per_group[g] = None
+
+            if verbose and len(sizes) > 1:
+                print("(%d, %d) tiles: %d images" % (height, width, len(images)))
+            if use_detect_faces:
+                print("Using only images with faces: total=%d, withfaces=%d" % (
+                    len(path_jobs), len(images)))
+
+                if not images:
+                    print("No images contained faces :( Exiting and returning None's")
+                    results[i] = (None, None, None)
                     continue
-                vectors.append(vector)
-                images.append(image)
-
-        if use_detect_faces:
-            print("Using only images with faces: total=%d, withfaces=%d" % (
-                len(results), len(images)))
-
-            if not images:
-                print("No images contained faces :( Exiting and returning None's")
-                return None, None, None
-                
-        # create matrix and index
-        matrix = np.array(vectors).reshape(-1, vectorization_dimensionality)
-        index.add(matrix)
-
-        # resize images to tiles
-        if verbose:
-            print("Resizing images to (%d, %d)..." % (height, width))
-        tile_images = []
-        for image in images:
-            img = image.load_image()
-            img_h, img_w, _ = img.shape
-            tile = cv2.resize(
-                img,
-                None,
-                fx=height / float(img_h),
-                fy=width / float(img_w),
-                interpolation=cv2.INTER_AREA)
-            tile_images.append(tile)
 
-        if caching:
-            print("Caching index to disk...")
-            cache.save(matrix, images, tile_images)
+            # create matrix and index
+            vectorization_dimensionality = match_h * match_w * nchannels
+            if masked:
+                # plus the alpha channel
+                vectorization_dimensionality = match_h * match_w * (nchannels + 1)
+            matrix = np.array(vectors).reshape(-1, vectorization_dimensionality)
+            del vectors
+            if extractor.spec != 'raw':
+                matrix = extractor.vectors(matrix, match_h, match_w, nchannels)
+            if storage != 'float32':
+                matrix = compact_matrix(matrix, storage)
+            coarse_matrix = None
+            if masked:
+                # premultiplied BGRA vectors, compared only where they're opaque
+                index = AlphaMaskedIndex(matrix, nchannels)
+            elif cascade_grid:
+                projection = mean_grid_projection(match_h, match_w, nchannels, *cascade_grid)
+                # the refine stage needs every vector at once, variants too
+                full_matrix = augment_matrix(matrix, variants, match_h, match_w, nchannels) if len(variants) > 1 else matrix
+                coarse_matrix = coarse_vectors(full_matrix, projection)
+                index = build_cascade_index(
+                    full_matrix, (match_h, match_w), nchannels, cascade_grid,
+                    cascade_factor=cascade_factor, coarse_class=index_class, coarse_matrix=coarse_matrix,
+                    storage=storage)
+            else:
+                index = build_storage_index(matrix, storage, index_class=index_class)
+                add_variant_vectors(index, matrix, variants, match_h, match_w, nchannels)
+
+            # one array, so rendering indexes into it rather than copying a list of tiles every time
+            channels = nchannels + 1 if masked else nchannels
+            tile_images = np.array(tile_images, dtype=np.uint8).reshape(len(tile_images), height, width, channels)
 
-        return index, images, tile_images
+            if caching:
+                print("Caching index to disk...")
+                caches[i].save(matrix, images, tile_images, coarse_matrix=coarse_matrix)
+
+            results[i] = (index, images, tile_images)
+
+        return results
 
     except Exception:
         import traceback
         print(traceback.format_exc())
-        import ipdb; ipdb.set_trace()
-        return None, None, None
-
+        raise
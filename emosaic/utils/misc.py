@@ -1,4 +1,13 @@
+import collections
+import itertools
 import os
+import sys
+import time
+
+try:
+    import builtins
+except ImportError:
+    import __builtin__ as builtins
 
 def ensure_directory(directory):
     if not os.path.exists(directory):
@@ -9,3 +18,64 @@ def is_running_jupyter():
         return type(get_ipython()).__module__.startswith('ipykernel.')
     except NameError:
         return False
+
+class ImportTimer(object):
+    """
+    Context manager that records how long each top-level package takes
+    to import while active, so slow startups are visible:
+
+        with ImportTimer() as timer:
+            import faiss
+        timer.report()
+    """
+    def __init__(self):
+        self.timings = {}
+        self._depth = 0
+        self._original_import = None
+
+    def __enter__(self):
+        self._original_import = builtins.__import__
+        builtins.__import__ = self._timed_import
+        return self
+
+    def __exit__(self, *exc_info):
+        builtins.__import__ = self._original_import
+        return False
+
+    def _timed_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        # only time the outermost import of modules we haven't seen yet
+        if self._depth or level or name in sys.modules:
+            return self._original_import(name, globals, locals, fromlist, level)
+
+        self._depth += 1
+        starttime = time.time()
+        try:
+            return self._original_import(name, globals, locals, fromlist, level)
+        finally:
+            self._depth -= 1
+            package = name.split('.')[0]
+            self.timings[package] = self.timings.get(package, 0.0) + time.time() - starttime
+
+    def report(self, top=15):
+        total = sum(self.timings.values())
+        print("=== Import times (total=%.3f secs) ===" % total)
+        ranked = sorted(self.timings.items(), key=lambda kv: kv[1], reverse=True)
+        for package, elapsed in ranked[:top]:
+            print("%8.3f secs  %s" % (elapsed, package))
+
+def imap_bounded(pool, func, iterable, window=32):
+    """
+    Like pool.imap(func, iterable), yielding results in order, but never
+    has more than `window` jobs submitted or results waiting at once, so
+    memory stays flat no matter how long `iterable` is.
+    """
+    jobs = iter(iterable)
+    pending = collections.deque()
+    for job in itertools.islice(jobs, window):
+        pending.append(pool.apply_async(func, (job,)))
+
+    while pending:
+        result = pending.popleft().get()
+        for job in itertools.islice(jobs, 1):
+            pending.append(pool.apply_async(func, (job,)))
+        yield result
@@ -0,0 +1,162 @@
+import collections
+from multiprocessing import Pool
+
+import numpy as np
+import cv2
+
+from emosaic.utils.image import compute_hw, compute_match_size
+from emosaic.target import TargetIntegral
+
+# target & settings shared with render workers, see init_scale_worker()
+SCALE_WORKER_STATE = {}
+
+def init_scale_worker(target, codebook_dir, height_aspect, width_aspect, index_kwargs, num_candidates):
+    SCALE_WORKER_STATE.update(
+        target=target,
+        integral=TargetIntegral(target),
+        codebook_dir=codebook_dir,
+        height_aspect=height_aspect,
+        width_aspect=width_aspect,
+        index_kwargs=index_kwargs,
+        num_candidates=num_candidates)
+
+def search_candidates_at_scale(scale):
+    """
+    Indexes the codebook (usually a cache hit) and searches the top
+    candidates for every tile of the shared target at `scale`, in a worker
+    process. Selecting & pasting tiles is left to the caller, so it can be
+    redone with new settings without searching again.
+
+    @return: tuple (scale, TileCandidates, tile_images), the latter two None if indexing failed
+    """
+    from emosaic.candidates import TileCandidates
+    from emosaic.utils.indexing import index_images
+
+    state = SCALE_WORKER_STATE
+    h, w = compute_hw(scale, state['height_aspect'], state['width_aspect'])
+    tile_index, _, tile_images = index_images(
+        paths='%s/*.jpg' % state['codebook_dir'],
+        aspect_ratio=state['height_aspect'] / float(state['width_aspect']),
+        height=h, width=w,
+        verbose=0,
+        **state['index_kwargs'])
+    if tile_index is None:
+        return scale, None, None
+
+    match_size = compute_match_size(h, w, state['index_kwargs'].get('vectorization_scaling_factor', 1))
+    candidates = TileCandidates.search(
+        state['target'], h, w, tile_index, k=state['num_candidates'], match_size=match_size,
+        integral=state['integral'], feature=state['index_kwargs'].get('feature'))
+    return scale, candidates, np.asarray(tile_images)
+
+def preview_at_scale(target, scale, height_aspect, width_aspect, integral=None):
+    """
+    Instant stand-in for a mosaic: every tile filled with the mean color
+    of the target region it covers, cropped to the tiled area like a render.
+
+    @param: integral (TargetIntegral) of target, makes the tile means a few lookups
+    """
+    h, w = compute_hw(scale, height_aspect, width_aspect)
+    target_h, target_w = target.shape[:2]
+    if integral is not None and h <= target_h and w <= target_w:
+        means, (rows, cols), _ = integral.grid_means(h, w, match_size=(1, 1))
+    else:
+        rows, cols = max(1, target_h // h), max(1, target_w // w)
+        x0, y0 = (target_h % h) // 2, (target_w % w) // 2
+        region = target[x0 : x0 + rows * h, y0 : y0 + cols * w]
+        means = cv2.resize(region, (cols, rows), interpolation=cv2.INTER_AREA)
+    return cv2.resize(means, (cols * w, rows * h), interpolation=cv2.INTER_NEAREST)
+
+
+class ScaleRenderer(object):
+    """
+    Renders mosaics of one target on demand, one scale at a time. The tile
+    searches run on background worker processes:
+
+        renderer = ScaleRenderer(target, codebook_dir, 4, 3)
+        mosaic = renderer.get(scale, best_k=2, opacity=0.1)  # None until it's ready
+        if mosaic is None:
+            mosaic = renderer.preview(scale)
+
+    Asking for a scale also prefetches its `prefetch` neighbours on either
+    side. The search results (TileCandidates) of at most `max_cached` scales
+    are kept, least recently used are dropped first, so changing selection
+    or opacity settings re-renders in milliseconds.
+    """
+    def __init__(self, 
+            target, 
+            codebook_dir, 
+            height_aspect, 
+            width_aspect, 
+            min_scale=1,
+            max_scale=None,
+            max_cached=8, 
+            prefetch=1, 
+            nprocesses=2,
+            index_kwargs=None,
+            num_candidates=8):
+        self.target = target
+        self.integral = TargetIntegral(target)
+        self.height_aspect = height_aspect
+        self.width_aspect = width_aspect
+        self.min_scale = min_scale
+        self.max_scale = max_scale
+        self.max_cached = max_cached
+        self.prefetch = prefetch
+        self.rendered = collections.OrderedDict()
+        self.pending = {}
+        self.pool = Pool(
+            nprocesses,
+            initializer=init_scale_worker,
+            initargs=(target, codebook_dir, height_aspect, width_aspect, 
+                index_kwargs or {}, num_candidates))
+
+    def _is_valid(self, scale):
+        if scale < self.min_scale:
+            return False
+        return self.max_scale is None or scale <= self.max_scale
+
+    def _schedule(self, scale):
+        if not self._is_valid(scale) or scale in self.rendered or scale in self.pending:
+            return
+        self.pending[scale] = self.pool.apply_async(search_candidates_at_scale, (scale,))
+
+    def _collect(self):
+        for scale, result in list(self.pending.items()):
+            if result.ready():
+                del self.pending[scale]
+                _, candidates, tile_images = result.get()
+                if candidates is not None:
+                    self.rendered[scale] = (candidates, tile_images)
+        while len(self.rendered) > self.max_cached:
+            self.rendered.popitem(last=False)
+
+    def request(self, scale):
+        self._schedule(scale)
+        for offset in range(1, self.prefetch + 1):
+            self._schedule(scale - offset)
+            self._schedule(scale + offset)
+
+    def get(self, scale, best_k=1, uniform_k=True, randomness=0.0, opacity=0.0, exclude=None, seed=0):
+        """
+        @return: mosaic at `scale` with these selection & blending settings,
+                 or None if its search is still running
+        """
+        self.request(scale)
+        self._collect()
+        if scale not in self.rendered:
+            return None
+        self.rendered[scale] = self.rendered.pop(scale)  # mark as recently used
+
+        candidates, tile_images = self.rendered[scale]
+        ids = candidates.select(
+            best_k=best_k, uniform_k=uniform_k, randomness=randomness, exclude=exclude,
+            num_images=len(tile_images), seed=seed)
+        return candidates.render(tile_images, ids, self.target, opacity=opacity)
+
+    def preview(self, scale):
+        return preview_at_scale(self.target, scale, self.height_aspect, self.width_aspect, integral=self.integral)
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
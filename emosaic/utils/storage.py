@@ -0,0 +1,61 @@
+import numpy as np
+
+"""
+How codebook vectors are kept in memory & in the cache:
+
+    'float32'   a flat index, exact (the default)
+    'float16'   half the memory, distances off by a tiny fraction
+    'uint8'     a quarter of the memory, exact for pixel features (raw & lab)
+
+Compact storage uses faiss scalar quantizer indexes, which decode vectors
+on the fly while searching, so nothing is ever held as float32.
+"""
+
+STORAGE_TYPES = ('float32', 'float16', 'uint8')
+
+# rows converted to float32 at a time when filling an index
+ADD_CHUNK_ROWS = 4096
+
+
+def check_storage(storage):
+    if storage not in STORAGE_TYPES:
+        raise ValueError("Unknown storage '%s', choose from: %s" % (storage, ', '.join(STORAGE_TYPES)))
+
+def compact_matrix(matrix, storage):
+    """
+    @return: matrix in the dtype `storage` keeps it as (uint8 rounded & clipped to 0-255)
+    """
+    check_storage(storage)
+    if storage == 'uint8':
+        return np.clip(np.rint(matrix), 0, 255).astype(np.uint8)
+    return np.asarray(matrix, dtype=np.dtype(storage))
+
+def make_storage_index(dimensions, storage, index_class=None):
+    """
+    @param: index_class (Faiss Index class) used for float32 storage, defaults to faiss.IndexFlatL2
+    """
+    import faiss
+
+    check_storage(storage)
+    if storage == 'float32':
+        return (index_class or faiss.IndexFlatL2)(dimensions)
+    qtype = faiss.ScalarQuantizer.QT_fp16 if storage == 'float16' else faiss.ScalarQuantizer.QT_8bit_direct
+    return faiss.IndexScalarQuantizer(dimensions, qtype, faiss.METRIC_L2)
+
+def add_in_chunks(index, matrix, chunk_rows=ADD_CHUNK_ROWS, columns=None):
+    """
+    Adds a (possibly compact) matrix to a faiss index a few rows at a
+    time, so only one chunk is ever converted to float32.
+
+    @param: columns (int array) to reorder every row by first (see emosaic.variants)
+    """
+    for start in range(0, len(matrix), chunk_rows):
+        chunk = matrix[start : start + chunk_rows]
+        if columns is not None:
+            chunk = chunk[:, columns]
+        index.add(np.ascontiguousarray(chunk, dtype=np.float32))
+    return index
+
+def build_storage_index(matrix, storage, index_class=None):
+    index = make_storage_index(matrix.shape[1], storage, index_class=index_class)
+    return add_in_chunks(index, matrix)
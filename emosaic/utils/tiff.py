@@ -0,0 +1,159 @@
+import os
+import struct
+
+import cv2
+import numpy as np
+
+# baseline TIFF tags we write, see the TIFF 6.0 spec
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+PHOTOMETRIC = 262
+STRIP_OFFSETS = 273
+SAMPLES_PER_PIXEL = 277
+ROWS_PER_STRIP = 278
+STRIP_BYTE_COUNTS = 279
+PLANAR_CONFIG = 284
+
+SHORT, LONG, LONG8 = 3, 4, 16
+
+# classic TIFF uses 32 bit offsets, past this we switch to BigTIFF
+CLASSIC_TIFF_LIMIT = 2 ** 32 - 2 ** 20
+
+
+class StripTiffWriter(object):
+    """
+    Writes an uncompressed RGB TIFF one horizontal strip at a time, so an
+    image bigger than memory can be written as it's rendered:
+
+        with StripTiffWriter(savepath, height, width) as writer:
+            for band in bands:
+                writer.append(band)
+
+    Bands are BGR uint8 numpy arrays (like everything from cv2), full width,
+    top to bottom, of any height. If the block raises, the file is removed.
+    Images too big for 32 bit offsets are written as BigTIFF, which libtiff,
+    Pillow, GDAL & co all read.
+    """
+    def __init__(self, savepath, height, width, bigtiff=None):
+        self.savepath = savepath
+        self.height = height
+        self.width = width
+        if bigtiff is None:
+            bigtiff = height * width * 3 > CLASSIC_TIFF_LIMIT
+        self.bigtiff = bigtiff
+        self.rows_written = 0
+        self.strip_offsets = []
+        self.strip_byte_counts = []
+        self.rows_per_strip = None
+        self.f = open(savepath, 'wb')
+
+        # header, the IFD offset is filled in on close()
+        if self.bigtiff:
+            self.f.write(b'II' + struct.pack('<HHHQ', 43, 8, 0, 0))
+        else:
+            self.f.write(b'II' + struct.pack('<HI', 42, 0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if exc_info[0] is not None:
+            # rendering failed, don't hide why behind the missing rows or leave half a file
+            self.abort()
+        else:
+            self.close()
+        return False
+
+    def abort(self):
+        """
+        Closes & removes the unfinished file.
+        """
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+        if os.path.exists(self.savepath):
+            os.remove(self.savepath)
+
+    def append(self, band_bgr):
+        h, w = band_bgr.shape[:2]
+        if w != self.width:
+            raise ValueError("Strip is %d pixels wide, expected %d" % (w, self.width))
+        if self.rows_written + h > self.height:
+            raise ValueError("More rows than the %d declared" % self.height)
+
+        # readers expect every strip but the last to be RowsPerStrip tall
+        if self.rows_per_strip is None:
+            self.rows_per_strip = h
+        elif h != self.rows_per_strip and self.rows_written + h != self.height:
+            raise ValueError("Only the last strip may differ in height (%d != %d)" % (h, self.rows_per_strip))
+        elif self.strip_byte_counts[-1] != self.rows_per_strip * self.width * 3:
+            raise ValueError("A short strip must be the last one")
+
+        data = cv2.cvtColor(np.ascontiguousarray(band_bgr), cv2.COLOR_BGR2RGB).tobytes()
+        self.strip_offsets.append(self.f.tell())
+        self.strip_byte_counts.append(len(data))
+        self.f.write(data)
+        self.rows_written += h
+
+    def _write_array(self, values, dtype):
+        if self.f.tell() % 2:
+            self.f.write(b'\0')
+        offset = self.f.tell()
+        self.f.write(np.asarray(values, dtype=dtype).tobytes())
+        return offset
+
+    def close(self):
+        if self.f is None:
+            return
+        if self.rows_written != self.height:
+            self.f.close()
+            self.f = None
+            raise IOError("Only %d of %d rows were written to '%s'" % (self.rows_written, self.height, self.savepath))
+
+        offset_type = LONG8 if self.bigtiff else LONG
+        offset_dtype = '<u8' if self.bigtiff else '<u4'
+        inline_bytes = 8 if self.bigtiff else 4
+
+        def entry(tag, type_, values):
+            values = list(values)
+            dtype = {SHORT: '<u2', LONG: '<u4', LONG8: '<u8'}[type_]
+            data = np.asarray(values, dtype=dtype).tobytes()
+            if len(data) <= inline_bytes:
+                return (tag, type_, len(values), data.ljust(inline_bytes, b'\0'))
+            offset = self._write_array(values, dtype)
+            return (tag, type_, len(values), struct.pack('<Q' if self.bigtiff else '<I', offset))
+
+        entries = [
+            entry(IMAGE_WIDTH, LONG, [self.width]),
+            entry(IMAGE_LENGTH, LONG, [self.height]),
+            entry(BITS_PER_SAMPLE, SHORT, [8, 8, 8]),
+            entry(COMPRESSION, SHORT, [1]),
+            entry(PHOTOMETRIC, SHORT, [2]),
+            entry(STRIP_OFFSETS, offset_type, self.strip_offsets),
+            entry(SAMPLES_PER_PIXEL, SHORT, [3]),
+            entry(ROWS_PER_STRIP, LONG, [self.rows_per_strip or self.height]),
+            entry(STRIP_BYTE_COUNTS, offset_type, self.strip_byte_counts),
+            entry(PLANAR_CONFIG, SHORT, [1]),
+        ]
+
+        if self.f.tell() % 2:
+            self.f.write(b'\0')
+        ifd_offset = self.f.tell()
+        if self.bigtiff:
+            self.f.write(struct.pack('<Q', len(entries)))
+            for tag, type_, count, value in entries:
+                self.f.write(struct.pack('<HHQ', tag, type_, count) + value)
+            self.f.write(struct.pack('<Q', 0))
+            self.f.seek(8)
+            self.f.write(struct.pack('<Q', ifd_offset))
+        else:
+            self.f.write(struct.pack('<H', len(entries)))
+            for tag, type_, count, value in entries:
+                self.f.write(struct.pack('<HHI', tag, type_, count) + value)
+            self.f.write(struct.pack('<I', 0))
+            self.f.seek(4)
+            self.f.write(struct.pack('<I', ifd_offset))
+        self.f.close()
+        self.f = None
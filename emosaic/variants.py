@@ -0,0 +1,122 @@
+import numpy as np
+
+"""
+Flipped & rotated versions of codebook photos, without storing them. A
+variant's vector is just the photo's vector with its pixels shuffled, so
+the index gets one permuted copy of the codebook per variant while the
+tiles (& the decoding, resizing) stay as they are:
+
+    variants = parse_variants('hflip,rot180')       # ('identity', 'hflip', 'rot180')
+    add_variant_vectors(index, matrix, variants, match_h, match_w, 3)
+
+Index ids then encode which variant matched, `slot * num_images + image`,
+and tiles are flipped / transposed from the stored bitmap when pasted:
+
+    images, slots = decode_ids(ids, num_images)
+    tiles = variant_tiles(tile_images, ids, variants)
+
+Rotations by 90 degrees only work for square tiles.
+"""
+
+# name => (function of a (..., h, w, c) array, needs square tiles)
+VARIANTS = {
+    'identity': (lambda tiles: tiles, False),
+    'hflip': (lambda tiles: tiles[..., :, ::-1, :], False),
+    'vflip': (lambda tiles: tiles[..., ::-1, :, :], False),
+    'rot180': (lambda tiles: tiles[..., ::-1, ::-1, :], False),
+    'rot90': (lambda tiles: np.swapaxes(tiles, -3, -2)[..., ::-1, :, :], True),
+    'rot270': (lambda tiles: np.swapaxes(tiles, -3, -2)[..., :, ::-1, :], True),
+}
+
+
+def parse_variants(spec=None):
+    """
+    @param: spec (String or list of Strings) like 'hflip,rot180', None for no variants
+
+    @return: tuple of variant names, always starting with 'identity'
+    """
+    if not spec:
+        return ('identity',)
+    names = spec.split(',') if isinstance(spec, str) else list(spec)
+    variants = ['identity']
+    for name in (n.strip() for n in names):
+        if name not in VARIANTS:
+            raise ValueError("Unknown variant '%s', choose from: %s" % (name, ', '.join(sorted(VARIANTS))))
+        if name not in variants:
+            variants.append(name)
+    return tuple(variants)
+
+def check_variants(variants, *sizes):
+    """
+    Raises ValueError when rotations are asked for with any (h, w) in `sizes` not square.
+    """
+    for name in parse_variants(variants):
+        if VARIANTS[name][1] and any(h != w for h, w in sizes):
+            raise ValueError("Variant '%s' needs square tiles" % name)
+
+def apply_variant(tiles, name):
+    """
+    @param: tiles (numpy arr) one (h, w, c) tile or a (N, h, w, c) batch
+    """
+    return VARIANTS[name][0](tiles)
+
+def vector_permutation(name, h, w, c):
+    """
+    @return: int array `perm` with vector[perm] the vector of the tile's variant
+    """
+    return np.ascontiguousarray(apply_variant(np.arange(h * w * c).reshape(h, w, c), name)).ravel()
+
+def encode_ids(images, slots, num_images):
+    images = np.asarray(images, dtype=np.int64)
+    return np.where(images >= 0, np.asarray(slots, dtype=np.int64) * num_images + images, -1)
+
+def decode_ids(ids, num_images):
+    """
+    @return: tuple (codebook image ids, variant slots), -1 ids stay -1 (slot 0)
+    """
+    ids = np.asarray(ids)
+    valid = ids >= 0
+    return np.where(valid, ids % num_images, -1), np.where(valid, ids // num_images, 0)
+
+def expand_ids(images, num_images, num_variants):
+    """
+    @return: every encoded id of the codebook `images`, one per variant
+    """
+    images = np.asarray(list(images), dtype=np.int64)
+    return (np.arange(num_variants)[:, None] * num_images + images[None, :]).ravel()
+
+def add_variant_vectors(index, matrix, variants, h, w, c):
+    """
+    Adds the permuted copies of `matrix` for every variant but 'identity',
+    which is expected to be in `index` already, in slot order.
+    """
+    from emosaic.utils.storage import add_in_chunks
+
+    for name in parse_variants(variants)[1:]:
+        add_in_chunks(index, matrix, columns=vector_permutation(name, h, w, c))
+    return index
+
+def augment_matrix(matrix, variants, h, w, c):
+    """
+    @return: matrix followed by its permuted copies, in slot order (for indexes that
+             need every vector at once, like cascades)
+    """
+    return np.concatenate([matrix[:, vector_permutation(name, h, w, c)] for name in parse_variants(variants)])
+
+def variant_tiles(tile_images, ids, variants):
+    """
+    @param: tile_images (list or array of images) codebook tiles, by image id
+    @param: ids (int array) encoded ids, -1 for none (black tiles)
+
+    @return: (len(ids), h, w, c) array of the tiles, flipped & rotated
+    """
+    stack = np.asarray(tile_images)
+    images, slots = decode_ids(ids, len(stack))
+    tiles = stack[np.maximum(images, 0)]
+    tiles[images < 0] = 0
+    for slot, name in enumerate(parse_variants(variants)):
+        if slot:
+            which = slots == slot
+            if which.any():
+                tiles[which] = apply_variant(tiles[which], name)
+    return tiles
@@ -1,14 +1,10 @@
 import os
-import sys
-import time
 import argparse
 
 import cv2
 import numpy as np
-import matplotlib.pyplot as plt
 
-from emosaic.utils.indexing import index_at_multiple_scales
-from emosaic import mosaicify
+from emosaic.utils.rendering import ScaleRenderer
 
 """
 Example usage:
@@ -19,6 +15,9 @@ Example usage:
         --savepath "media/output/%s-%d.jpg" \
         --min-scale 12 \
         --max-scale 14
+
+Drag the sliders to change scale, best K, randomness and opacity,
+press 'r' to re-roll random choices, 's' to save and ESC to quit.
 """
 parser = argparse.ArgumentParser()
 
@@ -29,12 +28,18 @@ parser.add_argument("--savepath", dest='savepath', type=str, required=True, help
 
 # optional
 parser.add_argument("--randomness", dest='randomness', type=float, default=0.0, help="Probability to use random tile")
-parser.add_argument("--min-scale", dest='min_scale', type=int, required=False, help="Minimum scale to index")
-parser.add_argument("--max-scale", dest='max_scale', type=int, required=False, help="Maximum scale to index")
+parser.add_argument("--min-scale", dest='min_scale', type=int, default=1, help="Minimum scale on the slider")
+parser.add_argument("--max-scale", dest='max_scale', type=int, default=30, help="Maximum scale on the slider")
 parser.add_argument("--height-aspect", dest='height_aspect', type=float, default=4.0, help="Height aspect")
 parser.add_argument("--width-aspect", dest='width_aspect', type=float, default=3.0, help="Width aspect")
 parser.add_argument("--vectorization-factor", dest='vectorization_factor', type=float, default=1., 
     help="Downsize the image by this much before vectorizing")
+parser.add_argument("--nprocesses", dest='nprocesses', type=int, default=2, help="Background render workers")
+parser.add_argument("--prefetch", dest='prefetch', type=int, default=1, 
+    help="Also render this many scales on either side of the current one")
+parser.add_argument("--max-cached", dest='max_cached', type=int, default=8, help="Scales' search results to keep in memory")
+parser.add_argument("--num-candidates", dest='num_candidates', type=int, default=8, 
+    help="Top matches kept per tile, and the largest best-k the slider offers")
 
 # parser.add_argument('--feature', dest='feature', action='store_true')
 args = parser.parse_args()
@@ -44,43 +49,54 @@ print("Images=%s, target=%s, min_scale=%d, max_scale=%d, aspect_ratio=%.4f, vect
     args.codebook_dir, args.target, args.min_scale, args.max_scale, 
     args.height_aspect / args.width_aspect, args.vectorization_factor, args.randomness))
 
-aspect_ratio = args.height_aspect / float(args.width_aspect)
-
 # load target image 
 target_image = cv2.imread(args.target)
 
-# create indexes for each possible scale
-scale2index, scale2mosaic = index_at_multiple_scales(
+# scales are indexed & rendered lazily on background workers as the slider moves
+renderer = ScaleRenderer(
+    target_image,
     args.codebook_dir,
+    args.height_aspect,
+    args.width_aspect,
     min_scale=args.min_scale,
     max_scale=args.max_scale,
-    height_aspect=args.height_aspect,
-    width_aspect=args.width_aspect,
-    vectorization_factor=args.vectorization_factor,
-    precompute_target=target_image,
-    use_stabilization=True,
-    stabilization_threshold=0.85,
-    randomness=args.randomness,
-    caching=True,
-)
+    max_cached=args.max_cached,
+    prefetch=args.prefetch,
+    nprocesses=args.nprocesses,
+    index_kwargs=dict(
+        vectorization_scaling_factor=args.vectorization_factor,
+        caching=True,
+        use_detect_faces=True),
+    num_candidates=args.num_candidates)
 
 # Create our window
 window_name = 'Mosaic Interactive Scaling'
 slider_name = 'Scale'
 cv2.namedWindow(window_name)
 cv2.createTrackbar(slider_name, window_name, 0, args.max_scale - args.min_scale + 1, lambda x: None)
+
+# selection & blending only re-render from cached candidates, so they're instant
+cv2.createTrackbar('Best K', window_name, 1, max(1, args.num_candidates - 1), lambda x: None)
+cv2.setTrackbarMin('Best K', window_name, 1)
+cv2.createTrackbar('Randomness %', window_name, int(args.randomness * 100), 100, lambda x: None)
+cv2.createTrackbar('Opacity %', window_name, 0, 100, lambda x: None)
+
 last_scale = -1
+last_settings = None
+is_preview = False
+seed = 0
 mosaic = np.array(target_image)
 
 while True:
-    cv2.imshow(window_name, mosaic)
+    cv2.imshow(window_name, mosaic.astype(np.uint8))
 
     # user operation key commands
-    if cv2.waitKey(1) & 0xFF == 27:  # ESC key
+    key = cv2.waitKey(1) & 0xFF
+    if key == 27:  # ESC key
         break
-    elif cv2.waitKey(1) & 0xFF == 115:  # 's' key
-        if mosaic is None:
-            print("Adjust the scale before saving!")
+    elif key == 115:  # 's' key
+        if last_scale < args.min_scale or is_preview:
+            print("Wait for a rendered mosaic before saving!")
             continue
 
         filename = os.path.basename(args.target)
@@ -88,27 +104,38 @@ while True:
         print("Saving mosaic image to '%s' ..." % savepath)
         cv2.imwrite(savepath, mosaic.astype(np.uint8))
         break
+    elif key == 114:  # 'r' key
+        # re-roll the random choices
+        seed += 1
 
     # get current position of trackbar
     gui_scale = cv2.getTrackbarPos(slider_name, window_name)
     scale = gui_scale + args.min_scale - 1 # since sliders must always start at zero...
 
-    if scale == args.min_scale - 1 or last_scale == -1:
+    if scale == args.min_scale - 1:
         # show original image
         mosaic = np.array(target_image)
+        is_preview = False
 
-    elif scale != last_scale:
-        print("Scale change detected! %d -> %d" % (last_scale, scale))
+    else:
+        settings = dict(
+            best_k=cv2.getTrackbarPos('Best K', window_name),
+            randomness=cv2.getTrackbarPos('Randomness %', window_name) / 100.,
+            opacity=cv2.getTrackbarPos('Opacity %', window_name) / 100.,
+            seed=seed)
 
-        # get index for this scale
-        if scale not in scale2index:
-            print("invalid scale! (%d)" % scale)
-            continue
+        if scale != last_scale or settings != last_settings or is_preview:
+            if scale != last_scale:
+                print("Scale change detected! %d -> %d" % (last_scale, scale))
 
-        # lookup the precomputed mosaic
-        mosaic = scale2mosaic[scale]
+            # show the full render if it's done, otherwise a quick preview until it is
+            rendered = renderer.get(scale, **settings)
+            is_preview = rendered is None
+            mosaic = renderer.preview(scale) if is_preview else rendered
+            last_settings = settings
 
     # adjust our last seen scale
     last_scale = scale
 
+renderer.close()
 cv2.destroyAllWindows()